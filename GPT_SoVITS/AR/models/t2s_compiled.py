@@ -0,0 +1,201 @@
+# 静态形状的T2S单步解码, 供 torch.compile 编译(CUDA上 mode="reduce-overhead" 会捕获为CUDA Graph)
+import os
+import threading
+import traceback
+from time import perf_counter as ttime
+from typing import List, Tuple
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+COMPILE_MODES = ["eager", "default", "reduce-overhead", "max-autotune"]
+
+
+def setup_compile_cache(cache_dir:str):
+    '''
+    Keep the inductor caches (compiled kernels, FX graphs) in `cache_dir`,
+        so a restarted server reuses the kernels compiled by the previous warmup.
+    '''
+    if cache_dir in [None, ""]:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(cache_dir))
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except Exception:
+        pass
+
+
+class T2SStaticDecodeStep(nn.Module):
+    '''
+    One decode step of T2STransformer over kv caches of a fixed capacity.
+
+    No shape changes between steps: the new k/v are written at `pos` with index_copy_,
+        attention always covers the whole cache and the positions after `pos` are masked.
+    The weights of the blocks are registered on this module (shared, not copied) and the caches and `pos` are buffers,
+        so the CUDA graphs captured by torch.compile(mode="reduce-overhead") treat all of them as static
+        and update the caches in place instead of copying inputs on every replay.
+    '''
+    weight_names = ["qkv_w", "qkv_b", "out_w", "out_b", "norm_w1", "norm_b1", "norm_w2", "norm_b2"]
+    mlp_weight_names = ["w1", "b1", "w2", "b2"]
+
+    def __init__(self, blocks:list, batch_size:int, capacity:int, dtype:torch.dtype, device:torch.device):
+        super().__init__()
+        self.blocks = blocks
+        self.num_blocks:int = len(blocks)
+        self.num_heads:int = blocks[0].num_heads
+        self.hidden_dim:int = blocks[0].hidden_dim
+        self.norm_eps1:List[float] = [block.norm_eps1 for block in blocks]
+        self.norm_eps2:List[float] = [block.norm_eps2 for block in blocks]
+        self.batch_size = batch_size
+        self.capacity = capacity
+        for i, block in enumerate(blocks):
+            for name in self.weight_names:
+                self._register_weight(f"{name}_{i}", getattr(block, name))
+            for name in self.mlp_weight_names:
+                self._register_weight(f"mlp_{name}_{i}", getattr(block.mlp, name))
+            self.register_buffer(f"k_cache_{i}", torch.zeros(batch_size, capacity, self.hidden_dim, dtype=dtype, device=device), persistent=False)
+            self.register_buffer(f"v_cache_{i}", torch.zeros(batch_size, capacity, self.hidden_dim, dtype=dtype, device=device), persistent=False)
+        self.register_buffer("positions", torch.arange(capacity, device=device).view(1, 1, 1, capacity), persistent=False)
+        self.register_buffer("pos", torch.zeros(1, dtype=torch.long, device=device), persistent=False)
+
+    def _register_weight(self, name:str, weight:torch.Tensor):
+        if isinstance(weight, nn.Parameter):
+            self.register_parameter(name, weight)
+        else:
+            self.register_buffer(name, weight, persistent=False)
+
+    def load_prompt(self, k_cache:List[torch.Tensor], v_cache:List[torch.Tensor], kv_len:int):
+        for i in range(self.num_blocks):
+            getattr(self, f"k_cache_{i}")[:, :kv_len] = k_cache[i][:, :kv_len]
+            getattr(self, f"v_cache_{i}")[:, :kv_len] = v_cache[i][:, :kv_len]
+
+    def export_cache(self, kv_len:int, max_kv_len:int)->Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        '''
+        Copies of the first kv_len positions with room for max_kv_len, in the layout of T2STransformer.decode_next_token.
+        '''
+        k_cache, v_cache = [], []
+        for i in range(self.num_blocks):
+            k_cache.append(self.blocks[i].alloc_kv_cache(getattr(self, f"k_cache_{i}")[:, :kv_len], max_kv_len))
+            v_cache.append(self.blocks[i].alloc_kv_cache(getattr(self, f"v_cache_{i}")[:, :kv_len], max_kv_len))
+        return k_cache, v_cache
+
+    def forward(self, x:torch.Tensor)->torch.Tensor:
+        batch_size = x.shape[0]
+        attn_mask = self.positions <= self.pos
+        for i in range(self.num_blocks):
+            w = {name: getattr(self, f"{name}_{i}") for name in self.weight_names}
+            k_cache = getattr(self, f"k_cache_{i}")
+            v_cache = getattr(self, f"v_cache_{i}")
+
+            q, k, v = F.linear(x, w["qkv_w"], w["qkv_b"]).chunk(3, dim=-1)
+            k_cache.index_copy_(1, self.pos, k)
+            v_cache.index_copy_(1, self.pos, v)
+
+            q = q.view(batch_size, 1, self.num_heads, -1).transpose(1, 2)
+            k = k_cache.view(batch_size, self.capacity, self.num_heads, -1).transpose(1, 2)
+            v = v_cache.view(batch_size, self.capacity, self.num_heads, -1).transpose(1, 2)
+            attn = F.scaled_dot_product_attention(q, k, v, attn_mask)
+            attn = attn.transpose(1, 2).reshape(batch_size, 1, self.hidden_dim)
+            attn = F.linear(attn, w["out_w"], w["out_b"])
+
+            x = F.layer_norm(x + attn, [self.hidden_dim], w["norm_w1"], w["norm_b1"], self.norm_eps1[i])
+            mlp = F.relu(F.linear(x, getattr(self, f"mlp_w1_{i}"), getattr(self, f"mlp_b1_{i}")))
+            x = x + F.linear(mlp, getattr(self, f"mlp_w2_{i}"), getattr(self, f"mlp_b2_{i}"))
+            x = F.layer_norm(x, [self.hidden_dim], w["norm_w2"], w["norm_b2"], self.norm_eps2[i])
+        return x
+
+
+class T2SCompiledDecoder:
+    '''
+    Opt-in compiled decode steps for single sentence inference (batch size 1).
+
+    mode: "reduce-overhead" (torch.compile + CUDA graphs), "default" / "max-autotune" (torch.compile, inductor on CPU),
+        "eager" (the static step without compiling).
+    If compiling fails, the error is printed and the static step runs eagerly.
+    The static caches are shared, one sequence uses them at a time: `acquire` returns False while another
+        request holds them, and that request decodes with T2STransformer.decode_next_token as before.
+    Sequences growing past `capacity` move their caches back to the eager path, see `export_cache`.
+    The step is rebuilt (and recompiled) when the dtype or device of the weights changes.
+    '''
+    def __init__(self, transformer, mode:str="reduce-overhead", capacity:int=2048):
+        assert mode in COMPILE_MODES, f"unknown compile mode: {mode}"
+        self.transformer = transformer
+        self.mode = mode
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.step_module:T2SStaticDecodeStep = None
+        self.step_fn = None
+        self.key:tuple = None
+
+    def _build(self, dtype:torch.dtype, device:torch.device):
+        key = (dtype, str(device))
+        if self.key == key:
+            return
+        self.step_module = T2SStaticDecodeStep(self.transformer.blocks, 1, self.capacity, dtype, device)
+        self.step_fn = self.step_module
+        if self.mode != "eager":
+            try:
+                self.step_fn = torch.compile(self.step_module, mode=self.mode, fullgraph=True)
+            except Exception:
+                traceback.print_exc()
+                print("torch.compile is not available, T2S decode steps run eagerly")
+        self.key = key
+
+    def _run(self, x:torch.Tensor)->torch.Tensor:
+        try:
+            # CUDA Graph 的输出在下次重放时会被覆盖
+            return self.step_fn(x).clone()
+        except Exception:
+            if self.step_fn is self.step_module:
+                raise
+            traceback.print_exc()
+            print("compiled T2S decode step failed, falling back to eager")
+            self.step_fn = self.step_module
+            return self.step_fn(x).clone()
+
+    def warmup(self, dtype:torch.dtype, device:torch.device, steps:int=3):
+        '''
+        Compile (and capture) the step before the first request, the first calls of a compiled step are slow.
+        '''
+        with self.lock:
+            self._build(dtype, device)
+            t = ttime()
+            x = torch.zeros(1, 1, self.step_module.hidden_dim, dtype=dtype, device=device)
+            with torch.no_grad():
+                for i in range(steps):
+                    self.step_module.pos.fill_(i)
+                    self._run(x)
+            print(f"T2S decode warmup ({self.mode}): {ttime() - t:.1f}s")
+
+    def acquire(self, x:torch.Tensor, src_len:int)->bool:
+        if x.shape[0] != 1 or src_len + 1 > self.capacity:
+            return False
+        if not self.lock.acquire(blocking=False):
+            return False
+        try:
+            self._build(x.dtype, x.device)
+        except Exception:
+            self.lock.release()
+            traceback.print_exc()
+            return False
+        return True
+
+    def release(self):
+        self.lock.release()
+
+    def load_prompt(self, k_cache:List[torch.Tensor], v_cache:List[torch.Tensor], kv_len:int):
+        self.step_module.load_prompt(k_cache, v_cache, kv_len)
+
+    def decode_next_token(self, x:torch.Tensor, kv_len:int)->torch.Tensor:
+        '''
+        Same as T2STransformer.decode_next_token(x, k_cache, v_cache, kv_len)[0], requires kv_len < capacity.
+        '''
+        self.step_module.pos.fill_(kv_len)
+        return self._run(x)
+
+    def export_cache(self, kv_len:int, max_kv_len:int):
+        return self.step_module.export_cache(kv_len, max_kv_len)
@@ -9,14 +9,15 @@ import torch
 from tqdm import tqdm
 
 from AR.models.utils import make_pad_mask
+from AR.models.t2s_compiled import T2SCompiledDecoder
 from AR.models.utils import (
     topk_sampling,
-    sample,
     logits_to_probs,
     multinomial_sample_one_no_sync,
     dpo_loss,
     make_reject_y, 
-    get_batch_logps
+    get_batch_logps,
+    Sampler
 )
 from AR.modules.embedding import SinePositionalEmbedding
 from AR.modules.embedding import TokenEmbedding
@@ -42,20 +43,18 @@ default_config = {
 @torch.jit.script
 # Efficient implementation equivalent to the following:
 def scaled_dot_product_attention(query:torch.Tensor, key:torch.Tensor, value:torch.Tensor, attn_mask:Optional[torch.Tensor]=None, scale:Optional[torch.Tensor]=None) -> torch.Tensor:
-    B, H, L, S =query.size(0), query.size(1), query.size(-2), key.size(-2)
     if scale is None:
         scale_factor = torch.tensor(1 / math.sqrt(query.size(-1)))
     else:
         scale_factor = scale
-    attn_bias = torch.zeros(B, H, L, S, dtype=query.dtype, device=query.device)
+    attn_weight = query @ key.transpose(-2, -1) * scale_factor
 
+    # 直接在attn_weight上加mask, 不再分配 B×H×L×S 的attn_bias; 没有mask时(单条解码)不做任何额外计算
     if attn_mask is not None:
         if attn_mask.dtype == torch.bool:
-            attn_bias.masked_fill_(attn_mask, float("-inf"))
+            attn_weight.masked_fill_(attn_mask, float("-inf"))
         else:
-            attn_bias += attn_mask
-    attn_weight = query @ key.transpose(-2, -1) * scale_factor
-    attn_weight += attn_bias
+            attn_weight += attn_mask
     attn_weight = torch.softmax(attn_weight, dim=-1)
 
     if attn_mask is not None:
@@ -68,6 +67,22 @@ def scaled_dot_product_attention(query:torch.Tensor, key:torch.Tensor, value:tor
 
     return attn_weight @ value
 
+@torch.jit.script
+def sdpa_attention(query:torch.Tensor, key:torch.Tensor, value:torch.Tensor, attn_mask:Optional[torch.Tensor]=None) -> torch.Tensor:
+    '''
+    torch.nn.functional.scaled_dot_product_attention (flash / memory-efficient / math kernels),
+        taking masks in the convention of scaled_dot_product_attention above: True means masked.
+    '''
+    if attn_mask is None:
+        return F.scaled_dot_product_attention(query, key, value)
+    if attn_mask.dtype == torch.bool:
+        keep_mask = attn_mask.logical_not()
+        # 整行都被mask的位置(batch中padding的query)会得到NaN, 让它们看到所有位置,
+        # 这些位置的输出随后会被padding_mask置零
+        keep_mask = keep_mask.logical_or(keep_mask.any(dim=-1, keepdim=True).logical_not())
+        return F.scaled_dot_product_attention(query, key, value, keep_mask)
+    return F.scaled_dot_product_attention(query, key, value, attn_mask)
+
 @torch.jit.script
 class T2SMLP:
     def __init__(self, w1, b1, w2, b2):
@@ -113,8 +128,13 @@ class T2SBlock:
         self.norm_w2 = norm_w2
         self.norm_b2 = norm_b2
         self.norm_eps2 = norm_eps2
+        # 为True时使用 F.scaled_dot_product_attention, 见 Text2SemanticDecoder.set_attention_backend
+        self.use_sdpa: bool = False
 
-        self.false = torch.tensor(False, dtype=torch.bool)
+    def attention(self, q:torch.Tensor, k:torch.Tensor, v:torch.Tensor, attn_mask:Optional[torch.Tensor]=None):
+        if self.use_sdpa:
+            return sdpa_attention(q, k, v, attn_mask)
+        return scaled_dot_product_attention(q, k, v, attn_mask)
 
     @torch.jit.ignore
     def to_mask(self, x:torch.Tensor, padding_mask:Optional[torch.Tensor]):
@@ -143,65 +163,55 @@ class T2SBlock:
         k = k_cache.view(batch_size, kv_len, self.num_heads, -1).transpose(1, 2)
         v = v_cache.view(batch_size, kv_len, self.num_heads, -1).transpose(1, 2)
 
-        attn = scaled_dot_product_attention(q, k, v, attn_mask)
+        attn = self.attention(q, k, v, attn_mask)
 
         attn = attn.permute(2, 0, 1, 3).reshape(batch_size*q_len, self.hidden_dim)
         attn = attn.view(q_len, batch_size, self.hidden_dim).transpose(1, 0)
         attn = F.linear(self.to_mask(attn, padding_mask), self.out_w, self.out_b)
 
-        if padding_mask is not None:
-            for i in range(batch_size):
-                # mask = padding_mask[i,:,0]
-                if self.false.device!= padding_mask.device:
-                    self.false = self.false.to(padding_mask.device)
-                idx = torch.where(padding_mask[i,:,0]==self.false)[0]
-                x_item = x[i,idx,:].unsqueeze(0)
-                attn_item = attn[i,idx,:].unsqueeze(0)
-                x_item = x_item + attn_item
-                x_item = F.layer_norm(
-                    x_item, [self.hidden_dim], self.norm_w1, self.norm_b1, self.norm_eps1
-                )
-                x_item = x_item + self.mlp.forward(x_item)
-                x_item = F.layer_norm(
-                    x_item,
-                    [self.hidden_dim],
-                    self.norm_w2,
-                    self.norm_b2,
-                    self.norm_eps2,
-                )
-                x[i,idx,:] = x_item.squeeze(0)
-            x = self.to_mask(x, padding_mask)
-        else:
-            x = x + attn
-            x = F.layer_norm(
-                x, [self.hidden_dim], self.norm_w1, self.norm_b1, self.norm_eps1
-            )
-            x = x + self.mlp.forward(x)
-            x = F.layer_norm(
-                x,
-                [self.hidden_dim],
-                self.norm_w2,
-                self.norm_b2,
-                self.norm_eps2,
-            )
+        # layer_norm 和 MLP 都是逐位置计算的, 整个batch一起算后再把padding位置置零,
+        # 有效位置的结果与逐条取出有效位置计算相同
+        x = x + attn
+        x = F.layer_norm(
+            x, [self.hidden_dim], self.norm_w1, self.norm_b1, self.norm_eps1
+        )
+        x = x + self.mlp.forward(x)
+        x = F.layer_norm(
+            x,
+            [self.hidden_dim],
+            self.norm_w2,
+            self.norm_b2,
+            self.norm_eps2,
+        )
+        x = self.to_mask(x, padding_mask)
         return x, k_cache, v_cache
     
-    def decode_next_token(self, x:torch.Tensor, k_cache:torch.Tensor, v_cache:torch.Tensor, attn_mask:Optional[torch.Tensor]=None):
+    def alloc_kv_cache(self, kv:torch.Tensor, max_kv_len:int):
+        # 预分配静态kv cache, 解码时原地写入, 避免每步torch.cat整体拷贝
+        cache = torch.zeros(kv.shape[0], max_kv_len, kv.shape[2], dtype=kv.dtype, device=kv.device)
+        cache[:, :kv.shape[1]] = kv
+        return cache
+
+    def decode_next_token(self, x:torch.Tensor, k_cache:torch.Tensor, v_cache:torch.Tensor, kv_len:int, attn_mask:Optional[torch.Tensor]=None):
         q, k, v = F.linear(x, self.qkv_w, self.qkv_b).chunk(3, dim=-1)
 
-        k_cache = torch.cat([k_cache, k], dim=1)
-        v_cache = torch.cat([v_cache, v], dim=1)
+        if kv_len >= k_cache.shape[1]:
+            # 超出预分配长度时按倍数扩容
+            k_cache = self.alloc_kv_cache(k_cache, k_cache.shape[1] * 2)
+            v_cache = self.alloc_kv_cache(v_cache, v_cache.shape[1] * 2)
+        k_cache[:, kv_len:kv_len+1] = k
+        v_cache[:, kv_len:kv_len+1] = v
+        kv_len = kv_len + 1
         
         batch_size = q.shape[0]
         q_len = q.shape[1]
-        kv_len = k_cache.shape[1]
 
         q = q.view(batch_size, q_len, self.num_heads, -1).transpose(1, 2)
-        k = k_cache.view(batch_size, kv_len, self.num_heads, -1).transpose(1, 2)
-        v = v_cache.view(batch_size, kv_len, self.num_heads, -1).transpose(1, 2)
+        k = k_cache[:, :kv_len].view(batch_size, kv_len, self.num_heads, -1).transpose(1, 2)
+        v = v_cache[:, :kv_len].view(batch_size, kv_len, self.num_heads, -1).transpose(1, 2)
 
 
-        attn = scaled_dot_product_attention(q, k, v, attn_mask)
+        attn = self.attention(q, k, v, attn_mask)
 
         attn = attn.permute(2, 0, 1, 3).reshape(batch_size*q_len, self.hidden_dim)
         attn = attn.view(q_len, batch_size, self.hidden_dim).transpose(1, 0)
@@ -231,20 +241,24 @@ class T2STransformer:
     def process_prompt(
         self, x:torch.Tensor, attn_mask : torch.Tensor,
         padding_mask : Optional[torch.Tensor]=None,
+        max_kv_len : int=0,
         ):
         k_cache : List[torch.Tensor] = []
         v_cache : List[torch.Tensor] = []
         for i in range(self.num_blocks):
             x, k_cache_, v_cache_ = self.blocks[i].process_prompt(x, attn_mask, padding_mask)
+            if max_kv_len > k_cache_.shape[1]:
+                k_cache_ = self.blocks[i].alloc_kv_cache(k_cache_, max_kv_len)
+                v_cache_ = self.blocks[i].alloc_kv_cache(v_cache_, max_kv_len)
             k_cache.append(k_cache_)
             v_cache.append(v_cache_)
         return x, k_cache, v_cache
 
     def decode_next_token(
-        self, x:torch.Tensor, k_cache: List[torch.Tensor], v_cache: List[torch.Tensor], attn_mask : Optional[torch.Tensor]=None,
+        self, x:torch.Tensor, k_cache: List[torch.Tensor], v_cache: List[torch.Tensor], kv_len:int, attn_mask : Optional[torch.Tensor]=None,
     ):
         for i in range(self.num_blocks):
-            x, k_cache[i], v_cache[i] = self.blocks[i].decode_next_token(x, k_cache[i], v_cache[i], attn_mask)
+            x, k_cache[i], v_cache[i] = self.blocks[i].decode_next_token(x, k_cache[i], v_cache[i], kv_len, attn_mask)
         return x, k_cache, v_cache
 
 
@@ -332,6 +346,49 @@ class Text2SemanticDecoder(nn.Module):
             blocks.append(block)
         
         self.t2s_transformer = T2STransformer(self.num_layers, blocks)
+        self.attention_backend = "jit"
+        self.compiled_decoder:Optional[T2SCompiledDecoder] = None
+
+    def get_kv_cache_len(self, src_len:int, early_stop_num:int=-1, max_steps:int=1500)->int:
+        """
+        Capacity of the static kv cache: prompt length plus the maximum number of decode steps.
+        """
+        if early_stop_num != -1:
+            max_steps = min(max_steps, early_stop_num + 2)
+        return src_len + max_steps
+
+    def enable_compiled_decode(self, mode:str="reduce-overhead", capacity:int=2048):
+        """
+        Decode single sentences (infer_panel_naive / infer_panel_stream) with a static-shape step compiled by torch.compile,
+            see T2SCompiledDecoder. mode=None disables it.
+        """
+        self.compiled_decoder = None if mode in [None, ""] else T2SCompiledDecoder(self.t2s_transformer, mode, capacity)
+        return self.compiled_decoder
+
+    def decode_next_token_single(self, xy_pos:torch.Tensor, k_cache:List[torch.Tensor], v_cache:List[torch.Tensor], kv_len:int, max_kv_len:int, compiled:Optional[T2SCompiledDecoder]):
+        """
+        One decode step of a single sentence, on the compiled decoder while the sequence fits in it.
+        """
+        if compiled is not None and kv_len >= compiled.capacity:
+            # 超出静态cache长度, 把cache拷回后继续用eager解码
+            k_cache, v_cache = compiled.export_cache(kv_len, max_kv_len)
+            compiled.release()
+            compiled = None
+        if compiled is not None:
+            return compiled.decode_next_token(xy_pos, kv_len), k_cache, v_cache, compiled
+        xy_dec, k_cache, v_cache = self.t2s_transformer.decode_next_token(xy_pos, k_cache, v_cache, kv_len)
+        return xy_dec, k_cache, v_cache, compiled
+
+    def set_attention_backend(self, backend:str="sdpa"):
+        """
+        Attention kernel of the inference blocks (t2s_transformer):
+            "sdpa": torch.nn.functional.scaled_dot_product_attention
+            "jit": the TorchScript scaled_dot_product_attention
+        """
+        assert backend in ["sdpa", "jit"], f"unknown attention backend: {backend}"
+        for block in self.t2s_transformer.blocks:
+            block.use_sdpa = backend == "sdpa"
+        self.attention_backend = backend
 
     def make_input_data(self, x, x_lens, y, y_lens, bert_feature):
         x = self.ar_text_embedding(x)
@@ -566,6 +623,36 @@ class Text2SemanticDecoder(nn.Module):
         # 错位
         return targets[:, :-1], targets[:, 1:]
 
+    def make_batch_padding_mask(self, x_lens:torch.LongTensor, x_len:int, y_lens:torch.LongTensor, y_len:int, max_kv_len:int):
+        """
+        Padding masks of a right padded batch, True at padded positions:
+            xy_padding_mask: (bsz, x_len + y_len), positions of the prompt
+            kv_padding_mask: (bsz, max_kv_len), the same positions as kv cache columns, generated tokens are never masked
+        """
+        xy_padding_mask = torch.concat([make_pad_mask(x_lens, x_len), make_pad_mask(y_lens, y_len)], dim=1)
+        kv_padding_mask = F.pad(xy_padding_mask, (0, max(max_kv_len - x_len - y_len, 0)), value=False)
+        return xy_padding_mask, kv_padding_mask
+
+    def make_batch_prompt_attn_mask(self, x_len:int, y_len:int, kv_padding_mask:torch.Tensor):
+        """
+        Attention mask of the prompt, (bsz, 1, src_len, src_len), broadcast over the heads:
+            text attends to text, audio attends to text and to earlier audio, padded columns are masked.
+        Padded query rows are not masked, their outputs are zeroed by padding_mask in process_prompt.
+        """
+        src_len = x_len + y_len
+        x_mask = F.pad(
+            torch.zeros((x_len, x_len), dtype=torch.bool),
+            (0, y_len),  ###xx的纯0扩展到xx纯0+xy纯1，(x,x+y)
+            value=True,
+        )
+        y_mask = F.pad(  ###yy的右上1扩展到左边xy的0,(y,x+y)
+            torch.triu(torch.ones(y_len, y_len, dtype=torch.bool), diagonal=1),
+            (x_len, 0),
+            value=False,
+        )
+        xy_mask = torch.concat([x_mask, y_mask], dim=0).to(kv_padding_mask.device)
+        return xy_mask.view(1, 1, src_len, src_len).logical_or(kv_padding_mask[:, None, None, :src_len])
+
     def infer_panel_batch_infer(
         self,
         x:List[torch.LongTensor],  #####全部文本token
@@ -599,7 +686,6 @@ class Text2SemanticDecoder(nn.Module):
         y = prompts
         
         x_len = x.shape[1]
-        x_attn_mask = torch.zeros((x_len, x_len), dtype=torch.bool)
         stop = False
 
         k_cache = None
@@ -627,58 +713,37 @@ class Text2SemanticDecoder(nn.Module):
         ##### create mask #####
         bsz = x.shape[0]
         src_len = x_len + y_len
-        y_paddind_mask = make_pad_mask(y_lens, y_len)
-        x_paddind_mask = make_pad_mask(x_lens, max_len)
-        
-        # (bsz, x_len + y_len)
-        xy_padding_mask = torch.concat([x_paddind_mask, y_paddind_mask], dim=1)
-
-        x_mask = F.pad(
-            x_attn_mask,
-            (0, y_len),  ###xx的纯0扩展到xx纯0+xy纯1，(x,x+y)
-            value=True,
-        )
-        y_mask = F.pad(  ###yy的右上1扩展到左边xy的0,(y,x+y)
-            torch.triu(torch.ones(y_len, y_len, dtype=torch.bool), diagonal=1), 
-            (x_len, 0),
-            value=False,
-        )
-        
-        xy_mask = torch.concat([x_mask, y_mask], dim=0).view(1 , src_len, src_len).repeat(bsz, 1, 1).to(x.device)
-        _xy_padding_mask = xy_padding_mask.view(bsz, 1, src_len).repeat(1, src_len, 1)
-        
-        for i in range(bsz):
-            l = x_lens[i]
-            _xy_padding_mask[i,l:max_len,:]=True
-            
-        xy_attn_mask = xy_mask.logical_or(_xy_padding_mask)
-        xy_attn_mask = xy_attn_mask.unsqueeze(1).expand(-1, self.num_head, -1, -1)
-        xy_attn_mask = xy_attn_mask.bool()
+        max_kv_len = self.get_kv_cache_len(src_len, early_stop_num)
+        # kv_padding_mask: (bsz, max_kv_len), 文本padding位置为True, 解码时每步只取前kv_len+1列的视图
+        xy_padding_mask, kv_padding_mask = self.make_batch_padding_mask(x_lens, max_len, y_lens, y_len, max_kv_len)
+        xy_attn_mask = self.make_batch_prompt_attn_mask(x_len, y_len, kv_padding_mask)
         xy_padding_mask = xy_padding_mask.view(bsz, src_len, 1).expand(-1, -1, self.model_dim)
 
         ###### decode #####
         y_list = [None]*y.shape[0]
         batch_idx_map = list(range(y.shape[0]))
         idx_list = [None]*y.shape[0]
+        kv_len = src_len
+        # 重复惩罚使用token计数直方图, 不再每步gather/scatter整个y
+        sampler = Sampler(self.vocab_size, x.device).add(y, top_k, top_p, temperature, repetition_penalty)
         for idx in tqdm(range(1500)):
             if idx == 0:
-                xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, xy_padding_mask)
+                xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, xy_padding_mask, max_kv_len)
             else:
-                xy_dec, k_cache, v_cache = self.t2s_transformer.decode_next_token(xy_pos, k_cache, v_cache, xy_attn_mask)
+                if kv_len + 1 > kv_padding_mask.shape[1]:
+                    kv_padding_mask = F.pad(kv_padding_mask, (0, kv_padding_mask.shape[1]), value=False)
+                xy_attn_mask = kv_padding_mask[:, None, None, :kv_len + 1]
+                xy_dec, k_cache, v_cache = self.t2s_transformer.decode_next_token(xy_pos, k_cache, v_cache, kv_len, xy_attn_mask)
+                kv_len += 1
 
             logits = self.ar_predict_layer(
                 xy_dec[:, -1]
             )
 
             if idx == 0:
-                xy_attn_mask = F.pad(xy_attn_mask[:,:,-1].unsqueeze(-2),(0,1),value=False)
                 logits = logits[:, :-1]
-            else:
-                xy_attn_mask = F.pad(xy_attn_mask,(0,1),value=False)
 
-            samples = sample(
-                    logits, y, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty, temperature=temperature
-                )[0]
+            samples = sampler.sample(logits)[0]
 
             y = torch.concat([y, samples], dim=1)
             
@@ -704,7 +769,8 @@ class Text2SemanticDecoder(nn.Module):
             if reserved_idx_of_batch_for_y is not None:
                 # index = torch.LongTensor(batch_idx_map).to(y.device)
                 y = torch.index_select(y, dim=0, index=reserved_idx_of_batch_for_y)
-                xy_attn_mask = torch.index_select(xy_attn_mask, dim=0, index=reserved_idx_of_batch_for_y)
+                kv_padding_mask = torch.index_select(kv_padding_mask, dim=0, index=reserved_idx_of_batch_for_y)
+                sampler.index_select(reserved_idx_of_batch_for_y)
                 if k_cache is not None :
                     for i in range(len(k_cache)):
                         k_cache[i] = torch.index_select(k_cache[i], dim=0, index=reserved_idx_of_batch_for_y)
@@ -833,47 +899,187 @@ class Text2SemanticDecoder(nn.Module):
         xy_attn_mask = xy_attn_mask.bool()
         # new_attn_mask = torch.zeros_like(xy_attn_mask, dtype=x.dtype)
         # xy_attn_mask = new_attn_mask.masked_fill(xy_attn_mask, float("-inf"))
-        for idx in tqdm(range(1500)):
-            if xy_attn_mask is not None:
-                xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, None)
-            else:
-                xy_dec, k_cache, v_cache = self.t2s_transformer.decode_next_token(xy_pos, k_cache, v_cache)
+        max_kv_len = self.get_kv_cache_len(src_len, early_stop_num)
+        kv_len = src_len
+        # 重复惩罚使用token计数直方图, 不再每步gather/scatter整个y
+        sampler = Sampler(self.vocab_size, x.device).add(y, top_k, top_p, temperature, repetition_penalty)
+        compiled = self.compiled_decoder
+        if compiled is not None and not compiled.acquire(xy_pos, src_len):
+            compiled = None
+        try:
+            for idx in tqdm(range(1500)):
+                if xy_attn_mask is not None:
+                    xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, None, 0 if compiled is not None else max_kv_len)
+                    if compiled is not None:
+                        compiled.load_prompt(k_cache, v_cache, kv_len)
+                else:
+                    xy_dec, k_cache, v_cache, compiled = self.decode_next_token_single(xy_pos, k_cache, v_cache, kv_len, max_kv_len, compiled)
+                    kv_len += 1
+
+                logits = self.ar_predict_layer(
+                    xy_dec[:, -1]
+                )
 
-            logits = self.ar_predict_layer(
-                xy_dec[:, -1]
-            )
+                if idx == 0:
+                    xy_attn_mask = None
+                    logits = logits[:, :-1]
 
-            if idx == 0:
-                xy_attn_mask = None
-                logits = logits[:, :-1]
-
-            samples = sample(
-                logits, y, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty, temperature=temperature
-            )[0]
+                samples = sampler.sample(logits)[0]
 
-            y = torch.concat([y, samples], dim=1)
+                y = torch.concat([y, samples], dim=1)
 
-            if early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num:
-                print("use early stop num:", early_stop_num)
-                stop = True
+                if early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num:
+                    print("use early stop num:", early_stop_num)
+                    stop = True
 
-            if torch.argmax(logits, dim=-1)[0] == self.EOS or samples[0, 0] == self.EOS:
-                stop = True
-            if stop:
-                if y.shape[1]==0:
-                    y = torch.concat([y, torch.zeros_like(samples)], dim=1)
-                    print("bad zero prediction")
-                print(f"T2S Decoding EOS [{prefix_len} -> {y.shape[1]}]")
-                break
+                if torch.argmax(logits, dim=-1)[0] == self.EOS or samples[0, 0] == self.EOS:
+                    stop = True
+                if stop:
+                    if y.shape[1]==0:
+                        y = torch.concat([y, torch.zeros_like(samples)], dim=1)
+                        print("bad zero prediction")
+                    print(f"T2S Decoding EOS [{prefix_len} -> {y.shape[1]}]")
+                    break
 
-            ####################### update next step ###################################
-            y_emb = self.ar_audio_embedding(y[:, -1:])
-            xy_pos = y_emb * self.ar_audio_position.x_scale + self.ar_audio_position.alpha * self.ar_audio_position.pe[:, y_len + idx].to(dtype=y_emb.dtype,device=y_emb.device)
+                ####################### update next step ###################################
+                y_emb = self.ar_audio_embedding(y[:, -1:])
+                xy_pos = y_emb * self.ar_audio_position.x_scale + self.ar_audio_position.alpha * self.ar_audio_position.pe[:, y_len + idx].to(dtype=y_emb.dtype,device=y_emb.device)
+        finally:
+            if compiled is not None:
+                compiled.release()
 
         if ref_free:
             return y[:, :-1], 0
         return y[:, :-1], idx - 1
     
+    def infer_panel_stream(
+        self,
+        x:torch.LongTensor,  #####全部文本token
+        x_lens:torch.LongTensor,
+        prompts:torch.LongTensor,  ####参考音频token
+        bert_feature:torch.LongTensor,
+        top_k: int = -100,
+        top_p: int = 100,
+        early_stop_num: int = -1,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.35,
+        chunk_size: int = 12,
+        **kwargs
+    ):
+        '''
+        与 infer_panel_naive 相同的单句解码, 但每确定 chunk_size 个语义token就 yield 一次 ([1, n]).
+        所有 yield 出的token拼接后, 与 infer_panel_naive 返回的 y[:, -idx:] 一致.
+        '''
+        x = self.ar_text_embedding(x)
+        x = x + self.bert_proj(bert_feature.transpose(1, 2))
+        x = self.ar_text_position(x)
+
+        # AR Decoder
+        y = prompts
+        
+        x_len = x.shape[1]
+        x_attn_mask = torch.zeros((x_len, x_len), dtype=torch.bool)
+        stop = False
+
+        k_cache = None
+        v_cache = None
+        ###################  first step ##########################
+        if y is not None:
+            y_emb = self.ar_audio_embedding(y)
+            y_len = y_emb.shape[1]
+            prefix_len = y.shape[1]
+            y_pos = self.ar_audio_position(y_emb)
+            xy_pos = torch.concat([x, y_pos], dim=1)
+            ref_free = False
+        else:
+            y_emb = None
+            y_len = 0
+            prefix_len = 0
+            y_pos = None
+            xy_pos = x
+            y = torch.zeros(x.shape[0], 0, dtype=torch.int, device=x.device)
+            ref_free = True
+
+        bsz = x.shape[0]
+        src_len = x_len + y_len
+        x_attn_mask_pad = F.pad(
+            x_attn_mask,
+            (0, y_len),  ###xx的纯0扩展到xx纯0+xy纯1，(x,x+y)
+            value=True,
+        )
+        y_attn_mask = F.pad(  ###yy的右上1扩展到左边xy的0,(y,x+y)
+            torch.triu(torch.ones(y_len, y_len, dtype=torch.bool), diagonal=1),
+            (x_len, 0),
+            value=False,
+        )
+        xy_attn_mask = torch.concat([x_attn_mask_pad, y_attn_mask], dim=0).unsqueeze(0).expand(bsz*self.num_head, -1, -1).view(bsz, self.num_head, src_len, src_len).to(x.device)
+        xy_attn_mask = xy_attn_mask.bool()
+        max_kv_len = self.get_kv_cache_len(src_len, early_stop_num)
+        kv_len = src_len
+        # 重复惩罚使用token计数直方图, 不再每步gather/scatter整个y
+        sampler = Sampler(self.vocab_size, x.device).add(y, top_k, top_p, temperature, repetition_penalty)
+
+        # 最后一个采样的token在解码于下一步结束时会被丢弃(同 y[:, :-1]), 因此延后一步才确定;
+        # 有参考音频时第一个token同样不输出(同 idx - 1)
+        pending = None
+        skip_first = not ref_free
+        chunk = []
+        compiled = self.compiled_decoder
+        if compiled is not None and not compiled.acquire(xy_pos, src_len):
+            compiled = None
+        try:
+            for idx in tqdm(range(1500)):
+                if xy_attn_mask is not None:
+                    xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, None, 0 if compiled is not None else max_kv_len)
+                    if compiled is not None:
+                        compiled.load_prompt(k_cache, v_cache, kv_len)
+                else:
+                    xy_dec, k_cache, v_cache, compiled = self.decode_next_token_single(xy_pos, k_cache, v_cache, kv_len, max_kv_len, compiled)
+                    kv_len += 1
+
+                logits = self.ar_predict_layer(
+                    xy_dec[:, -1]
+                )
+
+                if idx == 0:
+                    xy_attn_mask = None
+                    logits = logits[:, :-1]
+
+                samples = sampler.sample(logits)[0]
+
+                y = torch.concat([y, samples], dim=1)
+
+                if pending is not None:
+                    if skip_first:
+                        skip_first = False
+                    else:
+                        chunk.append(pending)
+                pending = samples
+
+                if early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num:
+                    print("use early stop num:", early_stop_num)
+                    stop = True
+
+                if torch.argmax(logits, dim=-1)[0] == self.EOS or samples[0, 0] == self.EOS:
+                    stop = True
+                if stop:
+                    print(f"T2S Decoding EOS [{prefix_len} -> {y.shape[1]}]")
+                    break
+
+                if len(chunk) >= chunk_size:
+                    yield torch.concat(chunk, dim=1)
+                    chunk = []
+
+                ####################### update next step ###################################
+                y_emb = self.ar_audio_embedding(y[:, -1:])
+                xy_pos = y_emb * self.ar_audio_position.x_scale + self.ar_audio_position.alpha * self.ar_audio_position.pe[:, y_len + idx].to(dtype=y_emb.dtype,device=y_emb.device)
+        finally:
+            if compiled is not None:
+                compiled.release()
+
+        if len(chunk) > 0:
+            yield torch.concat(chunk, dim=1)
+    
     def infer_panel(
         self,
         x:torch.LongTensor,  #####全部文本token
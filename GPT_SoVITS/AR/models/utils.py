@@ -227,3 +227,148 @@ def make_reject_y(y_o, y_lens):
     reject_y_lens = torch.tensor(reject_y_lens, device=y_lens.device)
 
     return reject_y, reject_y_lens
+
+
+def sampling_plan(vocab_size: int, top_k: torch.Tensor, top_p: torch.Tensor, repetition_penalty: torch.Tensor) -> Tuple[int, bool, bool]:
+    """
+    The shape of the sampling work for a set of per-row parameters, needed on the host:
+        (topk size, any row uses top-p, any row uses repetition penalty).
+    """
+    top_k = [vocab_size if k <= 0 or k > vocab_size else k for k in top_k.view(-1).tolist()]
+    top_p = top_p.view(-1).tolist()
+    any_top_p = any(p < 1.0 for p in top_p)
+    topk_size = max(top_k, default=1)
+    if any(p < 1.0 and k == vocab_size for k, p in zip(top_k, top_p)):
+        topk_size = vocab_size
+    any_penalty = any(r != 1.0 for r in repetition_penalty.view(-1).tolist())
+    return topk_size, any_top_p, any_penalty
+
+
+def logits_to_probs_batched(
+    logits: torch.Tensor,
+    token_counts: Optional[torch.Tensor],
+    temperature: torch.Tensor,
+    top_k: torch.Tensor,
+    top_p: torch.Tensor,
+    repetition_penalty: torch.Tensor,
+    plan: Optional[Tuple[int, bool, bool]] = None,
+) -> torch.Tensor:
+    """
+    Same result as logits_to_probs, with one set of parameters per row ((bsz, 1) tensors) and
+    the history given as a token count histogram (bsz, vocab_size).
+
+    top_k <= 0 and top_p >= 1 disable the filter of that row. top-p reuses the topk of top-k
+    instead of sorting the whole vocabulary when every row that uses top-p also uses top-k.
+    Like logits_to_probs, the repetition penalty is applied to `logits` in place.
+    plan: (topk size, any row uses top-p, any row uses repetition penalty), see `sampling_plan`,
+        computed from the parameters (with a device sync) when not given.
+    """
+    vocab_size = logits.shape[1]
+    topk_size, any_top_p, any_penalty = sampling_plan(vocab_size, top_k, top_p, repetition_penalty) if plan is None else plan
+    if token_counts is not None and any_penalty:
+        seen = token_counts[:, :vocab_size] > 0
+        penalized = torch.where(logits < 0, logits * repetition_penalty, logits / repetition_penalty)
+        logits.copy_(torch.where(seen, penalized, logits))
+
+    top_k = torch.where((top_k <= 0) | (top_k > vocab_size), vocab_size, top_k)
+    # 降序排列的前topk_size个, 同时用于top-k的阈值和top-p的累积概率
+    values, indices = torch.topk(logits, topk_size)
+
+    pivot = values.gather(1, top_k - 1)
+    indices_to_remove = logits < pivot
+    if any_top_p:
+        use_top_p = top_p < 1.0
+        cum_probs = torch.cumsum(torch.exp(values - torch.logsumexp(logits, dim=-1, keepdim=True)), dim=-1)
+        sorted_indices_to_remove = (cum_probs > top_p) & use_top_p
+        sorted_indices_to_remove[:, 0] = False  # keep at least one option
+        indices_to_remove = indices_to_remove.scatter(1, indices, sorted_indices_to_remove.logical_or(
+            indices_to_remove.gather(1, indices)))
+
+    logits = logits / temperature.clamp(min=1e-5)
+    logits = logits.masked_fill(indices_to_remove, -float("Inf"))
+    return torch.nn.functional.softmax(logits, dim=-1)
+
+
+class Sampler:
+    """
+    Vectorized sampling of a batch of sequences, each with its own top_k / top_p / temperature / repetition_penalty.
+
+    Instead of the token history, a running token count histogram (bsz, vocab_size) is kept for the
+    repetition penalty, so a sampling step costs the same at the first and at the 1500th token.
+    Rows follow the batch: `add` appends sequences, `index_select` keeps a subset.
+    """
+
+    def __init__(self, vocab_size: int, device: torch.device):
+        self.vocab_size = vocab_size
+        self.device = device
+        self.token_counts = torch.zeros(0, vocab_size, dtype=torch.int32, device=device)
+        self.top_k = torch.zeros(0, 1, dtype=torch.long, device=device)
+        self.top_p = torch.zeros(0, 1, dtype=torch.float, device=device)
+        self.temperature = torch.zeros(0, 1, dtype=torch.float, device=device)
+        self.repetition_penalty = torch.zeros(0, 1, dtype=torch.float, device=device)
+        # 参数不变时复用 sampling_plan, 避免每步都同步设备; 按vocab_size缓存(首步不含EOS)
+        self.plans = {}
+
+    def _param(self, value, n: int, dtype: torch.dtype) -> torch.Tensor:
+        if not isinstance(value, (list, tuple, torch.Tensor)):
+            value = [value] * n
+        return torch.as_tensor(value, dtype=dtype).view(n, 1).to(self.device)
+
+    def add(self, tokens: torch.Tensor, top_k=-100, top_p=1.0, temperature=1.0, repetition_penalty=1.0):
+        """
+        Append sequences. tokens: (n, len), the history of every new sequence (prompt semantic tokens).
+        The parameters are scalars or one value per new sequence.
+        """
+        tokens = tokens.long().to(self.device)
+        n = tokens.shape[0]
+        counts = torch.zeros(n, self.vocab_size, dtype=torch.int32, device=self.device)
+        counts.scatter_add_(1, tokens, torch.ones_like(tokens, dtype=torch.int32))
+        self.token_counts = torch.concat([self.token_counts, counts], dim=0)
+        self.top_k = torch.concat([self.top_k, self._param(-100 if top_k is None else top_k, n, torch.long)], dim=0)
+        self.top_p = torch.concat([self.top_p, self._param(1.0 if top_p is None else top_p, n, torch.float)], dim=0)
+        self.temperature = torch.concat([self.temperature, self._param(temperature, n, torch.float)], dim=0)
+        self.repetition_penalty = torch.concat([self.repetition_penalty, self._param(repetition_penalty, n, torch.float)], dim=0)
+        self.plans = {}
+        return self
+
+    def index_select(self, index: torch.Tensor):
+        index = index.to(self.device)
+        self.token_counts = torch.index_select(self.token_counts, dim=0, index=index)
+        self.top_k = torch.index_select(self.top_k, dim=0, index=index)
+        self.top_p = torch.index_select(self.top_p, dim=0, index=index)
+        self.temperature = torch.index_select(self.temperature, dim=0, index=index)
+        self.repetition_penalty = torch.index_select(self.repetition_penalty, dim=0, index=index)
+        self.plans = {}
+        return self
+
+    def update(self, samples: torch.Tensor):
+        samples = samples.long().view(-1, 1)
+        self.token_counts.scatter_add_(1, samples, torch.ones_like(samples, dtype=torch.int32))
+
+    def extend(self, other: "Sampler"):
+        """
+        Append the rows of another sampler, e.g. a sequence prefilled on its own and merged into the running batch.
+        """
+        self.token_counts = torch.concat([self.token_counts, other.token_counts.to(self.device)], dim=0)
+        self.top_k = torch.concat([self.top_k, other.top_k.to(self.device)], dim=0)
+        self.top_p = torch.concat([self.top_p, other.top_p.to(self.device)], dim=0)
+        self.temperature = torch.concat([self.temperature, other.temperature.to(self.device)], dim=0)
+        self.repetition_penalty = torch.concat([self.repetition_penalty, other.repetition_penalty.to(self.device)], dim=0)
+        self.plans = {}
+        return self
+
+    def sample(self, logits: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Sample the next token of every row and add it to the histogram.
+        Returns (samples (bsz, 1), probs) like `sample`.
+        """
+        vocab_size = logits.shape[1]
+        if vocab_size not in self.plans:
+            self.plans[vocab_size] = sampling_plan(vocab_size, self.top_k, self.top_p, self.repetition_penalty)
+        probs = logits_to_probs_batched(
+            logits, self.token_counts, self.temperature, self.top_k, self.top_p, self.repetition_penalty,
+            self.plans[vocab_size]
+        )
+        samples = multinomial_sample_one_no_sync(probs)
+        self.update(samples)
+        return samples, probs
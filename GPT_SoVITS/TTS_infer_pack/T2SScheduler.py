@@ -0,0 +1,335 @@
+import os, sys
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import queue
+import threading
+import traceback
+from concurrent.futures import Future
+from typing import List
+
+import torch
+import torch.nn.functional as F
+
+from AR.models.t2s_model import Text2SemanticDecoder
+from AR.models.utils import Sampler
+
+
+class T2STask:
+    '''
+    A single sentence waiting for / under T2S decoding in the continuous batch.
+    '''
+    def __init__(self,
+                 x:torch.LongTensor,
+                 prompt:torch.LongTensor,
+                 bert_feature:torch.Tensor,
+                 top_k:int=-100,
+                 top_p:float=100,
+                 temperature:float=1.0,
+                 repetition_penalty:float=1.35,
+                 early_stop_num:int=-1,
+                 ):
+        self.x = x
+        self.prompt = prompt
+        self.bert_feature = bert_feature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.temperature = temperature
+        self.repetition_penalty = repetition_penalty
+        self.early_stop_num = early_stop_num
+        self.future:Future = Future()
+
+        self.prompt_len:int = prompt.shape[0]
+        self.hist_len:int = 0   # 当前序列(prompt+已生成)的真实长度
+        self.idx:int = 0        # 最近一次采样所处的解码步
+        self.kv_start:int = 0   # kv cache中该序列的起始位置, 之前的位置为左侧padding
+
+
+class T2SScheduler:
+    '''
+    Continuous batching scheduler for T2S decoding.
+
+    Sentences submitted by concurrent requests are merged into one running decode batch.
+    New sequences are admitted at step boundaries (prefilled individually and right-aligned
+    into the shared kv cache), finished sequences are retired at EOS.
+    '''
+    def __init__(self, t2s_model:Text2SemanticDecoder, max_batch_size:int=20, max_steps:int=1500):
+        self.t2s_model:Text2SemanticDecoder = t2s_model
+        self.max_batch_size = max_batch_size
+        self.max_steps = max_steps
+
+        self.pending:queue.Queue = queue.Queue()
+        self.tasks:List[T2STask] = []
+        self.model:Text2SemanticDecoder = None
+        self.k_cache:List[torch.Tensor] = None
+        self.v_cache:List[torch.Tensor] = None
+        self.kv_len:int = 0
+        self.y:torch.Tensor = None
+        # 与 tasks 一一对应的采样参数和token计数直方图
+        self.sampler:Sampler = None
+
+        self._stop_event = threading.Event()
+        self._thread:threading.Thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, name="T2SScheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def num_running(self)->int:
+        return len(self.tasks)
+
+    @property
+    def num_pending(self)->int:
+        return self.pending.qsize()
+
+    def submit(self, x:torch.LongTensor, prompt:torch.LongTensor, bert_feature:torch.Tensor, **kwargs)->Future:
+        task = T2STask(x, prompt, bert_feature, **kwargs)
+        self.pending.put(task)
+        return task.future
+
+    def infer_panel(
+        self,
+        x:List[torch.LongTensor],  #####全部文本token
+        x_lens:torch.LongTensor,
+        prompts:torch.LongTensor,  ####参考音频token
+        bert_feature:List[torch.LongTensor],
+        top_k: int = -100,
+        top_p: int = 100,
+        early_stop_num: int = -1,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.35,
+        **kwargs,
+    ):
+        '''
+        Drop-in replacement of Text2SemanticDecoder.infer_panel_batch_infer,
+            blocks until every sentence of the batch reaches EOS in the shared decode batch.
+        '''
+        if prompts is None:
+            print("Warning: Prompt free is not supported by continuous batching! switch to naive_infer")
+            return self.t2s_model.infer_panel_0307(x, x_lens, prompts, bert_feature, top_k=top_k, top_p=top_p, early_stop_num=early_stop_num, temperature=temperature, repetition_penalty=repetition_penalty, **kwargs)
+
+        futures = [self.submit(x_item, prompt, bert_item,
+                               top_k=top_k,
+                               top_p=top_p,
+                               temperature=temperature,
+                               repetition_penalty=repetition_penalty,
+                               early_stop_num=early_stop_num)
+                   for x_item, prompt, bert_item in zip(x, prompts, bert_feature)]
+        results = [future.result() for future in futures]
+        y_list = [y for y, _ in results]
+        idx_list = [idx for _, idx in results]
+        return y_list, idx_list
+
+    def _loop(self):
+        while not self._stop_event.is_set():
+            try:
+                self._admit()
+                if len(self.tasks) == 0:
+                    continue
+                self._step()
+            except Exception as e:
+                traceback.print_exc()
+                for task in self.tasks:
+                    if not task.future.done():
+                        task.future.set_exception(e)
+                self._reset()
+
+    def _reset(self):
+        self.tasks = []
+        self.model = None
+        self.k_cache = None
+        self.v_cache = None
+        self.kv_len = 0
+        self.y = None
+        self.sampler = None
+
+    def _admit(self):
+        while len(self.tasks) < self.max_batch_size:
+            try:
+                if len(self.tasks) == 0:
+                    task = self.pending.get(timeout=0.1)
+                else:
+                    task = self.pending.get_nowait()
+            except queue.Empty:
+                return
+            if self.model is not None and self.model is not self.t2s_model:
+                # 模型已切换, 等当前batch解码完毕后再接纳新序列
+                self.pending.put(task)
+                return
+            try:
+                self._prefill(task)
+            except Exception as e:
+                traceback.print_exc()
+                task.future.set_exception(e)
+
+    @torch.no_grad()
+    def _prefill(self, task:T2STask):
+        model = self.t2s_model if self.model is None else self.model
+
+        x = model.ar_text_embedding(task.x.unsqueeze(0))
+        x = x + model.bert_proj(task.bert_feature.transpose(0, 1).unsqueeze(0))
+        x = model.ar_text_position(x)
+        y_emb = model.ar_audio_embedding(task.prompt.unsqueeze(0))
+        y_pos = model.ar_audio_position(y_emb)
+        xy_pos = torch.concat([x, y_pos], dim=1)
+
+        x_len = x.shape[1]
+        y_len = y_pos.shape[1]
+        src_len = x_len + y_len
+        x_attn_mask = F.pad(
+            torch.zeros((x_len, x_len), dtype=torch.bool),
+            (0, y_len),
+            value=True,
+        )
+        y_attn_mask = F.pad(
+            torch.triu(torch.ones(y_len, y_len, dtype=torch.bool), diagonal=1),
+            (x_len, 0),
+            value=False,
+        )
+        xy_attn_mask = torch.concat([x_attn_mask, y_attn_mask], dim=0).view(1, 1, src_len, src_len).to(xy_pos.device)
+
+        xy_dec, k_cache, v_cache = model.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, None)
+        logits = model.ar_predict_layer(xy_dec[:, -1])[:, :-1]
+        sampler = Sampler(model.vocab_size, xy_pos.device).add(task.prompt.unsqueeze(0), 
+                                                              task.top_k, 
+                                                              task.top_p, 
+                                                              task.temperature, 
+                                                              task.repetition_penalty)
+        samples = sampler.sample(logits)[0]
+        hist = torch.concat([task.prompt, samples[0].to(task.prompt.dtype)], dim=0)
+        task.hist_len = hist.shape[0]
+        task.idx = 0
+
+        self._merge(model, task, k_cache, v_cache, hist, sampler)
+        self._retire(logits)
+
+    def _merge(self, model:Text2SemanticDecoder, task:T2STask, k_cache:List[torch.Tensor], v_cache:List[torch.Tensor], hist:torch.Tensor, sampler:Sampler):
+        src_len = k_cache[0].shape[1]
+        if len(self.tasks) == 0:
+            max_kv_len = model.get_kv_cache_len(src_len, task.early_stop_num, self.max_steps)
+            blocks = model.t2s_transformer.blocks
+            self.k_cache = [blocks[i].alloc_kv_cache(k_cache[i], max_kv_len) for i in range(len(k_cache))]
+            self.v_cache = [blocks[i].alloc_kv_cache(v_cache[i], max_kv_len) for i in range(len(v_cache))]
+            self.kv_len = src_len
+            self.y = hist.unsqueeze(0)
+            self.sampler = sampler
+            self.model = model
+            task.kv_start = 0
+            self.tasks.append(task)
+            return
+
+        # 新序列比当前batch更长时, 整体右移已有的kv cache
+        shift = max(0, src_len - self.kv_len)
+        capacity = self.k_cache[0].shape[1] + shift
+        for i in range(len(self.k_cache)):
+            self.k_cache[i] = self._shift_and_append(self.k_cache[i], k_cache[i], shift, capacity)
+            self.v_cache[i] = self._shift_and_append(self.v_cache[i], v_cache[i], shift, capacity)
+        for t in self.tasks:
+            t.kv_start += shift
+        self.kv_len += shift
+        task.kv_start = self.kv_len - src_len
+
+        # 历史token左侧用各自的首个token补齐, 只用于输出, 重复惩罚使用sampler中的直方图
+        width = self.y.shape[1]
+        if hist.shape[0] < width:
+            hist = torch.concat([hist[:1].expand(width - hist.shape[0]), hist], dim=0)
+        elif hist.shape[0] > width:
+            self.y = torch.concat([self.y[:, :1].expand(-1, hist.shape[0] - width), self.y], dim=1)
+        self.y = torch.concat([self.y, hist.unsqueeze(0).to(self.y.dtype)], dim=0)
+        self.sampler.extend(sampler)
+        self.tasks.append(task)
+
+    def _shift_and_append(self, cache:torch.Tensor, new_kv:torch.Tensor, shift:int, capacity:int)->torch.Tensor:
+        bsz = cache.shape[0]
+        kv_len = self.kv_len + shift
+        merged = torch.zeros(bsz + 1, capacity, cache.shape[2], dtype=cache.dtype, device=cache.device)
+        merged[:bsz, shift:shift + self.kv_len] = cache[:, :self.kv_len]
+        merged[bsz, kv_len - new_kv.shape[1]:kv_len] = new_kv[0]
+        return merged
+
+    @torch.no_grad()
+    def _step(self):
+        model = self.model
+        bsz = len(self.tasks)
+        device = self.y.device
+
+        y_emb = model.ar_audio_embedding(self.y[:, -1:])
+        positions = torch.LongTensor([t.prompt_len + t.idx for t in self.tasks])
+        pe = model.ar_audio_position.pe[0, positions].to(dtype=y_emb.dtype, device=device)
+        xy_pos = y_emb * model.ar_audio_position.x_scale + model.ar_audio_position.alpha * pe.unsqueeze(1)
+
+        starts = torch.LongTensor([t.kv_start for t in self.tasks]).to(device)
+        if starts.max() > 0:
+            attn_mask = torch.arange(self.kv_len + 1, device=device).unsqueeze(0) < starts.unsqueeze(1)
+            attn_mask = attn_mask.view(bsz, 1, 1, self.kv_len + 1)
+        else:
+            attn_mask = None
+
+        xy_dec, self.k_cache, self.v_cache = model.t2s_transformer.decode_next_token(xy_pos, self.k_cache, self.v_cache, self.kv_len, attn_mask)
+        self.kv_len += 1
+        logits = model.ar_predict_layer(xy_dec[:, -1])
+
+        # 一次采样整个batch, 每条序列使用各自的top_k/top_p/temperature/repetition_penalty
+        samples = self.sampler.sample(logits)[0].to(self.y.dtype)
+
+        self.y = torch.concat([self.y, samples], dim=1)
+        for t in self.tasks:
+            t.idx += 1
+            t.hist_len += 1
+        self._retire(logits)
+
+    def _retire(self, logits:torch.Tensor):
+        '''
+        Retire the sequences which reached EOS or the early stop limit from the running batch.
+        '''
+        eos = self.model.EOS
+        samples = self.y[:, -1]
+        tokens = torch.argmax(logits, dim=-1)
+        # _prefill只计算了新加入序列的logits
+        offset = len(self.tasks) - tokens.shape[0]
+        finished = (samples[offset:] == eos).logical_or(tokens == eos).tolist()
+
+        width = self.y.shape[1]
+        reserved_idx = []
+        for i, t in enumerate(self.tasks):
+            y_item = self.y[i, width - t.hist_len:]
+            if i >= offset and finished[i - offset]:
+                t.future.set_result((y_item[:-1], t.idx - 1))
+            elif (t.early_stop_num != -1 and (t.hist_len - t.prompt_len) > t.early_stop_num) or t.idx == self.max_steps - 1:
+                print("use early stop num:", t.early_stop_num)
+                t.future.set_result((y_item[:-1], t.idx))
+            else:
+                reserved_idx.append(i)
+                continue
+            print(f"T2S Decoding EOS [{t.prompt_len} -> {t.hist_len}]")
+
+        if len(reserved_idx) == len(self.tasks):
+            return
+        if len(reserved_idx) == 0:
+            self._reset()
+            return
+
+        index = torch.LongTensor(reserved_idx).to(self.y.device)
+        self.tasks = [self.tasks[i] for i in reserved_idx]
+        self.y = torch.index_select(self.y, dim=0, index=index)
+        self.sampler.index_select(index)
+        # 丢弃所有序列共有的左侧padding
+        min_start = min(t.kv_start for t in self.tasks)
+        for i in range(len(self.k_cache)):
+            self.k_cache[i] = torch.index_select(self.k_cache[i], dim=0, index=index)[:, min_start:]
+            self.v_cache[i] = torch.index_select(self.v_cache[i], dim=0, index=index)[:, min_start:]
+        for t in self.tasks:
+            t.kv_start -= min_start
+        self.kv_len -= min_start
+        max_hist_len = max(t.hist_len for t in self.tasks)
+        self.y = self.y[:, self.y.shape[1] - max_hist_len:]
@@ -1,7 +1,10 @@
 from copy import deepcopy
 import math
 import os, sys, gc
+import queue
 import random
+import logging
+import threading
 import traceback
 
 from tqdm import tqdm
@@ -9,7 +12,7 @@ now_dir = os.getcwd()
 sys.path.append(now_dir)
 import ffmpeg
 import os
-from typing import Generator, List, Tuple, Union
+from typing import Callable, Generator, Iterable, List, Tuple, Union
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -17,6 +20,7 @@ import yaml
 from transformers import AutoModelForMaskedLM, AutoTokenizer
 
 from AR.models.t2s_lightning_module import Text2SemanticLightningModule
+from AR.models.t2s_compiled import setup_compile_cache
 from feature_extractor.cnhubert import CNHubert
 from module.models import SynthesizerTrn
 import librosa
@@ -26,9 +30,15 @@ from tools.my_utils import load_audio
 from module.mel_processing import spectrogram_torch
 from TTS_infer_pack.text_segmentation_method import splits
 from TTS_infer_pack.TextPreprocessor import TextPreprocessor
+from TTS_infer_pack.T2SScheduler import T2SScheduler
+from TTS_infer_pack.feature_cache import FeatureCache, hash_file, hash_text
+from TTS_infer_pack.model_pool import ModelPool
+from TTS_infer_pack.frontend_pool import FrontendPool
+from text.cleaner import warmup as warmup_frontends
 language=os.environ.get("language","Auto")
 language=sys.argv[-1] if sys.argv[-1] in scan_language_list() else language
 i18n = I18nAuto(language=language)
+logger = logging.getLogger(__name__)
 
 # configs/tts_infer.yaml
 """
@@ -152,6 +162,29 @@ class TTS_Config:
         self.bert_base_path = self.configs.get("bert_base_path", None)
         self.cnhuhbert_base_path = self.configs.get("cnhuhbert_base_path", None)
         self.languages = self.v2_languages if self.version=="v2" else self.v1_languages
+        self.ref_audio_cache_size = self.configs.get("ref_audio_cache_size", 200)
+        self.ref_audio_cache_dir = self.configs.get("ref_audio_cache_dir", "GPT_SoVITS/cache/ref_audio")
+        self.text_cache_size = self.configs.get("text_cache_size", 2000)
+        self.text_cache_dir = self.configs.get("text_cache_dir", None)
+        # 磁盘缓存的大小上限, 单位为MB, 0 表示不限制; 超出时删除最久未使用的文件
+        self.ref_audio_cache_disk_budget = self.configs.get("ref_audio_cache_disk_budget", 1024)
+        self.text_cache_disk_budget = self.configs.get("text_cache_disk_budget", 1024)
+        self.model_pool_size = self.configs.get("model_pool_size", 1)
+        self.model_pool_cpu_size = self.configs.get("model_pool_cpu_size", 2)
+        self.model_pool_memory_budget = self.configs.get("model_pool_memory_budget", 0)
+        # BERT特征提取后端: "torch" | "onnx" | "onnx_int8"
+        self.bert_backend = self.configs.get("bert_backend", "torch")
+        self.bert_onnx_threads = self.configs.get("bert_onnx_threads", 0)
+        # 启动时预加载的语种前端, 其余语种在首次使用时加载
+        self.warmup_languages = self.configs.get("warmup_languages", [])
+        # 文本前端(G2P)进程池的进程数, 0 表示在调用线程中串行处理
+        self.text_frontend_workers = self.configs.get("text_frontend_workers", 0)
+        # T2S推理的attention实现: "jit"(默认) | "sdpa"(torch.nn.functional.scaled_dot_product_attention, 需手动开启)
+        self.t2s_attention_backend = self.configs.get("t2s_attention_backend", "jit")
+        # 单句解码使用 torch.compile 编译的静态形状解码步: "" 关闭 | "reduce-overhead"(CUDA Graph) | "default" | "max-autotune" | "eager"
+        self.t2s_compile_mode = self.configs.get("t2s_compile_mode", "")
+        self.t2s_compile_max_kv_len = self.configs.get("t2s_compile_max_kv_len", 2048)
+        self.t2s_compile_cache_dir = self.configs.get("t2s_compile_cache_dir", "GPT_SoVITS/cache/inductor")
 
         
         if (self.t2s_weights_path in [None, ""]) or (not os.path.exists(self.t2s_weights_path)):
@@ -211,6 +244,23 @@ class TTS_Config:
             "vits_weights_path"  : self.vits_weights_path,
             "bert_base_path"     : self.bert_base_path,
             "cnhuhbert_base_path": self.cnhuhbert_base_path,
+            "ref_audio_cache_size": self.ref_audio_cache_size,
+            "ref_audio_cache_dir": self.ref_audio_cache_dir,
+            "text_cache_size"    : self.text_cache_size,
+            "text_cache_dir"     : self.text_cache_dir,
+            "ref_audio_cache_disk_budget": self.ref_audio_cache_disk_budget,
+            "text_cache_disk_budget": self.text_cache_disk_budget,
+            "model_pool_size"    : self.model_pool_size,
+            "model_pool_cpu_size": self.model_pool_cpu_size,
+            "model_pool_memory_budget": self.model_pool_memory_budget,
+            "bert_backend"       : self.bert_backend,
+            "bert_onnx_threads"  : self.bert_onnx_threads,
+            "warmup_languages"   : self.warmup_languages,
+            "text_frontend_workers": self.text_frontend_workers,
+            "t2s_attention_backend": self.t2s_attention_backend,
+            "t2s_compile_mode"   : self.t2s_compile_mode,
+            "t2s_compile_max_kv_len": self.t2s_compile_max_kv_len,
+            "t2s_compile_cache_dir": self.t2s_compile_cache_dir,
         }
         return self.config
 
@@ -248,13 +298,49 @@ class TTS:
         self.bert_tokenizer:AutoTokenizer = None
         self.bert_model:AutoModelForMaskedLM = None
         self.cnhuhbert_model:CNHubert = None
+        self.t2s_scheduler:T2SScheduler = None
         
+        # 已加载的GPT/SoVITS模型池, 按权重路径索引, 切换模型时优先复用
+        # model_pool_memory_budget 单位为MB, 0 表示不限制; GPT与SoVITS两个池共用这一预算
+        self.t2s_pool = ModelPool(self._load_t2s_model,
+                                  self.configs.device,
+                                  self.configs.model_pool_size,
+                                  self.configs.model_pool_cpu_size,
+                                  int(self.configs.model_pool_memory_budget * 1024 * 1024))
+        self.vits_pool = ModelPool(self._load_vits_model,
+                                   self.configs.device,
+                                   self.configs.model_pool_size,
+                                   self.configs.model_pool_cpu_size,
+                                   share_budget_with=self.t2s_pool)
+        # 正在使用当前模型的请求数, 切换模型前需等待其归零
+        self.model_cond = threading.Condition()
+        self.model_users:int = 0
+        self.prompt_cache:dict = None
+        
+        # 文本前端进程池须在加载模型与预热之前fork, 子进程不继承CUDA状态、模型和onnxruntime会话
+        self.frontend_pool:FrontendPool = None
+        if self.configs.text_frontend_workers > 0:
+            print(f"Starting {self.configs.text_frontend_workers} text frontend workers")
+            self.frontend_pool = FrontendPool(self.configs.text_frontend_workers, 
+                                              self.configs.version, 
+                                              self.configs.warmup_languages)
+        
+        if self.configs.t2s_compile_mode not in [None, ""]:
+            setup_compile_cache(self.configs.t2s_compile_cache_dir)
         self._init_models()
         
+        if len(self.configs.warmup_languages) > 0:
+            print(f"Warming up text frontends: {self.configs.warmup_languages}")
+            warmup_frontends(self.configs.warmup_languages, self.configs.version)
+        
         self.text_preprocessor:TextPreprocessor = \
                             TextPreprocessor(self.bert_model, 
                                             self.bert_tokenizer, 
-                                            self.configs.device)
+                                            self.configs.device,
+                                            FeatureCache(self.configs.text_cache_size, self.configs.text_cache_dir,
+                                                         int(self.configs.text_cache_disk_budget * 1024 * 1024)),
+                                            self.init_bert_backend(self.configs.bert_backend),
+                                            self.frontend_pool)
         
         
         self.prompt_cache:dict = {
@@ -268,9 +354,16 @@ class TTS:
             "norm_text"      : None,
             "aux_ref_audio_paths": [],
         }
+        self.prompt_lock = threading.Lock()
+        # 参考音频特征缓存, 按文件内容哈希+模型版本索引
+        self.ref_audio_cache = FeatureCache(self.configs.ref_audio_cache_size, self.configs.ref_audio_cache_dir,
+                                            int(self.configs.ref_audio_cache_disk_budget * 1024 * 1024))
+        # (路径, 大小, mtime) -> 文件内容哈希
+        self._ref_audio_hash_cache = FeatureCache(1024)
         
-        
-        self.stop_flag:bool = False
+        # 正在运行的请求的停止事件, stop() 会通知所有请求
+        self.stop_lock = threading.Lock()
+        self.stop_events:set = set()
         self.precision:torch.dtype = torch.float16 if self.configs.is_half else torch.float32
 
     def _init_models(self,):
@@ -301,30 +394,37 @@ class TTS:
         if self.configs.is_half and str(self.configs.device)!="cpu":
             self.bert_model = self.bert_model.half()
         
-    def init_vits_weights(self, weights_path: str):
+    def init_bert_backend(self, backend:str="torch"):
+        '''
+        Build the BERT inference backend used by the TextPreprocessor.
+            "torch": None, the torch bert_model is used directly.
+            "onnx"/"onnx_int8": onnxruntime session, exported from bert_model on first use.
+        '''
+        if backend in [None, "", "torch"]:
+            return None
+        assert backend in ["onnx", "onnx_int8"], f"unsupported bert_backend: {backend}"
+        from TTS_infer_pack.bert_backend import get_onnx_bert_backend
+        return get_onnx_bert_backend(self.bert_model,
+                                     self.bert_tokenizer,
+                                     self.configs.bert_base_path,
+                                     quantize=backend=="onnx_int8",
+                                     num_threads=self.configs.bert_onnx_threads,
+                                     device=str(self.configs.device))
+        
+    def _load_vits_model(self, weights_path: str)->Tuple[SynthesizerTrn, dict]:
         print(f"Loading VITS weights from {weights_path}")
-        self.configs.vits_weights_path = weights_path
         dict_s2 = torch.load(weights_path, map_location=self.configs.device)
         hps = dict_s2["config"]
         if dict_s2['weight']['enc_p.text_embedding.weight'].shape[0] == 322:
-            self.configs.update_version("v1")
+            hps["model"]["version"] = "v1"
         else:
-            self.configs.update_version("v2")
-        self.configs.save_configs()
+            hps["model"]["version"] = "v2"
         
-        hps["model"]["version"] = self.configs.version
-        self.configs.filter_length = hps["data"]["filter_length"]
-        self.configs.segment_size = hps["train"]["segment_size"]
-        self.configs.sampling_rate = hps["data"]["sampling_rate"]       
-        self.configs.hop_length = hps["data"]["hop_length"]
-        self.configs.win_length = hps["data"]["win_length"]
-        self.configs.n_speakers = hps["data"]["n_speakers"]
-        self.configs.semantic_frame_rate = "25hz"
         kwargs = hps["model"]
         vits_model = SynthesizerTrn(
-            self.configs.filter_length // 2 + 1,
-            self.configs.segment_size // self.configs.hop_length,
-            n_speakers=self.configs.n_speakers,
+            hps["data"]["filter_length"] // 2 + 1,
+            hps["train"]["segment_size"] // hps["data"]["hop_length"],
+            n_speakers=hps["data"]["n_speakers"],
             **kwargs
         )
 
@@ -334,26 +434,141 @@ class TTS:
         vits_model = vits_model.to(self.configs.device)
         vits_model = vits_model.eval()
         vits_model.load_state_dict(dict_s2["weight"], strict=False)
-        self.vits_model = vits_model
         if self.configs.is_half and str(self.configs.device)!="cpu":
-            self.vits_model = self.vits_model.half()
+            vits_model = vits_model.half()
+        return vits_model, hps
 
+    def init_vits_weights(self, weights_path: str):
+        vits_model, hps = self.vits_pool.get(weights_path)
+        self.configs.vits_weights_path = weights_path
+        last_version = self.configs.version
+        self.configs.update_version(hps["model"]["version"])
+        self.configs.save_configs()
         
-    def init_t2s_weights(self, weights_path: str):
+        self.configs.filter_length = hps["data"]["filter_length"]
+        self.configs.segment_size = hps["train"]["segment_size"]
+        self.configs.sampling_rate = hps["data"]["sampling_rate"]       
+        self.configs.hop_length = hps["data"]["hop_length"]
+        self.configs.win_length = hps["data"]["win_length"]
+        self.configs.n_speakers = hps["data"]["n_speakers"]
+        self.configs.semantic_frame_rate = "25hz"
+        self.vits_model = vits_model
+
+        # prompt_semantic 与 SoVITS 模型相关, 切换后重新提取(命中参考音频缓存时开销很小)
+        if self.prompt_cache is not None:
+            if last_version != self.configs.version:
+                self.prompt_cache["prompt_text"] = None
+            if self.prompt_cache["ref_audio_path"] is not None:
+                self.set_ref_audio(self.prompt_cache["ref_audio_path"])
+
+    def _load_t2s_model(self, weights_path: str)->Tuple[Text2SemanticLightningModule, dict]:
         print(f"Loading Text2Semantic weights from {weights_path}")
-        self.configs.t2s_weights_path = weights_path
-        self.configs.save_configs()
-        self.configs.hz = 50
         dict_s1 = torch.load(weights_path, map_location=self.configs.device)
         config = dict_s1["config"]
-        self.configs.max_sec = config["data"]["max_sec"]
         t2s_model = Text2SemanticLightningModule(config, "****", is_train=False)
         t2s_model.load_state_dict(dict_s1["weight"])
         t2s_model = t2s_model.to(self.configs.device)
         t2s_model = t2s_model.eval()
-        self.t2s_model = t2s_model
+        t2s_model.model.set_attention_backend(self.configs.t2s_attention_backend)
         if self.configs.is_half and str(self.configs.device)!="cpu":
-            self.t2s_model = self.t2s_model.half()
+            t2s_model = t2s_model.half()
+        self.init_compiled_decode(t2s_model)
+        return t2s_model, config
+
+    def init_compiled_decode(self, t2s_model:Text2SemanticLightningModule):
+        '''
+            Compile and warm up the single sentence decode step if t2s_compile_mode is set,
+                falls back to the eager decode if compiling fails.
+        '''
+        if self.configs.t2s_compile_mode in [None, ""]:
+            return
+        compiled_decoder = t2s_model.model.enable_compiled_decode(self.configs.t2s_compile_mode, 
+                                                                  self.configs.t2s_compile_max_kv_len)
+        try:
+            compiled_decoder.warmup(next(t2s_model.parameters()).dtype, self.configs.device)
+        except:
+            traceback.print_exc()
+            print("T2S decode warmup failed, using eager decode")
+            t2s_model.model.enable_compiled_decode(None)
+        
+    def init_t2s_weights(self, weights_path: str):
+        t2s_model, config = self.t2s_pool.get(weights_path)
+        self.configs.t2s_weights_path = weights_path
+        self.configs.save_configs()
+        self.configs.hz = 50
+        self.configs.max_sec = config["data"]["max_sec"]
+        self.t2s_model = t2s_model
+        if self.t2s_scheduler is not None:
+            self.t2s_scheduler.t2s_model = self.t2s_model.model
+
+    def set_models(self, t2s_weights_path: str = None, vits_weights_path: str = None):
+        '''
+            To switch the GPT/SoVITS weights.
+                Models already in the model pool are reused instead of being loaded again,
+                the switch waits for the running requests of the current models to finish.
+            Args:
+                t2s_weights_path: str, the path of the GPT weights, None to keep the current one.
+                vits_weights_path: str, the path of the SoVITS weights, None to keep the current one.
+        '''
+        self.acquire_models(t2s_weights_path, vits_weights_path)
+        self.release_models()
+
+    def _need_switch(self, t2s_weights_path: str, vits_weights_path: str)->bool:
+        return (t2s_weights_path not in [None, ""] and t2s_weights_path != self.configs.t2s_weights_path) or \
+            (vits_weights_path not in [None, ""] and vits_weights_path != self.configs.vits_weights_path)
+
+    def acquire_models(self, t2s_weights_path: str = None, vits_weights_path: str = None):
+        '''
+            Switch to the given models if needed and mark them as in use.
+                Requests using the same models run concurrently, 
+                a request for other models waits until the current ones are released.
+        '''
+        with self.model_cond:
+            while self._need_switch(t2s_weights_path, vits_weights_path) and self.model_users > 0:
+                self.model_cond.wait()
+            if t2s_weights_path not in [None, ""] and t2s_weights_path != self.configs.t2s_weights_path:
+                self.init_t2s_weights(t2s_weights_path)
+            if vits_weights_path not in [None, ""] and vits_weights_path != self.configs.vits_weights_path:
+                self.init_vits_weights(vits_weights_path)
+            self.model_users += 1
+
+    def release_models(self):
+        with self.model_cond:
+            self.model_users -= 1
+            self.model_cond.notify_all()
+
+    def _reset_models(self):
+        '''
+            Reload the current GPT/SoVITS models after a failed inference.
+                Only done when the failed request is the only user of the models,
+                the other running requests would lose the models in the middle of their inference.
+        '''
+        with self.model_cond:
+            if self.model_users != 1:
+                logger.warning("Skip resetting models, %d requests are using them", self.model_users)
+                return
+            logger.info("Attempting to reset models...")
+            try:
+                self.t2s_model = None
+                self.vits_model = None
+                self.t2s_pool.remove(self.configs.t2s_weights_path)
+                self.vits_pool.remove(self.configs.vits_weights_path)
+                self.empty_cache()
+                self.init_t2s_weights(self.configs.t2s_weights_path)
+                self.init_vits_weights(self.configs.vits_weights_path)
+                logger.info("Models reset successfully")
+            except Exception as reset_error:
+                logger.error("Failed to reset models: %s", reset_error)
+                raise reset_error
+
+    def model_pool_status(self)->dict:
+        return {
+            "gpt": self.t2s_pool.status(),
+            "sovits": self.vits_pool.status(),
+            "gpt_weights_path": self.configs.t2s_weights_path,
+            "sovits_weights_path": self.configs.vits_weights_path,
+            "running": self.model_users,
+        }
         
     def enable_half_precision(self, enable: bool = True, save: bool = True):
         '''
@@ -371,6 +586,8 @@ class TTS:
         if save:
             self.configs.save_configs()
         if enable:
+            self.t2s_pool.apply(lambda model: model.half())
+            self.vits_pool.apply(lambda model: model.half())
             if self.t2s_model is not None:
                 self.t2s_model =self.t2s_model.half()
             if self.vits_model is not None:
@@ -380,6 +597,8 @@ class TTS:
             if self.cnhuhbert_model is not None:
                 self.cnhuhbert_model = self.cnhuhbert_model.half()
         else:
+            self.t2s_pool.apply(lambda model: model.float())
+            self.vits_pool.apply(lambda model: model.float())
             if self.t2s_model is not None:
                 self.t2s_model = self.t2s_model.float()
             if self.vits_model is not None:
@@ -389,6 +608,20 @@ class TTS:
             if self.cnhuhbert_model is not None:
                 self.cnhuhbert_model = self.cnhuhbert_model.float()
                 
+    def enable_continuous_batching(self, enable: bool = True, max_batch_size: int = 20):
+        '''
+            To merge the T2S decoding of concurrent requests into one running batch.
+            Args:
+                enable: bool, whether to enable continuous batching.
+                max_batch_size: int, the maximum number of sequences decoded together.
+        '''
+        if self.t2s_scheduler is not None:
+            self.t2s_scheduler.stop()
+            self.t2s_scheduler = None
+        if enable:
+            self.t2s_scheduler = T2SScheduler(self.t2s_model.model, max_batch_size=max_batch_size)
+            self.t2s_scheduler.start()
+
     def set_device(self, device: torch.device, save: bool = True):
         '''
             To set the device for all models.
@@ -398,6 +631,8 @@ class TTS:
         self.configs.device = device
         if save:
             self.configs.save_configs()
+        self.t2s_pool.set_device(device)
+        self.vits_pool.set_device(device)
         if self.t2s_model is not None:
             self.t2s_model = self.t2s_model.to(device)
         if self.vits_model is not None:
@@ -414,13 +649,35 @@ class TTS:
             Args:
                 ref_audio_path: str, the path of the reference audio.
         '''
-        self._set_prompt_semantic(ref_audio_path)
+        key = self._get_ref_audio_cache_key(ref_audio_path, "prompt_semantic")
+        prompt_semantic = self.ref_audio_cache.get(key)
+        if prompt_semantic is None:
+            self._set_prompt_semantic(ref_audio_path)
+            self.ref_audio_cache.put(key, self.prompt_cache["prompt_semantic"].cpu())
+        else:
+            self.prompt_cache["prompt_semantic"] = prompt_semantic.to(self.configs.device)
         self._set_ref_spec(ref_audio_path)
         self._set_ref_audio_path(ref_audio_path)
         
     def _set_ref_audio_path(self, ref_audio_path):
         self.prompt_cache["ref_audio_path"] = ref_audio_path 
 
+    def _get_ref_audio_cache_key(self, ref_audio_path:str, feature:str)->str:
+        # 文件未改动时复用内容哈希, 避免每次重新读取文件
+        stat = os.stat(ref_audio_path)
+        file_key = (os.path.abspath(ref_audio_path), stat.st_size, stat.st_mtime)
+        content_hash = self._ref_audio_hash_cache.get(file_key)
+        if content_hash is None:
+            content_hash = hash_file(ref_audio_path)
+            self._ref_audio_hash_cache.put(file_key, content_hash)
+        if feature == "refer_spec":
+            model_version = (self.configs.sampling_rate, self.configs.filter_length, self.configs.hop_length, self.configs.win_length)
+        else:
+            vits_weights_path = self.configs.vits_weights_path
+            mtime = os.path.getmtime(vits_weights_path) if os.path.exists(vits_weights_path) else 0
+            model_version = (vits_weights_path, mtime, self.configs.cnhuhbert_base_path)
+        return hash_text(content_hash, feature, *model_version)
+
     def _set_ref_spec(self, ref_audio_path):
         spec = self._get_ref_spec(ref_audio_path)
         if self.prompt_cache["refer_spec"] in [[],None]:
@@ -429,6 +686,17 @@ class TTS:
             self.prompt_cache["refer_spec"][0] = spec
 
     def _get_ref_spec(self, ref_audio_path):
+        key = self._get_ref_audio_cache_key(ref_audio_path, "refer_spec")
+        spec = self.ref_audio_cache.get(key)
+        if spec is None:
+            spec = self._extract_ref_spec(ref_audio_path)
+            self.ref_audio_cache.put(key, spec.float().cpu())
+        spec = spec.to(self.configs.device)
+        if self.configs.is_half:
+            spec = spec.half()
+        return spec
+
+    def _extract_ref_spec(self, ref_audio_path):
         audio = load_audio(ref_audio_path, int(self.configs.sampling_rate))
         audio = torch.FloatTensor(audio)
         maxx=audio.abs().max()
@@ -443,9 +711,6 @@ class TTS:
             self.configs.win_length,
             center=False,
         )
-        spec = spec.to(self.configs.device)
-        if self.configs.is_half:
-            spec = spec.half()
         return spec
 
     def _set_prompt_semantic(self, ref_wav_path:str):
@@ -559,6 +824,7 @@ class TTS:
             all_phones_len_list = []
             all_bert_features_list = []
             norm_text_batch = []
+            text_batch = []
             all_bert_max_len = 0
             all_phones_max_len = 0
             for item in item_list:
@@ -584,6 +850,7 @@ class TTS:
                 all_phones_len_list.append(all_phones.shape[-1])
                 all_bert_features_list.append(all_bert_features)
                 norm_text_batch.append(item["norm_text"])
+                text_batch.append(item.get("text", item["norm_text"]))
                 
             phones_batch = phones_list
             all_phones_batch = all_phones_list
@@ -615,6 +882,7 @@ class TTS:
                 "all_phones_len": torch.LongTensor(all_phones_len_list).to(device),
                 "all_bert_features": all_bert_features_batch,
                 "norm_text": norm_text_batch,
+                "text": text_batch,
                 "max_len": max_len,
             }
             _data.append(batch)
@@ -642,9 +910,55 @@ class TTS:
     def stop(self,):
         '''
         Stop the inference process.
+            Stops the requests running now, requests started later are not affected.
         '''
-        self.stop_flag = True
+        with self.stop_lock:
+            for stop_event in self.stop_events:
+                stop_event.set()
     
+    def _prepare_prompt(self, ref_audio_path:str, aux_ref_audio_paths:list, prompt_text:str, prompt_lang:str, no_prompt_text:bool)->dict:
+        '''
+        Update the prompt cache for this request and return a snapshot of it,
+            so that concurrent requests with different references do not interfere.
+        '''
+        if (ref_audio_path is not None) and (ref_audio_path != self.prompt_cache["ref_audio_path"]):
+            if not os.path.exists(ref_audio_path):
+                raise ValueError(f"{ref_audio_path} not exists")
+            self.set_ref_audio(ref_audio_path)
+            
+        aux_ref_audio_paths = aux_ref_audio_paths if aux_ref_audio_paths is not None else []
+        paths = set(aux_ref_audio_paths)&set(self.prompt_cache["aux_ref_audio_paths"])
+        if not (len(list(paths)) == len(aux_ref_audio_paths) == len(self.prompt_cache["aux_ref_audio_paths"])):
+            self.prompt_cache["aux_ref_audio_paths"] = aux_ref_audio_paths
+            self.prompt_cache["refer_spec"] = [self.prompt_cache["refer_spec"][0]]
+            for path in aux_ref_audio_paths:
+                if path in [None, ""]:
+                    continue
+                if not os.path.exists(path):
+                    print(i18n("音频文件不存在，跳过：{}").format(path))
+                    continue
+                self.prompt_cache["refer_spec"].append(self._get_ref_spec(path))
+                
+        if not no_prompt_text:
+            prompt_text = prompt_text.strip("\n")
+            if (prompt_text[-1] not in splits): prompt_text += "。" if prompt_lang != "en" else "."
+            print(i18n("实际输入的参考文本:"), prompt_text)
+            if self.prompt_cache["prompt_text"] != prompt_text:
+                self.prompt_cache["prompt_text"] = prompt_text
+                self.prompt_cache["prompt_lang"] = prompt_lang
+                phones, bert_features, norm_text = \
+                    self.text_preprocessor.segment_and_extract_feature_for_text(
+                                                                        prompt_text, 
+                                                                        prompt_lang,
+                                                                        self.configs.version)
+                self.prompt_cache["phones"] = phones
+                self.prompt_cache["bert_features"] = bert_features
+                self.prompt_cache["norm_text"] = norm_text
+
+        prompt_cache = dict(self.prompt_cache)
+        prompt_cache["refer_spec"] = list(self.prompt_cache["refer_spec"])
+        return prompt_cache
+
     @torch.no_grad()
     def run(self, inputs:dict):
         """
@@ -667,17 +981,47 @@ class TTS:
                     "batch_threshold": 0.75,      # float. threshold for batch splitting.
                     "split_bucket: True,          # bool. whether to split the batch into multiple buckets.
                     "return_fragment": False,     # bool. step by step return the audio fragment.
+                    "streaming_pipeline": True,   # bool. with return_fragment, run text frontend, T2S and VITS as pipelined stages.
+                    "stream_chunk_size": 0,       # int. with return_fragment, vocode every n semantic tokens instead of every sentence, 0 to disable.
+                    "stream_chunk_overlap": 8,    # int. semantic tokens of left context decoded again with each chunk.
+                    "return_segments": False,     # bool. also return the subtitle segments of the audio.
                     "speed_factor":1.0,           # float. control the speed of the synthesized audio.
                     "fragment_interval":0.3,      # float. to control the interval of the audio fragment.
                     "seed": -1,                   # int. random seed for reproducibility.
                     "parallel_infer": True,       # bool. whether to use parallel inference.
-                    "repetition_penalty": 1.35    # float. repetition penalty for T2S model.
+                    "repetition_penalty": 1.35,   # float. repetition penalty for T2S model.
+                    "gpt_weights_path": None,     # str.(optional) GPT weights to use, switched through the model pool.
+                    "sovits_weights_path": None,  # str.(optional) SoVITS weights to use, switched through the model pool.
+                    "stop_event": None,           # threading.Event.(optional) set it to stop this request, stop() stops all requests.
                 }
         returns:
             Tuple[int, np.ndarray]: sampling rate and audio data.
+            Tuple[int, np.ndarray, List[dict]]: with return_segments, 
+                also the subtitle segments [{"text": str, "start": float, "end": float}, ...] (seconds).
         """
+        return_segments = inputs.get("return_segments", False)
+        stop_event:threading.Event = inputs.get("stop_event", None)
+        if stop_event is None:
+            stop_event = threading.Event()
+        with self.stop_lock:
+            self.stop_events.add(stop_event)
+        self.acquire_models(inputs.get("gpt_weights_path", None), inputs.get("sovits_weights_path", None))
+        try:
+            for result in self._run(inputs, stop_event):
+                if not return_segments:
+                    yield result[:2]
+                elif len(result) == 2:
+                    yield result[0], result[1], []
+                else:
+                    yield result
+        finally:
+            self.release_models()
+            with self.stop_lock:
+                self.stop_events.discard(stop_event)
+
+    @torch.no_grad()
+    def _run(self, inputs:dict, stop_event:threading.Event):
         ########## variables initialization ###########
-        self.stop_flag:bool = False
         text:str = inputs.get("text", "")
         text_lang:str = inputs.get("text_lang", "")
         ref_audio_path:str = inputs.get("ref_audio_path", "")
@@ -693,6 +1037,10 @@ class TTS:
         speed_factor = inputs.get("speed_factor", 1.0)
         split_bucket = inputs.get("split_bucket", True)
         return_fragment = inputs.get("return_fragment", False)
+        streaming_pipeline = inputs.get("streaming_pipeline", True)
+        streaming_pipeline_queue_size = inputs.get("streaming_pipeline_queue_size", 2)
+        stream_chunk_size = inputs.get("stream_chunk_size", 0)
+        stream_chunk_overlap = inputs.get("stream_chunk_overlap", 8)
         fragment_interval = inputs.get("fragment_interval", 0.3)
         seed = inputs.get("seed", -1)
         seed = -1 if seed in ["", None] else seed
@@ -700,12 +1048,13 @@ class TTS:
         parallel_infer = inputs.get("parallel_infer", True)
         repetition_penalty = inputs.get("repetition_penalty", 1.35)
 
+        # 模型为多个请求共享, 解码函数按请求选择, 不修改模型上的 infer_panel
         if parallel_infer:
             print(i18n("并行推理模式已开启"))
-            self.t2s_model.model.infer_panel = self.t2s_model.model.infer_panel_batch_infer
+            infer_panel = self.t2s_model.model.infer_panel_batch_infer
         else:
             print(i18n("并行推理模式已关闭"))
-            self.t2s_model.model.infer_panel = self.t2s_model.model.infer_panel_naive_batched
+            infer_panel = self.t2s_model.model.infer_panel_naive_batched
 
         if return_fragment:
             print(i18n("分段返回模式已开启"))
@@ -739,42 +1088,8 @@ class TTS:
 
         ###### setting reference audio and prompt text preprocessing ########
         t0 = ttime()
-        if (ref_audio_path is not None) and (ref_audio_path != self.prompt_cache["ref_audio_path"]):
-            if not os.path.exists(ref_audio_path):
-                raise ValueError(f"{ref_audio_path} not exists")
-            self.set_ref_audio(ref_audio_path)
-            
-        aux_ref_audio_paths = aux_ref_audio_paths if aux_ref_audio_paths is not None else []
-        paths = set(aux_ref_audio_paths)&set(self.prompt_cache["aux_ref_audio_paths"])
-        if not (len(list(paths)) == len(aux_ref_audio_paths) == len(self.prompt_cache["aux_ref_audio_paths"])):
-            self.prompt_cache["aux_ref_audio_paths"] = aux_ref_audio_paths
-            self.prompt_cache["refer_spec"] = [self.prompt_cache["refer_spec"][0]]
-            for path in aux_ref_audio_paths:
-                if path in [None, ""]:
-                    continue
-                if not os.path.exists(path):
-                    print(i18n("音频文件不存在，跳过：{}").format(path))
-                    continue
-                self.prompt_cache["refer_spec"].append(self._get_ref_spec(path))
-                
-        if not no_prompt_text:
-            prompt_text = prompt_text.strip("\n")
-            if (prompt_text[-1] not in splits): prompt_text += "。" if prompt_lang != "en" else "."
-            print(i18n("实际输入的参考文本:"), prompt_text)
-            if self.prompt_cache["prompt_text"] != prompt_text:
-                self.prompt_cache["prompt_text"] = prompt_text
-                self.prompt_cache["prompt_lang"] = prompt_lang
-                phones, bert_features, norm_text = \
-                    self.text_preprocessor.segment_and_extract_feature_for_text(
-                                                                        prompt_text, 
-                                                                        prompt_lang,
-                                                                        self.configs.version)
-                self.prompt_cache["phones"] = phones
-                self.prompt_cache["bert_features"] = bert_features
-                self.prompt_cache["norm_text"] = norm_text
-
-
-
+        with self.prompt_lock:
+            prompt_cache = self._prepare_prompt(ref_audio_path, aux_ref_audio_paths, prompt_text, prompt_lang, no_prompt_text)
 
         ###### text preprocessing ########
         t1 = ttime()
@@ -788,7 +1103,7 @@ class TTS:
 
             batch_index_list:list = None
             data, batch_index_list = self.to_batch(data, 
-                                prompt_data=self.prompt_cache if not no_prompt_text else None, 
+                                prompt_data=prompt_cache if not no_prompt_text else None, 
                                 batch_size=batch_size, 
                                 threshold=batch_threshold,
                                 split_bucket=split_bucket,
@@ -803,24 +1118,27 @@ class TTS:
                 if i%batch_size == 0:
                     data.append([])
                 data[-1].append(texts[i])
+            # 按顺序逐句产出特征; 有文本前端进程池时, 后续句子的G2P在第一句合成时已并行进行
+            features_iter = self.text_preprocessor.extract_features_iter(texts, text_lang, self.configs.version)
             
             def make_batch(batch_texts):
                 batch_data = []
                 print(i18n("############ 提取文本Bert特征 ############"))
                 for text in tqdm(batch_texts):
-                    phones, bert_features, norm_text = self.text_preprocessor.segment_and_extract_feature_for_text(text, text_lang, self.configs.version)
+                    phones, bert_features, norm_text = next(features_iter)
                     if phones is None:
                         continue
                     res={
                         "phones": phones,
                         "bert_features": bert_features,
                         "norm_text": norm_text,
+                        "text": text,
                     }
                     batch_data.append(res)
                 if len(batch_data) == 0:
                     return None
                 batch, _ = self.to_batch(batch_data, 
-                            prompt_data=self.prompt_cache if not no_prompt_text else None, 
+                            prompt_data=prompt_cache if not no_prompt_text else None, 
                             batch_size=batch_size, 
                             threshold=batch_threshold,
                             split_bucket=False,
@@ -831,11 +1149,64 @@ class TTS:
 
 
         t2 = ttime()
+        t2s_kwargs = dict(
+            top_k=top_k,
+            top_p=top_p,
+            temperature=temperature,
+            early_stop_num=self.configs.hz * self.configs.max_sec,
+            repetition_penalty=repetition_penalty,
+        )
         try:
             print("############ 推理 ############")
             t_34 = 0.0
             t_45 = 0.0
             audio = []
+            texts = []
+            if return_fragment and stream_chunk_size > 0:
+                # 句内流式: T2S每确定 stream_chunk_size 个语义token就交给VITS解码并返回, 不等待整句结束
+                max_amplitude = 0.95
+                for batch_texts in data:
+                    item = make_batch(batch_texts)
+                    if item is None:
+                        continue
+                    for i in range(len(item["all_phones"])):
+                        for audio_chunk in self._infer_audio_stream(item, i, prompt_cache, no_prompt_text, speed_factor,
+                                                                    stream_chunk_size, stream_chunk_overlap, **t2s_kwargs):
+                            audio_chunk = (audio_chunk.float().clamp(-max_amplitude, max_amplitude) * 32768).cpu().numpy().astype(np.int16)
+                            yield self.configs.sampling_rate, audio_chunk
+                            if stop_event.is_set():
+                                yield self.configs.sampling_rate, np.zeros(int(self.configs.sampling_rate), dtype=np.int16)
+                                return
+                        yield self.configs.sampling_rate, np.zeros(int(self.configs.sampling_rate * fragment_interval), dtype=np.int16)
+                print("%.3f\t%.3f\t%.3f" % (t1 - t0, t2 - t1, ttime() - t2))
+                return
+
+            if return_fragment and streaming_pipeline:
+                # 文本前端 / T2S / VITS 各自在独立线程中运行, 以有界队列相连,
+                # 第N段在VITS解码(及在调用方编码发送)时, 第N+1段的T2S已经开始
+                def t2s_stage(item):
+                    pred_semantic_list, idx_list = self._infer_semantic(item, prompt_cache, no_prompt_text, infer_panel, **t2s_kwargs)
+                    return item, pred_semantic_list, idx_list
+
+                def vits_stage(args):
+                    item, pred_semantic_list, idx_list = args
+                    return item["text"], self._decode_audio(item, pred_semantic_list, idx_list, prompt_cache, speed_factor)
+
+                for batch_texts, batch_audio_fragment in pipeline_generator(data, [make_batch, t2s_stage, vits_stage], queue_size=streaming_pipeline_queue_size):
+                    yield self.audio_postprocess([batch_audio_fragment], 
+                                                    self.configs.sampling_rate, 
+                                                    None, 
+                                                    speed_factor, 
+                                                    False,
+                                                    fragment_interval,
+                                                    [batch_texts]
+                                                    )
+                    if stop_event.is_set():
+                        yield self.configs.sampling_rate, np.zeros(int(self.configs.sampling_rate), dtype=np.int16)
+                        return
+                print("%.3f\t%.3f\t%.3f" % (t1 - t0, t2 - t1, ttime() - t2))
+                return
+
             for item in data:
                 t3 = ttime()
                 if return_fragment:
@@ -843,80 +1214,11 @@ class TTS:
                     if item is None:
                         continue
 
-                batch_phones:List[torch.LongTensor] = item["phones"]
-                # batch_phones:torch.LongTensor = item["phones"]
-                batch_phones_len:torch.LongTensor = item["phones_len"]
-                all_phoneme_ids:torch.LongTensor = item["all_phones"]
-                all_phoneme_lens:torch.LongTensor  = item["all_phones_len"]
-                all_bert_features:torch.LongTensor = item["all_bert_features"]
-                norm_text:str = item["norm_text"]
-                max_len = item["max_len"]
-
-                print(i18n("前端处理后的文本(每句):"), norm_text)
-                if no_prompt_text :
-                    prompt = None
-                else:
-                    prompt = self.prompt_cache["prompt_semantic"].expand(len(all_phoneme_ids), -1).to(self.configs.device)
-
-
-                pred_semantic_list, idx_list = self.t2s_model.model.infer_panel(
-                    all_phoneme_ids,
-                    all_phoneme_lens,
-                    prompt,
-                    all_bert_features,
-                    # prompt_phone_len=ph_offset,
-                    top_k=top_k,
-                    top_p=top_p,
-                    temperature=temperature,
-                    early_stop_num=self.configs.hz * self.configs.max_sec,
-                    max_len=max_len,
-                    repetition_penalty=repetition_penalty,
-                )
+                pred_semantic_list, idx_list = self._infer_semantic(item, prompt_cache, no_prompt_text, infer_panel, **t2s_kwargs)
                 t4 = ttime()
                 t_34 += t4 - t3
 
-                refer_audio_spec:torch.Tensor = [item.to(dtype=self.precision, device=self.configs.device) for item in self.prompt_cache["refer_spec"]]
-                                                    
-
-                batch_audio_fragment = []
-            
-                # ## vits并行推理 method 1
-                # pred_semantic_list = [item[-idx:] for item, idx in zip(pred_semantic_list, idx_list)]
-                # pred_semantic_len = torch.LongTensor([item.shape[0] for item in pred_semantic_list]).to(self.configs.device)
-                # pred_semantic = self.batch_sequences(pred_semantic_list, axis=0, pad_value=0).unsqueeze(0)
-                # max_len = 0
-                # for i in range(0, len(batch_phones)):
-                #     max_len = max(max_len, batch_phones[i].shape[-1])
-                # batch_phones = self.batch_sequences(batch_phones, axis=0, pad_value=0, max_length=max_len)
-                # batch_phones = batch_phones.to(self.configs.device)
-                # batch_audio_fragment = (self.vits_model.batched_decode(
-                #         pred_semantic, pred_semantic_len, batch_phones, batch_phones_len,refer_audio_spec
-                #     ))
-
-                if speed_factor == 1.0:
-                    # ## vits并行推理 method 2
-                    pred_semantic_list = [item[-idx:] for item, idx in zip(pred_semantic_list, idx_list)]
-                    upsample_rate = math.prod(self.vits_model.upsample_rates)
-                    audio_frag_idx = [pred_semantic_list[i].shape[0]*2*upsample_rate for i in range(0, len(pred_semantic_list))]
-                    audio_frag_end_idx = [ sum(audio_frag_idx[:i+1]) for i in range(0, len(audio_frag_idx))]
-                    all_pred_semantic = torch.cat(pred_semantic_list).unsqueeze(0).unsqueeze(0).to(self.configs.device)
-                    _batch_phones = torch.cat(batch_phones).unsqueeze(0).to(self.configs.device)
-                    _batch_audio_fragment = (self.vits_model.decode(
-                            all_pred_semantic, _batch_phones, refer_audio_spec, speed=speed_factor
-                        ).detach()[0, 0, :])
-                    audio_frag_end_idx.insert(0, 0)
-                    batch_audio_fragment= [_batch_audio_fragment[audio_frag_end_idx[i-1]:audio_frag_end_idx[i]] for i in range(1, len(audio_frag_end_idx))]
-                else:
-                # ## vits串行推理
-                    for i, idx in enumerate(idx_list):
-                        phones = batch_phones[i].unsqueeze(0).to(self.configs.device)
-                        _pred_semantic = (pred_semantic_list[i][-idx:].unsqueeze(0).unsqueeze(0))   # .unsqueeze(0)#mq要多unsqueeze一次
-                        audio_fragment =(self.vits_model.decode(
-                                _pred_semantic, phones, refer_audio_spec, speed=speed_factor
-                            ).detach()[0, 0, :])
-                        batch_audio_fragment.append(
-                            audio_fragment
-                        )  ###试试重建不带上prompt部分
+                batch_audio_fragment = self._decode_audio(item, pred_semantic_list, idx_list, prompt_cache, speed_factor)
 
                 t5 = ttime()
                 t_45 += t5 - t4
@@ -927,23 +1229,21 @@ class TTS:
                                                     None, 
                                                     speed_factor, 
                                                     False,
-                                                    fragment_interval
+                                                    fragment_interval,
+                                                    [item["text"]]
                                                     )
                 else:
                     audio.append(batch_audio_fragment)
+                    texts.append(item["text"])
 
                 # 清理中间变量
                 del pred_semantic_list
                 del idx_list
-                if speed_factor == 1.0:
-                    del all_pred_semantic
-                    del _batch_phones
-                    del _batch_audio_fragment
                 
                 # 主动进行内存清理
                 self.empty_cache()
 
-                if self.stop_flag:
+                if stop_event.is_set():
                     yield self.configs.sampling_rate, np.zeros(int(self.configs.sampling_rate), dtype=np.int16)
                     return
 
@@ -958,44 +1258,161 @@ class TTS:
                                                 batch_index_list, 
                                                 speed_factor, 
                                                 split_bucket,
-                                                fragment_interval
+                                                fragment_interval,
+                                                texts
                                                 )
 
         except Exception as e:
-            traceback.print_exc()
-            error_msg = f"Error during inference: {str(e)}\n{traceback.format_exc()}"
-            print(error_msg)
-            
-            # 记录错误日志
-            import logging
-            logging.error(error_msg)
+            logger.exception("Error during inference: %s", e)
             
             # 返回空音频
             empty_audio = np.zeros(int(self.configs.sampling_rate), dtype=np.int16)
             yield self.configs.sampling_rate, empty_audio
             
-            try:
-                # 重置模型
-                print("Attempting to reset models...")
-                if hasattr(self, 't2s_model') and self.t2s_model is not None:
-                    del self.t2s_model
-                    self.t2s_model = None
-                if hasattr(self, 'vits_model') and self.vits_model is not None:
-                    del self.vits_model
-                    self.vits_model = None
-                    
-                self.empty_cache()
-                self.init_t2s_weights(self.configs.t2s_weights_path)
-                self.init_vits_weights(self.configs.vits_weights_path)
-                print("Models reset successfully")
-            except Exception as reset_error:
-                print(f"Failed to reset models: {str(reset_error)}")
-                raise reset_error
+            self._reset_models()
             
             raise e
         finally:
             self.empty_cache()
     
+    def _infer_semantic(self, item:dict, prompt_cache:dict, no_prompt_text:bool, infer_panel:Callable, **kwargs)->Tuple[List[torch.LongTensor], List[int]]:
+        '''
+        T2S inference for one batch made by to_batch.
+            infer_panel: the decode function chosen by the request, replaced by the scheduler's when continuous batching is on.
+        '''
+        all_phoneme_ids:torch.LongTensor = item["all_phones"]
+        all_phoneme_lens:torch.LongTensor  = item["all_phones_len"]
+        all_bert_features:torch.LongTensor = item["all_bert_features"]
+        norm_text:str = item["norm_text"]
+        max_len = item["max_len"]
+
+        print(i18n("前端处理后的文本(每句):"), norm_text)
+        if no_prompt_text :
+            prompt = None
+        else:
+            prompt = prompt_cache["prompt_semantic"].expand(len(all_phoneme_ids), -1).to(self.configs.device)
+
+
+        if self.t2s_scheduler is not None:
+            infer_panel = self.t2s_scheduler.infer_panel
+        return infer_panel(
+            all_phoneme_ids,
+            all_phoneme_lens,
+            prompt,
+            all_bert_features,
+            # prompt_phone_len=ph_offset,
+            max_len=max_len,
+            **kwargs
+        )
+
+    def _decode_audio(self, item:dict, pred_semantic_list:List[torch.LongTensor], idx_list:List[int], prompt_cache:dict, speed_factor:float)->List[torch.Tensor]:
+        '''
+        VITS decoding of the semantic tokens of one batch, returns one audio fragment per sentence.
+        '''
+        batch_phones:List[torch.LongTensor] = item["phones"]
+        # batch_phones:torch.LongTensor = item["phones"]
+        batch_phones_len:torch.LongTensor = item["phones_len"]
+
+        refer_audio_spec:torch.Tensor = [item.to(dtype=self.precision, device=self.configs.device) for item in prompt_cache["refer_spec"]]
+                                            
+
+        batch_audio_fragment = []
+    
+        # ## vits并行推理 method 1
+        # pred_semantic_list = [item[-idx:] for item, idx in zip(pred_semantic_list, idx_list)]
+        # pred_semantic_len = torch.LongTensor([item.shape[0] for item in pred_semantic_list]).to(self.configs.device)
+        # pred_semantic = self.batch_sequences(pred_semantic_list, axis=0, pad_value=0).unsqueeze(0)
+        # max_len = 0
+        # for i in range(0, len(batch_phones)):
+        #     max_len = max(max_len, batch_phones[i].shape[-1])
+        # batch_phones = self.batch_sequences(batch_phones, axis=0, pad_value=0, max_length=max_len)
+        # batch_phones = batch_phones.to(self.configs.device)
+        # batch_audio_fragment = (self.vits_model.batched_decode(
+        #         pred_semantic, pred_semantic_len, batch_phones, batch_phones_len,refer_audio_spec
+        #     ))
+
+        if speed_factor == 1.0:
+            # ## vits并行推理 method 2
+            pred_semantic_list = [item[-idx:] for item, idx in zip(pred_semantic_list, idx_list)]
+            upsample_rate = math.prod(self.vits_model.upsample_rates)
+            audio_frag_idx = [pred_semantic_list[i].shape[0]*2*upsample_rate for i in range(0, len(pred_semantic_list))]
+            audio_frag_end_idx = [ sum(audio_frag_idx[:i+1]) for i in range(0, len(audio_frag_idx))]
+            all_pred_semantic = torch.cat(pred_semantic_list).unsqueeze(0).unsqueeze(0).to(self.configs.device)
+            _batch_phones = torch.cat(batch_phones).unsqueeze(0).to(self.configs.device)
+            _batch_audio_fragment = (self.vits_model.decode(
+                    all_pred_semantic, _batch_phones, refer_audio_spec, speed=speed_factor
+                ).detach()[0, 0, :])
+            audio_frag_end_idx.insert(0, 0)
+            batch_audio_fragment= [_batch_audio_fragment[audio_frag_end_idx[i-1]:audio_frag_end_idx[i]] for i in range(1, len(audio_frag_end_idx))]
+        else:
+        # ## vits串行推理
+            for i, idx in enumerate(idx_list):
+                phones = batch_phones[i].unsqueeze(0).to(self.configs.device)
+                _pred_semantic = (pred_semantic_list[i][-idx:].unsqueeze(0).unsqueeze(0))   # .unsqueeze(0)#mq要多unsqueeze一次
+                audio_fragment =(self.vits_model.decode(
+                        _pred_semantic, phones, refer_audio_spec, speed=speed_factor
+                    ).detach()[0, 0, :])
+                batch_audio_fragment.append(
+                    audio_fragment
+                )  ###试试重建不带上prompt部分
+        return batch_audio_fragment
+
+    def _infer_audio_stream(self, item:dict, index:int, prompt_cache:dict, no_prompt_text:bool, speed_factor:float,
+                            chunk_size:int, overlap:int, **kwargs)->Generator[torch.Tensor, None, None]:
+        '''
+        Token level streaming of one sentence of the batch: 
+            the semantic tokens are vocoded every `chunk_size` tokens while T2S decoding is still running.
+        '''
+        x = item["all_phones"][index].unsqueeze(0)
+        x_lens = item["all_phones_len"][index]
+        bert_feature = item["all_bert_features"][index].unsqueeze(0)
+        phones = item["phones"][index].unsqueeze(0).to(self.configs.device)
+        prompt = None if no_prompt_text else prompt_cache["prompt_semantic"].unsqueeze(0).to(self.configs.device)
+        refer_audio_spec:torch.Tensor = [spec.to(dtype=self.precision, device=self.configs.device) for spec in prompt_cache["refer_spec"]]
+
+        print(i18n("前端处理后的文本(每句):"), item["norm_text"][index])
+        token_chunks = self.t2s_model.model.infer_panel_stream(x, x_lens, prompt, bert_feature, chunk_size=chunk_size, **kwargs)
+        yield from self._decode_audio_stream(token_chunks, phones, refer_audio_spec, speed_factor, overlap,
+                                             fade_len=int(self.configs.sampling_rate * 0.02))
+
+    def _decode_audio_stream(self, token_chunks:Iterable[torch.LongTensor], phones:torch.LongTensor, refer_audio_spec:List[torch.Tensor],
+                             speed_factor:float, overlap:int, fade_len:int)->Generator[torch.Tensor, None, None]:
+        '''
+        Incremental VITS decoding. 
+            Each chunk of new semantic tokens is decoded together with `overlap` tokens of left context,
+            only the audio after what was already returned is kept, 
+            and the last `fade_len` samples are held back to be cross-faded with the next chunk.
+        '''
+        semantic = None
+        emitted = 0   # 已返回的采样点数(不含保留的尾部)
+        tail = None
+        samples_per_token = 2 * math.prod(self.vits_model.upsample_rates) / speed_factor
+        token_chunks = iter(token_chunks)
+        chunk = next(token_chunks, None)
+        while chunk is not None:
+            next_chunk = next(token_chunks, None)
+            semantic = chunk if semantic is None else torch.cat([semantic, chunk], dim=1)
+            start = max(0, int(emitted // samples_per_token) - overlap)
+            window = semantic[:, start:].unsqueeze(0).to(self.configs.device)
+            audio = self.vits_model.decode(window, phones, refer_audio_spec, speed=speed_factor).detach()[0, 0, :]
+            samples_per_token = audio.shape[0] / window.shape[-1]
+            audio = audio[max(0, int(round(emitted - start * samples_per_token))):]
+
+            if tail is not None:
+                fade = min(tail.shape[0], audio.shape[0])
+                weight = torch.linspace(0, 1, fade, dtype=audio.dtype, device=audio.device)
+                audio = torch.cat([tail[:fade] * (1 - weight) + audio[:fade] * weight, audio[fade:]], dim=0)
+
+            if next_chunk is None:
+                yield audio
+                break
+            keep = max(0, audio.shape[0] - fade_len)
+            tail = audio[keep:]
+            if keep > 0:
+                yield audio[:keep]
+            emitted += keep
+            chunk = next_chunk
+
     def empty_cache(self):
         try:
             gc.collect() # 触发gc的垃圾回收。避免内存一直增长。
@@ -1012,8 +1429,13 @@ class TTS:
                           batch_index_list:list=None, 
                           speed_factor:float=1.0, 
                           split_bucket:bool=True,
-                          fragment_interval:float=0.3
-                          )->Tuple[int, np.ndarray]:
+                          fragment_interval:float=0.3,
+                          texts:List[List[str]]=None,
+                          )->Tuple[int, np.ndarray, List[dict]]:
+        '''
+        Returns the sampling rate, the int16 audio and the subtitle segments
+            [{"text": str, "start": float, "end": float}, ...] (seconds), one per fragment.
+        '''
         # 添加音频质量控制参数
         max_amplitude = 0.95  # 防止爆音
         noise_gate = 0.001   # 噪声门限
@@ -1023,15 +1445,6 @@ class TTS:
                         dtype=self.precision,
                         device=self.configs.device
                     )
-
-        def ms_to_srt_time(ms):
-            N = int(ms)
-            hours, remainder = divmod(N, 3600000)
-            minutes, remainder = divmod(remainder, 60000)
-            seconds, milliseconds = divmod(remainder, 1000)
-            timesrt = f"{hours:02d}:{minutes:02d}:{seconds:02d},{milliseconds:03d}"
-            # print(timesrt)
-            return timesrt
         
         for i, batch in enumerate(audio):
             for j, audio_fragment in enumerate(batch):
@@ -1049,64 +1462,104 @@ class TTS:
         
         if split_bucket:
             audio = self.recovery_order(audio, batch_index_list)
+            texts = self.recovery_order(texts, batch_index_list) if texts is not None else None
         else:
             # audio = [item for batch in audio for item in batch]
             audio = sum(audio, [])
+            texts = sum(texts, []) if texts is not None else None
 
-        
-        import soundfile as sf
-        print("打印")
-        text = ""
-        with open(r'./音频输出/tts-out.txt', 'r',encoding='utf-8') as f:
-            text = f.read()
-        text_list = eval(text)
-
+        # 字幕时间轴按片段(含片段间隔)累计, 只在内存中生成, 落盘由调用方决定
+        segments = []
         audio_samples = 0
-        srtlines = []
-        audio_opt = []
-        try:
-            num = 0
-            for x in audio:
-                ad = (np.concatenate([x], 0) * 32768).astype(np.int16)
-
-                srtline_begin=ms_to_srt_time(audio_samples*1000.0 / int(sr))
-                audio_samples += ad.size
-                srtline_end=ms_to_srt_time(audio_samples*1000.0 / int(sr))
-
-                audio_opt.append(ad)
-
-                srtlines.append(f"{len(audio_opt):02d}\n")
-                srtlines.append(srtline_begin+' --> '+srtline_end+"\n")
-
-
-                srtlines.append(text_list[num]+"\n\n")
-
-                num += 1
-        except Exception as e:
-            print(e)
-
+        for i, fragment in enumerate(audio):
+            start = audio_samples / sr
+            audio_samples += fragment.shape[0]
+            segments.append({
+                "text": texts[i] if texts is not None else "",
+                "start": start,
+                "end": audio_samples / sr,
+            })
             
         audio = np.concatenate(audio, 0)
         audio = (audio * 32768).astype(np.int16) 
 
-        with open('./音频输出/tts-out.srt', 'w', encoding='utf-8') as f:
-            f.writelines(srtlines)
-            
-
-        
         # try:
         #     if speed_factor != 1.0:
         #         audio = speed_change(audio, speed=speed_factor, sr=int(sr))
         # except Exception as e:
         #     print(f"Failed to change speed of audio: \n{e}")
-
-        sf.write(f'./音频输出/audio.wav',audio,sr)
         
-        return sr, audio
+        return sr, audio, segments
             
         
         
        
+class _PipelineError:
+    def __init__(self, error:BaseException):
+        self.error = error
+
+
+_PIPELINE_END = object()
+
+
+def pipeline_generator(source:Iterable, stages:List[Callable], queue_size:int=2)->Generator:
+    '''
+    Run every stage in its own thread, connected by bounded queues, and yield the outputs of the last stage in order.
+        A stage returning None drops the item, exceptions raised in a stage are re-raised in the consumer.
+        Closing the generator stops the stages.
+    '''
+    stop_event = threading.Event()
+    queues = [queue.Queue()] + [queue.Queue(maxsize=max(1, queue_size)) for _ in stages]
+    for item in source:
+        queues[0].put(item)
+    queues[0].put(_PIPELINE_END)
+
+    def put(q:queue.Queue, item)->bool:
+        while not stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def work(fn:Callable, q_in:queue.Queue, q_out:queue.Queue):
+        # no_grad 只对当前线程生效
+        with torch.no_grad():
+            while not stop_event.is_set():
+                try:
+                    item = q_in.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is _PIPELINE_END or isinstance(item, _PipelineError):
+                    put(q_out, item)
+                    return
+                try:
+                    item = fn(item)
+                except BaseException as e:
+                    traceback.print_exc()
+                    put(q_out, _PipelineError(e))
+                    return
+                if item is not None and not put(q_out, item):
+                    return
+
+    threads = [threading.Thread(target=work, args=(fn, queues[i], queues[i + 1]), daemon=True) for i, fn in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _PIPELINE_END:
+                return
+            if isinstance(item, _PipelineError):
+                raise item.error
+            yield item
+    finally:
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+
+
 def speed_change(input_audio:np.ndarray, speed:float, sr:int):
     # 将 NumPy 数组转换为原始 PCM 流
     raw_audio = input_audio.astype(np.int16).tobytes()
@@ -6,14 +6,16 @@ now_dir = os.getcwd()
 sys.path.append(now_dir)
 
 import re
+import threading
 import torch
+from concurrent.futures.process import BrokenProcessPool
 import LangSegment
-from text import chinese
-from typing import Dict, List, Tuple
-from text.cleaner import clean_text
+from typing import Dict, Generator, Iterator, List, Tuple
+from text.cleaner import clean_text, get_frontend
 from text import cleaned_text_to_sequence
 from transformers import AutoModelForMaskedLM, AutoTokenizer
 from TTS_infer_pack.text_segmentation_method import split_big_text, splits, get_method as get_seg_method
+from TTS_infer_pack.feature_cache import FeatureCache, hash_text
 
 from tools.i18n.i18n import I18nAuto, scan_language_list
 
@@ -50,10 +52,21 @@ def merge_short_text_in_array(texts:str, threshold:int) -> list:
 
 class TextPreprocessor:
     def __init__(self, bert_model:AutoModelForMaskedLM, 
-                 tokenizer:AutoTokenizer, device:torch.device):
+                 tokenizer:AutoTokenizer, device:torch.device,
+                 feature_cache:FeatureCache=None,
+                 bert_backend=None,
+                 frontend_pool=None):
         self.bert_model = bert_model
         self.tokenizer = tokenizer
         self.device = device
+        # 可选的 BERT 推理后端(如 bert_backend.OnnxBertBackend), None 时使用 bert_model
+        self.bert_backend = bert_backend
+        # 可选的文本前端进程池(frontend_pool.FrontendPool), 多句文本的G2P并行执行
+        self.frontend_pool = frontend_pool
+        # (文本, 语种, 版本) -> (phones, bert_features, norm_text)
+        self.feature_cache = feature_cache
+        # LangSegment的过滤器是全局状态, 并发请求需要串行
+        self.lock = threading.Lock()
         
     def preprocess(self, text:str, lang:str, text_split_method:str, version:str="v2")->List[Dict]:
         print(i18n("############ 切分文本 ############"))
@@ -62,20 +75,14 @@ class TextPreprocessor:
         result = []
         print(i18n("############ 提取文本Bert特征 ############"))
         print(texts)
-        try:
-            with open('./音频输出/tts-out.txt', 'w', encoding='utf-8') as f:
-                f.write(str(texts))
-        except Exception as e:
-            print(e)
-            pass
-        for text in tqdm(texts):
-            phones, bert_features, norm_text = self.segment_and_extract_feature_for_text(text, lang, version)
+        for text, (phones, bert_features, norm_text) in zip(texts, self.extract_features_batch(texts, lang, version)):
             if phones is None or norm_text=="":
                 continue
             res={
                 "phones": phones,
                 "bert_features": bert_features,
                 "norm_text": norm_text,
+                "text": text,
             }
             result.append(res)
         return result
@@ -121,9 +128,148 @@ class TextPreprocessor:
         return texts
     
     def segment_and_extract_feature_for_text(self, text:str, language:str, version:str="v1")->Tuple[list, torch.Tensor, str]:
-        return self.get_phones_and_bert(text, language, version)
-        
+        return self.extract_features_batch([text], language, version)[0]
+
+    def extract_features_batch(self, texts:List[str], language:str, version:str="v1")->List[Tuple[list, torch.Tensor, str]]:
+        '''
+        Extract phones, bert features and norm_text for a list of sentences.
+            G2P runs per sentence (in the frontend pool if there is one),
+            the BERT features of all Chinese segments are extracted with batched forward passes.
+        '''
+        results, keys, pending = self.lookup_cache(texts, language, version)
+        if len(pending) == 0:
+            return results
+
+        if self.frontend_pool is not None and len(pending) > 1:
+            segments_list = dict(zip(pending, self.pool_get_phones([texts[i] for i in pending], language, version)))
+        else:
+            segments_list = {}
+            with self.lock:
+                for i in tqdm(pending) if len(pending) > 1 else pending:
+                    segments_list[i] = self.get_phones(texts[i], language, version)
+
+        self.build_features(results, keys, pending, segments_list)
+        return results
+
+    def extract_features_iter(self, texts:List[str], language:str, version:str="v1")->Generator[Tuple[list, torch.Tensor, str], None, None]:
+        '''
+        Same results as extract_features_batch, yielded one sentence at a time in order.
+            With a frontend pool, all sentences are phonemized in parallel ahead of the consumer,
+            so the first sentence can be synthesized while the later ones are still processed.
+        '''
+        if self.frontend_pool is None:
+            for text in texts:
+                yield self.extract_features_batch([text], language, version)[0]
+            return
+
+        results, keys, pending = self.lookup_cache(texts, language, version)
+        segments_iter = self.pool_get_phones([texts[i] for i in pending], language, version)
+        try:
+            for i in range(len(texts)):
+                if results[i] is None:
+                    self.build_features(results, keys, [i], {i: next(segments_iter)})
+                yield results[i]
+                results[i] = None
+        finally:
+            segments_iter.close()
+
+    def pool_get_phones(self, texts:List[str], language:str, version:str)->Iterator[Tuple[list, list, str]]:
+        '''
+        get_phones of every text, in order, run in the frontend pool.
+            A dead worker leaves the pool broken for good: the pool is dropped
+            and the remaining texts are processed in this process.
+        '''
+        pool = self.frontend_pool
+        done = 0
+        if pool is not None:
+            segments_iter = pool.map(texts, language, version)
+            try:
+                for segments in segments_iter:
+                    yield segments
+                    done += 1
+            except BrokenProcessPool:
+                print("Text frontend pool is broken, falling back to in-process G2P")
+                if self.frontend_pool is pool:
+                    self.frontend_pool = None
+                    pool.close()
+            finally:
+                segments_iter.close()
+        for text in texts[done:]:
+            with self.lock:
+                segments = self.get_phones(text, language, version)
+            yield segments
+
+    def lookup_cache(self, texts:List[str], language:str, version:str):
+        '''
+        Returns:
+            results (list): cached (phones, bert_features, norm_text) of each text, None if not cached.
+            keys (list): cache keys of each text.
+            pending (list): indices of the texts not cached.
+        '''
+        results = [None] * len(texts)
+        keys = [None] * len(texts)
+        pending = []
+        for i, text in enumerate(texts):
+            if self.feature_cache is not None:
+                keys[i] = self.get_cache_key(text, language, version)
+                res = self.feature_cache.get(keys[i])
+                if res is not None:
+                    results[i] = (list(res["phones"]), res["bert_features"].to(self.device), res["norm_text"])
+                    continue
+            pending.append(i)
+        return results, keys, pending
+
+    def build_features(self, results:list, keys:list, pending:List[int], segments_list:dict):
+        '''
+        Fill results[i] for i in pending from the get_phones output segments_list[i], extracting the BERT features in batch.
+        '''
+        bert_inputs = [(seg_norm_text, seg_word2ph)
+                       for i in pending
+                       for _, seg_word2ph, seg_norm_text, seg_lang in segments_list[i][0]
+                       if seg_lang == "zh"]
+        bert_outputs = iter(self.get_bert_feature_batch([item[0] for item in bert_inputs], [item[1] for item in bert_inputs]))
+
+        for i in pending:
+            segments, phones, norm_text = segments_list[i]
+            bert_list = []
+            for seg_phones, _, _, seg_lang in segments:
+                if seg_lang == "zh":
+                    bert_list.append(next(bert_outputs).to(self.device))
+                else:
+                    bert_list.append(torch.zeros((1024, len(seg_phones)), dtype=torch.float32).to(self.device))
+            bert = torch.cat(bert_list, dim=1)
+            results[i] = (phones, bert, norm_text)
+            if self.feature_cache is not None:
+                self.feature_cache.put(keys[i], {
+                    "phones": list(phones),
+                    "bert_features": bert.float().cpu(),
+                    "norm_text": norm_text,
+                })
+
+    def get_cache_key(self, text:str, language:str, version:str)->str:
+        backend_name = getattr(self.bert_backend, "name", "") if self.bert_backend is not None else ""
+        return hash_text(text.strip(), language, version, getattr(self.bert_model, "name_or_path", ""), backend_name)
+
+    def cache_stats(self)->dict:
+        if self.feature_cache is None:
+            return {}
+        return self.feature_cache.stats()
+
     def get_phones_and_bert(self, text:str, language:str, version:str, final:bool=False):
+        segments, phones, norm_text = self.get_phones(text, language, version, final)
+        bert_list = [self.get_bert_inf(seg_phones, seg_word2ph, seg_norm_text, seg_lang)
+                     for seg_phones, seg_word2ph, seg_norm_text, seg_lang in segments]
+        bert = torch.cat(bert_list, dim=1)
+        return phones, bert, norm_text
+
+    def get_phones(self, text:str, language:str, version:str, final:bool=False):
+        '''
+        Returns:
+            segments (List[Tuple[list, list, str, str]]): (phones, word2ph, norm_text, language) of each language segment,
+                the bert features of the segment are needed only when its language is "zh".
+            phones (list): phones of the whole text.
+            norm_text (str): normalized text.
+        '''
         if language in {"en", "all_zh", "all_ja", "all_ko", "all_yue"}:
             language = language.replace("all_","")
             if language == "en":
@@ -134,24 +280,17 @@ class TextPreprocessor:
                 formattext = text
             while "  " in formattext:
                 formattext = formattext.replace("  ", " ")
-            if language == "zh":
-                if re.search(r'[A-Za-z]', formattext):
-                    formattext = re.sub(r'[a-z]', lambda x: x.group(0).upper(), formattext)
-                    formattext = chinese.mix_text_normalize(formattext)
-                    return self.get_phones_and_bert(formattext,"zh",version)
-                else:
-                    phones, word2ph, norm_text = self.clean_text_inf(formattext, language, version)
-                    bert = self.get_bert_feature(norm_text, word2ph).to(self.device)
+            if language == "zh" and re.search(r'[A-Za-z]', formattext):
+                formattext = re.sub(r'[a-z]', lambda x: x.group(0).upper(), formattext)
+                formattext = get_frontend("zh", "v1").mix_text_normalize(formattext)
+                return self.get_phones(formattext,"zh",version)
             elif language == "yue" and re.search(r'[A-Za-z]', formattext):
-                    formattext = re.sub(r'[a-z]', lambda x: x.group(0).upper(), formattext)
-                    formattext = chinese.mix_text_normalize(formattext)
-                    return self.get_phones_and_bert(formattext,"yue",version)
+                formattext = re.sub(r'[a-z]', lambda x: x.group(0).upper(), formattext)
+                formattext = get_frontend("zh", "v1").mix_text_normalize(formattext)
+                return self.get_phones(formattext,"yue",version)
             else:
                 phones, word2ph, norm_text = self.clean_text_inf(formattext, language, version)
-                bert = torch.zeros(
-                    (1024, len(phones)),
-                    dtype=torch.float32,
-                ).to(self.device)
+                segments = [(phones, word2ph, norm_text, language)]
         elif language in {"zh", "ja", "ko", "yue", "auto", "auto_yue"}:
             textlist=[]
             langlist=[]
@@ -176,33 +315,36 @@ class TextPreprocessor:
                     textlist.append(tmp["text"])
             # print(textlist)
             # print(langlist)
-            phones_list = []
-            bert_list = []
-            norm_text_list = []
+            segments = []
             for i in range(len(textlist)):
                 lang = langlist[i]
                 phones, word2ph, norm_text = self.clean_text_inf(textlist[i], lang, version)
-                bert = self.get_bert_inf(phones, word2ph, norm_text, lang)
-                phones_list.append(phones)
-                norm_text_list.append(norm_text)
-                bert_list.append(bert)
-            bert = torch.cat(bert_list, dim=1)
-            phones = sum(phones_list, [])
-            norm_text = ''.join(norm_text_list)
+                segments.append((phones, word2ph, norm_text, lang))
+        phones = sum([item[0] for item in segments], [])
+        norm_text = ''.join([item[2] for item in segments])
 
         if not final and len(phones) < 6:
-            return self.get_phones_and_bert("." + text,language,version,final=True)
+            return self.get_phones("." + text,language,version,final=True)
 
-        return phones, bert, norm_text
+        return segments, phones, norm_text
 
 
-    def get_bert_feature(self, text:str, word2ph:list)->torch.Tensor:
+    def get_bert_hidden_state(self, inputs:Dict[str, torch.Tensor])->torch.Tensor:
+        '''
+        BERT hidden state used for the phone level features, [B, T, 1024] on CPU.
+        '''
+        if self.bert_backend is not None:
+            return self.bert_backend(inputs)
         with torch.no_grad():
-            inputs = self.tokenizer(text, return_tensors="pt")
             for i in inputs:
                 inputs[i] = inputs[i].to(self.device)
             res = self.bert_model(**inputs, output_hidden_states=True)
-            res = torch.cat(res["hidden_states"][-3:-2], -1)[0].cpu()[1:-1]
+            return torch.cat(res["hidden_states"][-3:-2], -1).cpu()
+
+    def get_bert_feature(self, text:str, word2ph:list)->torch.Tensor:
+        with torch.no_grad():
+            inputs = self.tokenizer(text, return_tensors="pt")
+            res = self.get_bert_hidden_state(inputs)[0][1:-1]
         assert len(word2ph) == len(text)
         phone_level_feature = []
         for i in range(len(word2ph)):
@@ -210,6 +352,32 @@ class TextPreprocessor:
             phone_level_feature.append(repeat_feature)
         phone_level_feature = torch.cat(phone_level_feature, dim=0)
         return phone_level_feature.T
+
+    def get_bert_feature_batch(self, texts:List[str], word2phs:List[list], batch_size:int=16)->List[torch.Tensor]:
+        '''
+        Batched version of get_bert_feature, texts of similar length are padded and forwarded together.
+            Texts whose tokens do not map one to one to their characters go through get_bert_feature.
+        '''
+        # 注: 不能复用 g2pw 的编码结果代替这里的前向. g2pw 的 ONNX 模型是微调过的 bert-base (768维),
+        # 只共用 chinese-roberta-wwm-ext-large 的词表; 而 T2S 模型训练时使用的是 roberta-large 倒数第三层的 1024 维特征.
+        results = [None] * len(texts)
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        for start in range(0, len(order), batch_size):
+            index = order[start:start + batch_size]
+            with torch.no_grad():
+                inputs = self.tokenizer([texts[i] for i in index], return_tensors="pt", padding=True)
+                token_lens = inputs["attention_mask"].sum(-1).tolist()
+                res = self.get_bert_hidden_state(inputs)
+            for j, i in enumerate(index):
+                word2ph = word2phs[i]
+                feature = res[j, 1:token_lens[j] - 1]
+                if feature.shape[0] != len(word2ph):
+                    # 分词结果与字符不是一一对应(如连续的数字/字母被合并), 按单句的方式处理
+                    results[i] = self.get_bert_feature(texts[i], word2ph)
+                    continue
+                repeats = torch.LongTensor(word2ph)
+                results[i] = torch.repeat_interleave(feature, repeats, dim=0).T
+        return results
     
     def clean_text_inf(self, text:str, language:str, version:str="v2"):
         phones, word2ph, norm_text = clean_text(text, language, version)
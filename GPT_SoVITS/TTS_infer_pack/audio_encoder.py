@@ -0,0 +1,177 @@
+import queue
+import subprocess
+import threading
+import traceback
+from collections import deque
+from typing import Callable, Dict, List
+
+import numpy as np
+
+# AAC(ADTS) 编码参数, 每个编码包写出后立即刷新到管道
+AAC_ARGS = [
+    '-c:a', 'aac',  # 音频编码器为AAC
+    '-b:a', '192k',  # 比特率
+    '-vn',  # 不包含视频
+    '-flush_packets', '1',
+    '-f', 'adts',  # 输出AAC数据流格式
+]
+
+
+class FFmpegEncoder:
+    '''
+    A long-lived ffmpeg process encoding 16 bit mono PCM written incrementally with `write`.
+
+    Encoded bytes are collected by a reader thread as soon as ffmpeg produces them,
+        `read` returns what is available without blocking, `close` flushes the encoder and returns the rest.
+    With `forward(callback)` the reader thread hands every packet to the callback instead,
+        the stream is then ended with `finish`.
+    '''
+    def __init__(self, rate:int, codec_args:List[str]=AAC_ARGS):
+        self.rate = rate
+        self.process = subprocess.Popen([
+            'ffmpeg', '-hide_banner', '-loglevel', 'error',
+            '-f', 's16le',  # 输入16位有符号小端整数PCM
+            '-ar', str(rate),  # 设置采样率
+            '-ac', '1',  # 单声道
+            '-i', 'pipe:0',  # 从管道读取输入
+            *codec_args,
+            'pipe:1'  # 将输出写入管道
+        ], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.chunks:queue.Queue = queue.Queue()
+        self.finished:bool = False
+        self.lock = threading.Lock()
+        self.callback:Callable[[bytes], None] = None
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def _read(self):
+        try:
+            while True:
+                data = self.process.stdout.read1(65536)
+                if not data:
+                    break
+                self._emit(data)
+        except:
+            traceback.print_exc()
+        finally:
+            self._emit(None)
+
+    def _emit(self, data:bytes):
+        with self.lock:
+            if self.callback is not None:
+                self.callback(data)
+            else:
+                self.chunks.put(data)
+
+    def forward(self, callback:Callable[[bytes], None]):
+        '''
+        Deliver the encoded packets to callback(data) from the reader thread as they appear, None marks the end.
+            The callback must not block, e.g. loop.call_soon_threadsafe(queue.put_nowait, data).
+        '''
+        with self.lock:
+            # 先按顺序交出已读取的数据
+            while True:
+                try:
+                    callback(self.chunks.get_nowait())
+                except queue.Empty:
+                    break
+            self.callback = callback
+
+    def alive(self)->bool:
+        return self.process.poll() is None
+
+    def write(self, data:np.ndarray):
+        self.process.stdin.write(data.tobytes())
+        self.process.stdin.flush()
+
+    def read(self)->bytes:
+        out = []
+        while not self.finished:
+            try:
+                data = self.chunks.get_nowait()
+            except queue.Empty:
+                break
+            if data is None:
+                self.finished = True
+            else:
+                out.append(data)
+        return b"".join(out)
+
+    def finish(self):
+        '''
+        End the input, the remaining packets and the end marker go to the `forward` callback.
+        '''
+        self.process.stdin.close()
+
+    def close(self)->bytes:
+        '''
+        Finish the stream and return all remaining encoded bytes.
+        '''
+        self.process.stdin.close()
+        out = []
+        while not self.finished:
+            data = self.chunks.get()
+            if data is None:
+                self.finished = True
+            else:
+                out.append(data)
+        self.process.wait()
+        return b"".join(out)
+
+    def kill(self):
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+
+
+class FFmpegEncoderPool:
+    '''
+    Keeps `size` idle, already started encoders per sample rate, so requests do not wait for ffmpeg to start.
+
+    Every acquired encoder serves one output stream and is not returned, a replacement is started in the background.
+    '''
+    def __init__(self, size:int=2, codec_args:List[str]=AAC_ARGS):
+        self.size = size
+        self.codec_args = codec_args
+        self.lock = threading.Lock()
+        self.idle:Dict[int, deque] = {}
+        # 正在后台启动的编码器数
+        self.starting:Dict[int, int] = {}
+
+    def acquire(self, rate:int)->FFmpegEncoder:
+        encoder = None
+        with self.lock:
+            idle = self.idle.setdefault(rate, deque())
+            while len(idle) > 0 and encoder is None:
+                encoder = idle.popleft()
+                if not encoder.alive():
+                    encoder = None
+        if encoder is None:
+            encoder = FFmpegEncoder(rate, self.codec_args)
+        if self.size > 0:
+            threading.Thread(target=self._replenish, args=(rate,), daemon=True).start()
+        return encoder
+
+    def _replenish(self, rate:int):
+        try:
+            while True:
+                with self.lock:
+                    if len(self.idle[rate]) + self.starting.get(rate, 0) >= self.size:
+                        return
+                    self.starting[rate] = self.starting.get(rate, 0) + 1
+                try:
+                    encoder = FFmpegEncoder(rate, self.codec_args)
+                finally:
+                    with self.lock:
+                        self.starting[rate] -= 1
+                with self.lock:
+                    self.idle[rate].append(encoder)
+        except:
+            traceback.print_exc()
+
+    def close(self):
+        with self.lock:
+            encoders = [encoder for idle in self.idle.values() for encoder in idle]
+            self.idle.clear()
+        for encoder in encoders:
+            encoder.kill()
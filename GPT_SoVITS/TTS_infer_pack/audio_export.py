@@ -0,0 +1,79 @@
+import os
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+import soundfile as sf
+
+
+def ms_to_srt_time(ms:float)->str:
+    N = int(ms)
+    hours, remainder = divmod(N, 3600000)
+    minutes, remainder = divmod(remainder, 60000)
+    seconds, milliseconds = divmod(remainder, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d},{milliseconds:03d}"
+
+
+def segments_to_srt(segments:List[Dict])->str:
+    '''
+    segments: [{"text": str, "start": float, "end": float}, ...], start/end in seconds.
+    '''
+    srtlines = []
+    for i, segment in enumerate(segments):
+        srtlines.append(f"{i+1:02d}\n")
+        srtlines.append(ms_to_srt_time(segment["start"] * 1000.0) + ' --> ' + ms_to_srt_time(segment["end"] * 1000.0) + "\n")
+        srtlines.append(segment["text"] + "\n\n")
+    return "".join(srtlines)
+
+
+class AudioExporter:
+    '''
+    Opt-in sink writing synthesized audio and its subtitles to disk in a background thread.
+
+    Every export gets its own file names, so concurrent requests do not overwrite each other.
+    If `keep_last` > 0, only the files of the latest `keep_last` exports are kept.
+    '''
+    def __init__(self, output_dir:str, keep_last:int=0):
+        self.output_dir = output_dir
+        self.keep_last = keep_last
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="audio_export")
+        self.lock = threading.Lock()
+        self.exported:deque = deque()
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def export(self, name:str, sr:int, audio:np.ndarray, segments:List[Dict]=None)->Future:
+        '''
+        Returns a future of (audio_path, srt_path), srt_path is None without segments.
+        '''
+        return self.executor.submit(self._export, name, sr, audio, segments)
+
+    def _export(self, name:str, sr:int, audio:np.ndarray, segments:List[Dict]=None)->Tuple[str, str]:
+        audio_path = os.path.join(self.output_dir, f"{name}.wav")
+        srt_path = None
+        sf.write(audio_path, audio, sr)
+        if segments is not None:
+            srt_path = os.path.join(self.output_dir, f"{name}.srt")
+            with open(srt_path, 'w', encoding='utf-8') as f:
+                f.write(segments_to_srt(segments))
+        self._cleanup(audio_path, srt_path)
+        return audio_path, srt_path
+
+    def _cleanup(self, *paths:str):
+        if self.keep_last <= 0:
+            return
+        with self.lock:
+            self.exported.append([path for path in paths if path is not None])
+            while len(self.exported) > self.keep_last:
+                for path in self.exported.popleft():
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    except:
+                        traceback.print_exc()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,94 @@
+import os
+from copy import deepcopy
+from typing import Dict
+
+import numpy as np
+import torch
+from torch import nn
+from transformers import AutoModelForMaskedLM, AutoTokenizer
+
+# T2S 模型使用的是 BERT 倒数第三层的特征
+HIDDEN_STATE_LAYER = -3
+
+
+class BertHiddenState(nn.Module):
+    '''
+    Wraps the MLM model so that only the hidden state used for the phone level features is computed and exported.
+    '''
+    def __init__(self, bert_model:AutoModelForMaskedLM, layer:int=HIDDEN_STATE_LAYER):
+        super().__init__()
+        self.bert_model = bert_model.base_model
+        self.layer = layer
+
+    def forward(self, input_ids:torch.LongTensor, attention_mask:torch.LongTensor, token_type_ids:torch.LongTensor):
+        res = self.bert_model(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids, output_hidden_states=True)
+        return res["hidden_states"][self.layer]
+
+
+def export_bert_onnx(bert_model:AutoModelForMaskedLM, tokenizer:AutoTokenizer, onnx_path:str, quantize:bool=False)->str:
+    '''
+    Export the BERT feature extractor to ONNX, optionally dynamic-quantized to INT8 weights.
+    Returns onnx_path.
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(onnx_path)), exist_ok=True)
+    fp32_path = onnx_path if not quantize else onnx_path.replace(".onnx", ".fp32.onnx")
+    # 复制一份导出, 避免改动正在使用的模型的精度和设备
+    model = BertHiddenState(deepcopy(bert_model)).float().cpu().eval()
+    inputs = tokenizer(["你好，这是一个导出用的句子。", "你好。"], return_tensors="pt", padding=True)
+    print(f"Exporting BERT to {fp32_path}")
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (inputs["input_ids"], inputs["attention_mask"], inputs["token_type_ids"]),
+            fp32_path,
+            input_names=["input_ids", "attention_mask", "token_type_ids"],
+            output_names=["hidden_state"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "length"},
+                "attention_mask": {0: "batch", 1: "length"},
+                "token_type_ids": {0: "batch", 1: "length"},
+                "hidden_state": {0: "batch", 1: "length"},
+            },
+            opset_version=14,
+        )
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        print(f"Quantizing BERT to {onnx_path}")
+        quantize_dynamic(fp32_path, onnx_path, weight_type=QuantType.QInt8)
+    return onnx_path
+
+
+class OnnxBertBackend:
+    '''
+    Runs the BERT feature extractor with onnxruntime.
+
+    Call with the tokenizer outputs (torch tensors), returns the hidden state used for the features on CPU, [B, T, 1024].
+    '''
+    def __init__(self, onnx_path:str, num_threads:int=0, device:str="cpu"):
+        import onnxruntime
+        sess_options = onnxruntime.SessionOptions()
+        sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            sess_options.intra_op_num_threads = num_threads
+        providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if "cuda" in str(device) else ['CPUExecutionProvider']
+        self.session = onnxruntime.InferenceSession(onnx_path, sess_options=sess_options, providers=providers)
+        self.name = f"onnx:{os.path.basename(onnx_path)}"
+
+    def __call__(self, inputs:Dict[str, torch.Tensor])->torch.Tensor:
+        feeds = {
+            name: inputs[name].cpu().numpy().astype(np.int64)
+            for name in ["input_ids", "attention_mask", "token_type_ids"]
+        }
+        hidden_state = self.session.run(["hidden_state"], feeds)[0]
+        return torch.from_numpy(hidden_state).float()
+
+
+def get_onnx_bert_backend(bert_model:AutoModelForMaskedLM, tokenizer:AutoTokenizer, bert_base_path:str,
+                          quantize:bool=False, num_threads:int=0, device:str="cpu")->OnnxBertBackend:
+    '''
+    Load the ONNX backend from `bert_base_path`/onnx, exporting it on first use.
+    '''
+    onnx_path = os.path.join(bert_base_path, "onnx", "bert_int8.onnx" if quantize else "bert.onnx")
+    if not os.path.exists(onnx_path):
+        export_bert_onnx(bert_model, tokenizer, onnx_path, quantize)
+    return OnnxBertBackend(onnx_path, num_threads, device)
@@ -0,0 +1,190 @@
+import os
+import hashlib
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+import torch
+
+
+def hash_file(path:str, chunk_size:int=1 << 20)->str:
+    '''
+    sha1 of the file content.
+    '''
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def hash_text(*items)->str:
+    sha1 = hashlib.sha1()
+    for item in items:
+        sha1.update(str(item).encode("utf-8"))
+        sha1.update(b"\0")
+    return sha1.hexdigest()
+
+
+class FeatureCache:
+    '''
+    A thread-safe LRU cache for features, with an optional on-disk tier.
+
+    Values are kept in memory up to `max_items`, least recently used entries are evicted first.
+    If `cache_dir` is set, every value is also written to disk with torch.save,
+        so that evicted entries (and entries of previous runs) can be loaded back without recomputation.
+        The writes run in a background thread, off the request path.
+        If `max_disk_bytes` > 0, the least recently used files (by mtime) are removed beyond that size.
+    '''
+    def __init__(self, max_items:int=256, cache_dir:str=None, max_disk_bytes:int=0):
+        self.max_items = max_items
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.lock = threading.Lock()
+        self.data:OrderedDict = OrderedDict()
+        self.hits:int = 0
+        self.disk_hits:int = 0
+        self.misses:int = 0
+        # 磁盘上的缓存文件: key -> 文件大小, 按最近使用顺序排列
+        self.disk_files:OrderedDict = OrderedDict()
+        self.disk_bytes:int = 0
+        self.writer:ThreadPoolExecutor = None
+        if self.cache_dir not in [None, ""]:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="feature_cache")
+            self._scan_disk()
+
+    def _disk_path(self, key:str)->str:
+        return os.path.join(self.cache_dir, f"{key}.pth")
+
+    def _scan_disk(self):
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".pth"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, name[:-len(".pth")], stat.st_size))
+        for _, key, size in sorted(files):
+            self.disk_files[key] = size
+            self.disk_bytes += size
+        self.writer.submit(self._evict_disk)
+
+    def get(self, key:str)->Optional[Any]:
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+
+        value = None
+        if self.cache_dir not in [None, ""] and os.path.exists(self._disk_path(key)):
+            try:
+                value = torch.load(self._disk_path(key), map_location="cpu")
+                # 更新mtime, 重启后按mtime恢复最近使用顺序
+                os.utime(self._disk_path(key))
+            except FileNotFoundError:
+                # 刚被淘汰
+                value = None
+            except:
+                traceback.print_exc()
+                value = None
+
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            if key in self.disk_files:
+                self.disk_files.move_to_end(key)
+            self._put(key, value)
+        return value
+
+    def put(self, key:str, value:Any, persist:bool=True):
+        with self.lock:
+            self._put(key, value)
+        if persist and self.writer is not None:
+            self.writer.submit(self._write, key, value)
+
+    def _put(self, key:str, value:Any):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_items:
+            self.data.popitem(last=False)
+
+    def _write(self, key:str, value:Any):
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            torch.save(value, tmp_path)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except:
+            traceback.print_exc()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        with self.lock:
+            self.disk_bytes += size - self.disk_files.pop(key, 0)
+            self.disk_files[key] = size
+        self._evict_disk()
+
+    def _evict_disk(self):
+        if self.max_disk_bytes <= 0:
+            return
+        while True:
+            with self.lock:
+                if self.disk_bytes <= self.max_disk_bytes or len(self.disk_files) <= 1:
+                    return
+                key, size = self.disk_files.popitem(last=False)
+                self.disk_bytes -= size
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def flush(self):
+        '''
+        Wait for the pending disk writes.
+        '''
+        if self.writer is not None:
+            self.writer.submit(lambda: None).result()
+
+    def clear(self, disk:bool=False):
+        with self.lock:
+            self.data.clear()
+            self.hits = self.disk_hits = self.misses = 0
+        if disk and self.writer is not None:
+            self.writer.submit(self._clear_disk).result()
+
+    def _clear_disk(self):
+        with self.lock:
+            self.disk_files.clear()
+            self.disk_bytes = 0
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".pth"):
+                os.remove(os.path.join(self.cache_dir, name))
+
+    def stats(self)->Dict[str, Any]:
+        with self.lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {
+                "size": len(self.data),
+                "max_items": self.max_items,
+                "disk_files": len(self.disk_files),
+                "disk_bytes": self.disk_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / total if total > 0 else 0.0,
+            }
+
+    def __len__(self):
+        return len(self.data)
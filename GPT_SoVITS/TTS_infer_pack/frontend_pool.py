@@ -0,0 +1,73 @@
+import os
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterator, List, Tuple
+
+from TTS_infer_pack.TextPreprocessor import TextPreprocessor
+from text.cleaner import warmup as warmup_frontends
+
+# 工作进程内的文本前端, 只做G2P, 不需要BERT模型
+_worker_preprocessor:TextPreprocessor = None
+
+
+def _init_worker(version:str, warmup_languages:List[str]):
+    global _worker_preprocessor
+    os.environ["version"] = version
+    _worker_preprocessor = TextPreprocessor(None, None, "cpu")
+    if warmup_languages:
+        warmup_frontends(warmup_languages, version)
+
+
+def _get_phones(text:str, language:str, version:str):
+    return _worker_preprocessor.get_phones(text, language, version)
+
+
+def _ping():
+    return os.getpid()
+
+
+class FrontendPool:
+    '''
+    A process pool running the CPU-bound part of the text frontend
+        (normalization, segmentation, G2P: TextPreprocessor.get_phones) for many sentences in parallel.
+    BERT features are still extracted in the main process on the main device.
+
+    Results keep the sentence order: `map` yields the result of sentence i as soon as
+        sentences 0..i are done, so consumers can start on the first sentence while the rest are still processed.
+
+    Workers are forked when the pool is created, before the server starts its threads.
+        Platforms without fork are not supported, spawned workers would re-run the launching script.
+    '''
+    def __init__(self, num_workers:int, version:str="v2", warmup_languages:List[str]=None):
+        assert "fork" in multiprocessing.get_all_start_methods(), "FrontendPool needs the fork start method"
+        self.num_workers = num_workers
+        self.version = version
+        self.executor = ProcessPoolExecutor(max_workers=num_workers,
+                                            mp_context=multiprocessing.get_context("fork"),
+                                            initializer=_init_worker,
+                                            initargs=(version, warmup_languages or []))
+        # 立即创建所有工作进程并完成初始化
+        for future in [self.executor.submit(_ping) for _ in range(num_workers)]:
+            future.result()
+
+    def submit(self, text:str, language:str, version:str=None)->Future:
+        '''
+        Returns a future of TextPreprocessor.get_phones(text, language, version).
+        '''
+        return self.executor.submit(_get_phones, text, language, version or self.version)
+
+    def map(self, texts:List[str], language:str, version:str=None)->Iterator[Tuple[list, list, str]]:
+        '''
+        get_phones of every text, in order. All texts are submitted at once,
+            the unfinished ones are cancelled if the iterator is closed early.
+        '''
+        futures = [self.submit(text, language, version) for text in texts]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,151 @@
+import itertools
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Tuple
+
+import torch
+
+
+def get_model_size(model:torch.nn.Module)->int:
+    '''
+    Memory used by the parameters and buffers of the model, in bytes.
+    '''
+    size = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        size += tensor.numel() * tensor.element_size()
+    return size
+
+
+class ModelPool:
+    '''
+    LRU pool of loaded models, keyed by weights path.
+
+    The most recently used `max_resident` models stay on `device`, older ones are offloaded to CPU as warm copies,
+        at most `max_warm` of them are kept, the rest are released.
+    If `memory_budget` (bytes) is set, models are also offloaded until the resident ones fit into the budget.
+    A pool created with `share_budget_with=other` takes the budget of `other` and counts the resident models
+        of both pools against it (e.g. the GPT and SoVITS pools), the least recently used ones are offloaded first.
+
+    `loader(weights_path)` returns a tuple whose first item is the model, the rest is kept as is.
+    '''
+    def __init__(self,
+                 loader:Callable[[str], Tuple],
+                 device:torch.device,
+                 max_resident:int=1,
+                 max_warm:int=2,
+                 memory_budget:int=0,
+                 share_budget_with:"ModelPool"=None,
+                 ):
+        self.loader = loader
+        self.device = device
+        self.max_resident = max(1, max_resident)
+        self.max_warm = max(0, max_warm)
+        if share_budget_with is None:
+            self.memory_budget = memory_budget
+            self.lock = threading.RLock()
+            self.budget_group:list = []
+            self.clock = itertools.count()
+        else:
+            # 共用预算的池共用一把锁, 卸载时可能涉及另一个池的模型
+            self.memory_budget = share_budget_with.memory_budget
+            self.lock = share_budget_with.lock
+            self.budget_group:list = share_budget_with.budget_group
+            self.clock = share_budget_with.clock
+        self.budget_group.append(self)
+        self.entries:OrderedDict = OrderedDict()
+        self.resident:set = set()
+        self.last_used:Dict[str, int] = {}
+
+    def get(self, weights_path:str)->Tuple:
+        with self.lock:
+            if weights_path in self.entries:
+                self.entries.move_to_end(weights_path)
+                entry = self.entries[weights_path]
+                if weights_path not in self.resident:
+                    print(f"Moving {weights_path} from the model pool to {self.device}")
+                    entry[0].to(self.device)
+            else:
+                entry = self.loader(weights_path)
+                self.entries[weights_path] = entry
+            self.resident.add(weights_path)
+            self.last_used[weights_path] = next(self.clock)
+            self._evict()
+            return entry
+
+    def _offload(self, key:str):
+        self.resident.discard(key)
+        if str(self.device) != "cpu":
+            print(f"Offloading {key} to cpu")
+            self.entries[key][0].to("cpu")
+
+    def _evict(self):
+        resident = [key for key in self.entries if key in self.resident]
+        # resident[-1] 为当前使用的模型, 不会被卸载
+        for key in resident[:max(0, len(resident) - self.max_resident)]:
+            self._offload(key)
+        self._evict_budget()
+        for pool in self.budget_group:
+            pool._release_warm()
+
+    def _evict_budget(self):
+        if self.memory_budget <= 0:
+            return
+        resident_size = 0
+        candidates = []
+        for pool in self.budget_group:
+            resident = [key for key in pool.entries if key in pool.resident]
+            resident_size += sum(get_model_size(pool.entries[key][0]) for key in resident)
+            # 各池当前使用的模型不会被卸载
+            candidates += [(pool.last_used.get(key, -1), pool, key) for key in resident[:-1]]
+        for _, pool, key in sorted(candidates, key=lambda candidate: candidate[0]):
+            if resident_size <= self.memory_budget:
+                break
+            resident_size -= get_model_size(pool.entries[key][0])
+            pool._offload(key)
+
+    def _release_warm(self):
+        warm = [key for key in self.entries if key not in self.resident]
+        for key in warm[:max(0, len(warm) - self.max_warm)]:
+            print(f"Releasing {key} from the model pool")
+            del self.entries[key]
+            self.last_used.pop(key, None)
+
+    def set_device(self, device:torch.device):
+        with self.lock:
+            self.device = device
+            for key in self.resident:
+                self.entries[key][0].to(device)
+
+    def apply(self, fn:Callable[[Any], Any]):
+        '''
+        Apply fn (e.g. half()/float()) to every pooled model.
+        '''
+        with self.lock:
+            for key, entry in self.entries.items():
+                self.entries[key] = (fn(entry[0]),) + tuple(entry[1:])
+
+    def remove(self, weights_path:str):
+        with self.lock:
+            self.entries.pop(weights_path, None)
+            self.resident.discard(weights_path)
+            self.last_used.pop(weights_path, None)
+
+    def status(self)->Dict[str, Any]:
+        with self.lock:
+            return {
+                "resident": [key for key in self.entries if key in self.resident],
+                "warm": [key for key in self.entries if key not in self.resident],
+                "resident_size": sum(get_model_size(self.entries[key][0]) for key in self.resident),
+                "max_resident": self.max_resident,
+                "max_warm": self.max_warm,
+                "memory_budget": self.memory_budget,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.resident.clear()
+            self.last_used.clear()
+
+    def __contains__(self, weights_path:str):
+        return weights_path in self.entries
@@ -0,0 +1,103 @@
+"""
+BERT特征提取后端对比: torch / onnx / onnx_int8 的延迟和精度
+
+` python GPT_SoVITS/bert_benchmark.py --bert_path GPT_SoVITS/pretrained_models/chinese-roberta-wwm-ext-large --threads 4 `
+
+精度以torch的输出为基准, 统计有效token上的最大绝对误差和平均余弦相似度
+"""
+import os
+import sys
+import argparse
+from time import perf_counter as ttime
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+sys.path.append("%s/GPT_SoVITS" % (now_dir))
+
+import torch
+from transformers import AutoModelForMaskedLM, AutoTokenizer
+
+from TTS_infer_pack.bert_backend import HIDDEN_STATE_LAYER, get_onnx_bert_backend
+
+default_texts = [
+    "先帝创业未半而中道崩殂，今天下三分，益州疲弊，此诚危急存亡之秋也。",
+    "然侍卫之臣不懈于内，忠志之士忘身于外者，盖追先帝之殊遇，欲报之于陛下也。",
+    "今天天气不错。",
+    "诚宜开张圣听，以光先帝遗德，恢弘志士之气，不宜妄自菲薄，引喻失义，以塞忠谏之路也。",
+]
+
+
+class TorchBertBackend:
+    name = "torch"
+
+    def __init__(self, bert_model:AutoModelForMaskedLM, device:str):
+        self.bert_model = bert_model
+        self.device = device
+
+    @torch.no_grad()
+    def __call__(self, inputs):
+        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        res = self.bert_model(**inputs, output_hidden_states=True)
+        return res["hidden_states"][HIDDEN_STATE_LAYER].float().cpu()
+
+
+def bench_backend(backend, inputs, runs:int, warmup:int):
+    for _ in range(warmup):
+        backend(inputs)
+    costs = []
+    for _ in range(runs):
+        t = ttime()
+        output = backend(inputs)
+        costs.append(ttime() - t)
+    costs.sort()
+    return output, costs[len(costs) // 2], sum(costs) / len(costs)
+
+
+def compare(reference:torch.Tensor, output:torch.Tensor, attention_mask:torch.Tensor):
+    mask = attention_mask.bool()
+    ref, out = reference[mask], output[mask]
+    max_abs = (ref - out).abs().max().item()
+    cos = torch.nn.functional.cosine_similarity(ref, out, dim=-1).mean().item()
+    return max_abs, cos
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GPT-SoVITS BERT backend benchmark")
+    parser.add_argument("--bert_path", type=str, default="GPT_SoVITS/pretrained_models/chinese-roberta-wwm-ext-large")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--threads", type=int, default=0, help="onnxruntime intra-op threads, 0 for default")
+    parser.add_argument("--backends", type=str, default="torch,onnx,onnx_int8")
+    parser.add_argument("--batch", action="store_true", default=False, help="run all texts in one padded batch")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.bert_path)
+    bert_model = AutoModelForMaskedLM.from_pretrained(args.bert_path).eval().to(args.device)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    inputs_list = [tokenizer(default_texts, return_tensors="pt", padding=True)] if args.batch else \
+                  [tokenizer(text, return_tensors="pt") for text in default_texts]
+
+    backends = {"torch": TorchBertBackend(bert_model, args.device)}
+    for name in args.backends.split(","):
+        if name in ["onnx", "onnx_int8"]:
+            backends[name] = get_onnx_bert_backend(bert_model, tokenizer, args.bert_path,
+                                                   quantize=name=="onnx_int8",
+                                                   num_threads=args.threads,
+                                                   device=args.device)
+
+    references = [backends["torch"](inputs) for inputs in inputs_list]
+    print("%-10s %12s %12s %12s %12s" % ("backend", "median(ms)", "mean(ms)", "max_abs", "cosine"))
+    for name in args.backends.split(","):
+        backend = backends[name]
+        median, mean, max_abs, cos = 0, 0, 0, 0
+        for inputs, reference in zip(inputs_list, references):
+            output, _median, _mean = bench_backend(backend, inputs, args.runs, args.warmup)
+            _max_abs, _cos = compare(reference, output, inputs["attention_mask"])
+            median += _median
+            mean += _mean
+            max_abs = max(max_abs, _max_abs)
+            cos += _cos / len(inputs_list)
+        print("%-10s %12.2f %12.2f %12.5f %12.6f" % (name, median * 1000, mean * 1000, max_abs, cos))
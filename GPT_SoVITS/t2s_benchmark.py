@@ -0,0 +1,332 @@
+"""
+T2S解码性能测试, 使用随机初始化的权重, 不需要下载预训练模型
+
+` python GPT_SoVITS/t2s_benchmark.py --device cpu --steps 1500 `
+
+decode: 逐token解码, 按位置窗口统计每个token的平均耗时(静态kv cache下应保持平稳)
+    --padded: 带batch推理的padding mask解码, 耗时同样应不随生成长度增长
+prefill: 带padding的batch prompt处理, 与逐条处理padding的参考实现对比输出, 并统计不同batch_size下的吞吐
+    ` python GPT_SoVITS/t2s_benchmark.py --mode prefill --batch_sizes 1,4,8,16 `
+attention: 各attention后端(jit / sdpa)每个解码步的延迟, 分无mask(单条请求)和有padding mask(batch请求)两种情况
+    ` python GPT_SoVITS/t2s_benchmark.py --mode attention --device cpu --steps 300 `
+compiled: 单句解码(batch_size=1)的tokens/s, eager 与 torch.compile 编译的静态形状解码步对比
+    ` python GPT_SoVITS/t2s_benchmark.py --mode compiled --device cpu --compile_mode default --steps 500 `
+sampling: 每步采样耗时, logits_to_probs(对整个历史gather/scatter) 与 Sampler(token计数直方图) 对比, 并检查两者的概率一致
+    ` python GPT_SoVITS/t2s_benchmark.py --mode sampling --batch_size 8 --top_p 0.9 `
+"""
+import os
+import sys
+import argparse
+from time import perf_counter as ttime
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+sys.path.append("%s/GPT_SoVITS" % (now_dir))
+
+import torch
+from torch.nn import functional as F
+
+from AR.models.t2s_model import Text2SemanticDecoder, scaled_dot_product_attention
+from AR.models.utils import Sampler, logits_to_probs
+
+# 与 s1longer-v2.yaml 一致
+default_config = {
+    "model": {
+        "embedding_dim": 512,
+        "hidden_dim": 512,
+        "head": 16,
+        "n_layer": 24,
+        "vocab_size": 1025,
+        "phoneme_vocab_size": 732,
+        "dropout": 0,
+        "EOS": 1024,
+    }
+}
+
+
+def build_model(device:str, is_half:bool=False, n_layer:int=24)->Text2SemanticDecoder:
+    config = {"model": dict(default_config["model"], n_layer=n_layer)}
+    model = Text2SemanticDecoder(config)
+    model = model.to(device).eval()
+    if is_half:
+        model = model.half()
+    return model
+
+
+def synchronize(device:str):
+    if str(device).startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+@torch.no_grad()
+def bench_decode(model:Text2SemanticDecoder, args):
+    dtype = torch.float16 if args.half else torch.float32
+    transformer = model.t2s_transformer
+    bsz, src_len = args.batch_size, args.prompt_len
+    xy_pos = torch.randn(bsz, src_len, model.model_dim, dtype=dtype, device=args.device)
+    attn_mask = torch.zeros(bsz, model.num_head, src_len, src_len, dtype=torch.bool, device=args.device)
+    max_kv_len = model.get_kv_cache_len(src_len, args.steps)
+
+    _, k_cache, v_cache = transformer.process_prompt(xy_pos, attn_mask, None, max_kv_len)
+    kv_padding_mask = None
+    if args.padded:
+        # 与 infer_panel_batch_infer 相同: 每步取padding位图前kv_len+1列的视图, 不随生成长度复制mask
+        x_lens = torch.randint(src_len // 4, src_len // 2 + 1, (bsz,), device=args.device)
+        _, kv_padding_mask = model.make_batch_padding_mask(x_lens, src_len // 2, x_lens.new_tensor([src_len - src_len // 2] * bsz),
+                                                           src_len - src_len // 2, max_kv_len)
+    x = torch.randn(bsz, 1, model.model_dim, dtype=dtype, device=args.device)
+    kv_len = src_len
+    window_costs = []
+    t = ttime()
+    for step in range(1, args.steps + 1):
+        step_mask = None if kv_padding_mask is None else kv_padding_mask[:, None, None, :kv_len + 1]
+        _, k_cache, v_cache = transformer.decode_next_token(x, k_cache, v_cache, kv_len, step_mask)
+        kv_len += 1
+        if step % args.window == 0:
+            synchronize(args.device)
+            window_costs.append((ttime() - t) / args.window)
+            t = ttime()
+
+    print("decode: batch_size=%d prompt_len=%d padded=%s" % (bsz, src_len, args.padded))
+    for i, cost in enumerate(window_costs):
+        print("  tokens %5d-%5d: %.3f ms/token" % (i * args.window + 1, (i + 1) * args.window, cost * 1000))
+
+
+def process_prompt_loop(block, x:torch.Tensor, attn_mask:torch.Tensor, padding_mask:torch.Tensor):
+    '''
+    Reference: the previous T2SBlock.process_prompt, which ran layer_norm/MLP item by item on the unpadded positions.
+    '''
+    q, k, v = F.linear(block.to_mask(x, padding_mask), block.qkv_w, block.qkv_b).chunk(3, dim=-1)
+    batch_size, q_len, kv_len = q.shape[0], q.shape[1], k.shape[1]
+    q = block.to_mask(q, padding_mask)
+    k_cache = block.to_mask(k, padding_mask)
+    v_cache = block.to_mask(v, padding_mask)
+    q = q.view(batch_size, q_len, block.num_heads, -1).transpose(1, 2)
+    k = k_cache.view(batch_size, kv_len, block.num_heads, -1).transpose(1, 2)
+    v = v_cache.view(batch_size, kv_len, block.num_heads, -1).transpose(1, 2)
+    attn = scaled_dot_product_attention(q, k, v, attn_mask)
+    attn = attn.permute(2, 0, 1, 3).reshape(batch_size * q_len, block.hidden_dim)
+    attn = attn.view(q_len, batch_size, block.hidden_dim).transpose(1, 0)
+    attn = F.linear(block.to_mask(attn, padding_mask), block.out_w, block.out_b)
+    x = x.clone()
+    for i in range(batch_size):
+        idx = torch.where(padding_mask[i, :, 0] == False)[0]
+        x_item = x[i, idx, :].unsqueeze(0) + attn[i, idx, :].unsqueeze(0)
+        x_item = F.layer_norm(x_item, [block.hidden_dim], block.norm_w1, block.norm_b1, block.norm_eps1)
+        x_item = x_item + block.mlp.forward(x_item)
+        x_item = F.layer_norm(x_item, [block.hidden_dim], block.norm_w2, block.norm_b2, block.norm_eps2)
+        x[i, idx, :] = x_item.squeeze(0)
+    return block.to_mask(x, padding_mask), k_cache, v_cache
+
+
+def make_prompt_batch(model:Text2SemanticDecoder, bsz:int, x_len:int, y_len:int, dtype, device):
+    '''
+    Random embeddings and the prompt masks of batch inference, text lengths vary in [x_len/2, x_len].
+    Returns the dense per-head mask infer_panel_batch_infer used to build (for the reference loop)
+        and the broadcast mask it builds now.
+    '''
+    x_lens = torch.randint(x_len // 2, x_len + 1, (bsz,))
+    x_lens[0] = x_len
+    src_len = x_len + y_len
+    x_padding_mask = torch.arange(x_len).unsqueeze(0) >= x_lens.unsqueeze(1)
+    xy_padding_mask = torch.cat([x_padding_mask, torch.zeros(bsz, y_len, dtype=torch.bool)], dim=1)
+    x_mask = F.pad(torch.zeros(x_len, x_len, dtype=torch.bool), (0, y_len), value=True)
+    y_mask = F.pad(torch.triu(torch.ones(y_len, y_len, dtype=torch.bool), diagonal=1), (x_len, 0), value=False)
+    xy_mask = torch.cat([x_mask, y_mask], dim=0).view(1, src_len, src_len).repeat(bsz, 1, 1)
+    _xy_padding_mask = xy_padding_mask.view(bsz, 1, src_len).repeat(1, src_len, 1)
+    for i in range(bsz):
+        _xy_padding_mask[i, x_lens[i]:x_len, :] = True
+    attn_mask = xy_mask.logical_or(_xy_padding_mask).unsqueeze(1).expand(-1, model.num_head, -1, -1).to(device)
+    padding_mask = xy_padding_mask.view(bsz, src_len, 1).expand(-1, -1, model.model_dim).to(device)
+    _, kv_padding_mask = model.make_batch_padding_mask(x_lens.to(device), x_len, torch.LongTensor([y_len] * bsz).to(device), y_len, src_len)
+    compact_attn_mask = model.make_batch_prompt_attn_mask(x_len, y_len, kv_padding_mask)
+    xy_pos = torch.randn(bsz, src_len, model.model_dim, dtype=dtype, device=device)
+    return xy_pos, attn_mask, compact_attn_mask, padding_mask
+
+
+@torch.no_grad()
+def bench_prefill(model:Text2SemanticDecoder, args):
+    dtype = torch.float16 if args.half else torch.float32
+    blocks = model.t2s_transformer.blocks
+    for bsz in [int(item) for item in args.batch_sizes.split(",")]:
+        xy_pos, attn_mask, compact_attn_mask, padding_mask = make_prompt_batch(model, bsz, args.text_len, args.prompt_len, dtype, args.device)
+
+        # 与参考实现(逐条处理, 稠密mask)逐层对比
+        max_diff = 0.0
+        x_ref, x = xy_pos, xy_pos
+        for block in blocks:
+            x_ref, _, _ = process_prompt_loop(block, x_ref, attn_mask, padding_mask)
+            x, _, _ = block.process_prompt(x, compact_attn_mask, padding_mask)
+            max_diff = max(max_diff, (x - x_ref).abs().max().item())
+
+        costs = {}
+        for name, fn, mask in [("loop", process_prompt_loop, attn_mask),
+                               ("batched", lambda block, *inputs: block.process_prompt(*inputs), compact_attn_mask)]:
+            synchronize(args.device)
+            t = ttime()
+            for _ in range(args.runs):
+                x = xy_pos
+                for block in blocks:
+                    x, _, _ = fn(block, x, mask, padding_mask)
+            synchronize(args.device)
+            costs[name] = (ttime() - t) / args.runs
+        print("prefill: batch_size=%3d  loop %8.2f ms  batched %8.2f ms  (%6.1f sentences/s)  max_diff %.2e" % (
+            bsz, costs["loop"] * 1000, costs["batched"] * 1000, bsz / costs["batched"], max_diff))
+
+
+@torch.no_grad()
+def bench_attention(model:Text2SemanticDecoder, args):
+    dtype = torch.float16 if args.half else torch.float32
+    transformer = model.t2s_transformer
+    bsz, src_len = args.batch_size, args.prompt_len
+    xy_pos = torch.randn(bsz, src_len, model.model_dim, dtype=dtype, device=args.device)
+    x = torch.randn(bsz, 1, model.model_dim, dtype=dtype, device=args.device)
+    max_kv_len = model.get_kv_cache_len(src_len, args.steps)
+    # 有mask时每条序列前面有随机长度的padding, 与T2SScheduler合并请求时的mask相同
+    starts = torch.randint(0, src_len // 2, (bsz,), device=args.device)
+    starts[0] = 0
+
+    backends = args.attention_backends.split(",")
+    print("attention: batch_size=%d prompt_len=%d steps=%d" % (bsz, src_len, args.steps))
+    for masked in [False, True]:
+        outputs = {}
+        for backend in backends:
+            model.set_attention_backend(backend)
+            prompt_mask = torch.arange(src_len, device=args.device).unsqueeze(0) < starts.unsqueeze(1)
+            if not masked:
+                prompt_mask = torch.zeros_like(prompt_mask)
+            _, k_cache, v_cache = transformer.process_prompt(xy_pos, prompt_mask.view(bsz, 1, 1, src_len), None, max_kv_len)
+            kv_len = src_len
+            costs = []
+            for step in range(args.steps):
+                attn_mask = None
+                if masked:
+                    attn_mask = torch.arange(kv_len + 1, device=args.device).unsqueeze(0) < starts.unsqueeze(1)
+                    attn_mask = attn_mask.view(bsz, 1, 1, kv_len + 1)
+                synchronize(args.device)
+                t = ttime()
+                y, k_cache, v_cache = transformer.decode_next_token(x, k_cache, v_cache, kv_len, attn_mask)
+                synchronize(args.device)
+                costs.append(ttime() - t)
+                kv_len += 1
+                if step == 0:
+                    outputs[backend] = y
+            costs.sort()
+            max_diff = (outputs[backend] - outputs[backends[0]]).abs().max().item()
+            print("  %-5s mask=%-5s  median %7.3f ms/step  p90 %7.3f ms/step  max_diff(vs %s) %.2e" % (
+                backend, masked, costs[len(costs) // 2] * 1000, costs[int(len(costs) * 0.9)] * 1000, backends[0], max_diff))
+
+
+@torch.no_grad()
+def bench_compiled(model:Text2SemanticDecoder, args):
+    dtype = torch.float16 if args.half else torch.float32
+    transformer = model.t2s_transformer
+    src_len = args.prompt_len
+    steps = min(args.steps, args.capacity - src_len - 1)
+    xy_pos = torch.randn(1, src_len, model.model_dim, dtype=dtype, device=args.device)
+    xs = torch.randn(steps, 1, 1, model.model_dim, dtype=dtype, device=args.device)
+    attn_mask = torch.zeros(1, 1, src_len, src_len, dtype=torch.bool, device=args.device)
+
+    compiled = model.enable_compiled_decode(args.compile_mode, args.capacity)
+    compiled.warmup(dtype, args.device)
+
+    results = {}
+    for name in ["eager", args.compile_mode]:
+        max_kv_len = model.get_kv_cache_len(src_len, steps)
+        _, k_cache, v_cache = transformer.process_prompt(xy_pos, attn_mask, None, max_kv_len)
+        use_compiled = name != "eager"
+        if use_compiled:
+            assert compiled.acquire(xy_pos, src_len)
+            compiled.load_prompt(k_cache, v_cache, src_len)
+        outputs = []
+        kv_len = src_len
+        synchronize(args.device)
+        t = ttime()
+        for step in range(steps):
+            if use_compiled:
+                y = compiled.decode_next_token(xs[step], kv_len)
+            else:
+                y, k_cache, v_cache = transformer.decode_next_token(xs[step], k_cache, v_cache, kv_len)
+            kv_len += 1
+            if step < 10:
+                outputs.append(y)
+        synchronize(args.device)
+        cost = ttime() - t
+        if use_compiled:
+            compiled.release()
+        results[name] = outputs
+        max_diff = max((a - b).abs().max().item() for a, b in zip(outputs, results["eager"]))
+        print("compiled: %-16s %8.1f tokens/s  %7.3f ms/token  max_diff(vs eager) %.2e" % (
+            name, steps / cost, cost / steps * 1000, max_diff))
+    model.enable_compiled_decode(None)
+
+
+@torch.no_grad()
+def bench_sampling(model:Text2SemanticDecoder, args):
+    bsz, vocab_size = args.batch_size, model.vocab_size
+    prompts = torch.randint(0, vocab_size - 1, (bsz, args.prompt_len), device=args.device)
+    params = dict(top_k=args.top_k, top_p=args.top_p, temperature=args.temperature, repetition_penalty=args.repetition_penalty)
+    sampler = Sampler(vocab_size, args.device).add(prompts, **params)
+    y = prompts
+    costs = {"logits_to_probs": [], "Sampler": []}
+    max_diff = 0.0
+    for step in range(args.steps):
+        logits = torch.randn(bsz, vocab_size, device=args.device) * 3
+
+        synchronize(args.device)
+        t = ttime()
+        probs_ref = logits_to_probs(logits.clone(), y, **params)
+        synchronize(args.device)
+        costs["logits_to_probs"].append(ttime() - t)
+
+        t = ttime()
+        samples, probs = sampler.sample(logits.clone())
+        synchronize(args.device)
+        costs["Sampler"].append(ttime() - t)
+
+        max_diff = max(max_diff, (probs - probs_ref).abs().max().item())
+        y = torch.concat([y, samples.to(y.dtype)], dim=1)
+
+    print("sampling: batch_size=%d prompt_len=%d steps=%d %s" % (bsz, args.prompt_len, args.steps, params))
+    window = max(args.steps // 5, 1)
+    for name, items in costs.items():
+        print("  %-16s" % name + "".join("  steps %4d-%4d: %6.3f ms" % (i, min(i + window, args.steps), sum(items[i:i + window]) / len(items[i:i + window]) * 1000)
+                                         for i in range(0, args.steps, window)))
+    print("  max prob diff: %.2e" % max_diff)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GPT-SoVITS T2S benchmark")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--half", action="store_true", default=False)
+    parser.add_argument("--n_layer", type=int, default=24)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--prompt_len", type=int, default=200)
+    parser.add_argument("--steps", type=int, default=1500)
+    parser.add_argument("--window", type=int, default=100)
+    parser.add_argument("--padded", action="store_true", default=False, help="decode with the padding mask of batch inference")
+    parser.add_argument("--mode", type=str, default="decode", choices=["decode", "prefill", "attention", "compiled", "sampling"])
+    parser.add_argument("--batch_sizes", type=str, default="1,4,8,16")
+    parser.add_argument("--text_len", type=int, default=100)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--attention_backends", type=str, default="jit,sdpa")
+    parser.add_argument("--compile_mode", type=str, default="default", help="eager | default | reduce-overhead | max-autotune")
+    parser.add_argument("--capacity", type=int, default=2048, help="kv cache length of the compiled decode step")
+    parser.add_argument("--top_k", type=int, default=15)
+    parser.add_argument("--top_p", type=float, default=1.0)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--repetition_penalty", type=float, default=1.35)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = build_model(args.device, args.half, args.n_layer)
+    if args.mode == "prefill":
+        bench_prefill(model, args)
+    elif args.mode == "attention":
+        bench_attention(model, args)
+    elif args.mode == "compiled":
+        bench_compiled(model, args)
+    elif args.mode == "sampling":
+        bench_sampling(model, args)
+    else:
+        bench_decode(model, args)
@@ -136,10 +136,13 @@ def _merge_erhua(initials: list[str],
 def _g2p(segments):
     phones_list = []
     word2ph = []
-    for seg in segments:
+    # Replace all English words in the sentence
+    segments = [re.sub("[a-zA-Z]+", "", seg) for seg in segments]
+    if is_g2pw:
+        # 所有分句的多音字合并为一次g2pw推理
+        all_pinyins = g2pw.lazy_pinyin_batch(segments, neutral_tone_with_five=True, style=Style.TONE3)
+    for seg_idx, seg in enumerate(segments):
         pinyins = []
-        # Replace all English words in the sentence
-        seg = re.sub("[a-zA-Z]+", "", seg)
         seg_cut = psg.lcut(seg)
         seg_cut = tone_modifier.pre_merge_for_modify(seg_cut)
         initials = []
@@ -161,7 +164,7 @@ def _g2p(segments):
             print("pypinyin结果",initials,finals)
         else:
             # g2pw采用整句推理
-            pinyins = g2pw.lazy_pinyin(seg, neutral_tone_with_five=True, style=Style.TONE3)
+            pinyins = all_pinyins[seg_idx]
 
             pre_word_length = 0
             for word, pos in seg_cut:
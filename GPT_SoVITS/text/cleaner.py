@@ -1,5 +1,8 @@
 from text import cleaned_text_to_sequence
 import os
+import sys
+import importlib
+import traceback
 # if os.environ.get("version","v1")=="v1":
 #     from text import chinese
 #     from text.symbols import symbols
@@ -17,15 +20,68 @@ special = [
     # ('@', 'zh', "SP4")#不搞鬼畜了，和第二版保持一致吧
 ]
 
+# 各语种前端模块, 首次使用该语种时才导入(G2PW/pyopenjtalk/g2p_en 等在导入时加载模型和词典)
+language_module_maps = {
+    "v1": {"zh": "chinese", "ja": "japanese", "en": "english"},
+    "v2": {"zh": "chinese2", "ja": "japanese", "en": "english", "ko": "korean", "yue": "cantonese"},
+}
+# 预热用的样例文本, 触发 jieba/nltk 等首次调用时的延迟加载
+warmup_texts = {
+    "zh": "你好，这是一个预热用的句子。",
+    "ja": "こんにちは、これはウォームアップです。",
+    "en": "Hello, this is a warmup sentence.",
+    "ko": "안녕하세요, 워밍업 문장입니다.",
+    "yue": "你好，呢句係預熱用嘅句子。",
+}
+
+
+def get_language_module_map(version=None):
+    if version is None:version=os.environ.get('version', 'v2')
+    return language_module_maps["v1" if version == "v1" else "v2"]
+
+
+def get_frontend(language, version=None):
+    '''
+    Return the frontend module of `language`, importing it on first use.
+    '''
+    # import 自带模块锁, 并发请求同时首次使用同一语种时只会初始化一次
+    return importlib.import_module("text." + get_language_module_map(version)[language])
+
+
+def loaded_frontends():
+    '''
+    Names of the frontend modules imported so far.
+    '''
+    return sorted({module for modules in language_module_maps.values() for module in modules.values()
+                   if "text." + module in sys.modules})
+
+
+def warmup(langs=None, version=None):
+    '''
+    Load the frontends of `langs` (all languages of `version` if None) ahead of the first request,
+        and run one sample sentence through each so lazily initialized resources are loaded too.
+    '''
+    language_module_map = get_language_module_map(version)
+    if langs is None:
+        langs = list(language_module_map.keys())
+    for language in langs:
+        if language not in language_module_map:
+            print(f"warmup: unsupported language {language}")
+            continue
+        try:
+            get_frontend(language, version)
+            clean_text(warmup_texts[language], language, version)
+        except:
+            traceback.print_exc()
+
 
 def clean_text(text, language, version=None):
     if version is None:version=os.environ.get('version', 'v2')
     if version == "v1":
         symbols = symbols_v1.symbols
-        language_module_map = {"zh": "chinese", "ja": "japanese", "en": "english"}
     else:
         symbols = symbols_v2.symbols
-        language_module_map = {"zh": "chinese2", "ja": "japanese", "en": "english", "ko": "korean","yue":"cantonese"}
+    language_module_map = get_language_module_map(version)
 
     if(language not in language_module_map):
         language="en"
@@ -33,7 +89,7 @@ def clean_text(text, language, version=None):
     for special_s, special_l, target_symbol in special:
         if special_s in text and language == special_l:
             return clean_special(text, language, special_s, target_symbol, version)
-    language_module = __import__("text."+language_module_map[language],fromlist=[language_module_map[language]])
+    language_module = get_frontend(language, version)
     if hasattr(language_module,"text_normalize"):
         norm_text = language_module.text_normalize(text)
     else:
@@ -58,16 +114,14 @@ def clean_special(text, language, special_s, target_symbol, version=None):
     if version is None:version=os.environ.get('version', 'v2')
     if version == "v1":
         symbols = symbols_v1.symbols
-        language_module_map = {"zh": "chinese", "ja": "japanese", "en": "english"}
     else:
         symbols = symbols_v2.symbols
-        language_module_map = {"zh": "chinese2", "ja": "japanese", "en": "english", "ko": "korean","yue":"cantonese"}
 
     """
     特殊静音段sp符号处理
     """
     text = text.replace(special_s, ",")
-    language_module = __import__("text."+language_module_map[language],fromlist=[language_module_map[language]])
+    language_module = get_frontend(language, version)
     norm_text = language_module.text_normalize(text)
     phones = language_module.g2p(norm_text)
     new_ph = []
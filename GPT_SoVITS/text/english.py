@@ -3,8 +3,10 @@ import os
 import re
 import wordsegment
 from g2p_en import G2p
+from g2p_en.g2p import construct_homograph_dictionary
 
 from text.symbols import punctuation
+from text.lexicon import PronunciationCache, load_lexicon
 
 from text.symbols2 import symbols
 
@@ -21,6 +23,11 @@ CMU_DICT_FAST_PATH = os.path.join(current_file_path, "cmudict-fast.rep")
 CMU_DICT_HOT_PATH = os.path.join(current_file_path, "engdict-hot.rep")
 CACHE_PATH = os.path.join(current_file_path, "engdict_cache.pickle")
 NAMECACHE_PATH = os.path.join(current_file_path, "namedict_cache.pickle")
+# mmap 词典, 由 cmudict.rep / cmudict-fast.rep 与姓名字典生成
+LEXICON_PATH = os.path.join(current_file_path, "engdict_cache.lex")
+NAME_LEXICON_PATH = os.path.join(current_file_path, "namedict_cache.lex")
+# 未登录词(OOV)预测结果的持久化缓存, 运行时生成, 不放在源码目录中; 设为空字符串则不持久化
+OOV_CACHE_PATH = os.environ.get("oov_cache_path", "GPT_SoVITS/cache/engdict_oov_cache.rep")
 
 arpa = {
     "AH0",
@@ -195,13 +202,14 @@ def cache_dict(g2p_dict, file_path):
         pickle.dump(g2p_dict, pickle_file)
 
 
+def read_namedict():
+    with open(NAMECACHE_PATH, "rb") as pickle_file:
+        return pickle.load(pickle_file)
+
+
 def get_dict():
-    if os.path.exists(CACHE_PATH):
-        with open(CACHE_PATH, "rb") as pickle_file:
-            g2p_dict = pickle.load(pickle_file)
-    else:
-        g2p_dict = read_dict_new()
-        cache_dict(g2p_dict, CACHE_PATH)
+    # 字典源文件更新时重新生成 mmap 词典, 热词只在内存中覆盖
+    g2p_dict = load_lexicon(LEXICON_PATH, [CMU_DICT_PATH, CMU_DICT_FAST_PATH], read_dict_new)
 
     g2p_dict = hot_reload_hot(g2p_dict)
 
@@ -210,8 +218,7 @@ def get_dict():
 
 def get_namedict():
     if os.path.exists(NAMECACHE_PATH):
-        with open(NAMECACHE_PATH, "rb") as pickle_file:
-            name_dict = pickle.load(pickle_file)
+        name_dict = load_lexicon(NAME_LEXICON_PATH, [NAMECACHE_PATH], read_namedict)
     else:
         name_dict = {}
 
@@ -247,9 +254,31 @@ def text_normalize(text):
     return text
 
 
+# 与 g2p_en.G2p 的神经网络模型一致的字母/音素表
+G2P_GRAPHEMES = ["<pad>", "<unk>", "</s>"] + list("abcdefghijklmnopqrstuvwxyz")
+G2P_PHONEMES = ["<pad>", "<unk>", "<s>", "</s>"] + [
+    'AA0', 'AA1', 'AA2', 'AE0', 'AE1', 'AE2', 'AH0', 'AH1', 'AH2', 'AO0',
+    'AO1', 'AO2', 'AW0', 'AW1', 'AW2', 'AY0', 'AY1', 'AY2', 'B', 'CH', 'D', 'DH',
+    'EH0', 'EH1', 'EH2', 'ER0', 'ER1', 'ER2', 'EY0', 'EY1',
+    'EY2', 'F', 'G', 'HH',
+    'IH0', 'IH1', 'IH2', 'IY0', 'IY1', 'IY2', 'JH', 'K', 'L',
+    'M', 'N', 'NG', 'OW0', 'OW1',
+    'OW2', 'OY0', 'OY1', 'OY2', 'P', 'R', 'S', 'SH', 'T', 'TH',
+    'UH0', 'UH1', 'UH2', 'UW',
+    'UW0', 'UW1', 'UW2', 'V', 'W', 'Y', 'Z', 'ZH']
+
+
 class en_G2p(G2p):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, oov_cache_size:int=10000, oov_cache_path:str=OOV_CACHE_PATH):
+        # 不调用 G2p.__init__: 它会用 nltk 的 cmudict.dict() 解析整个CMU词典, 随后又被 mmap 词典替换
+        self.graphemes = G2P_GRAPHEMES
+        self.phonemes = G2P_PHONEMES
+        self.g2idx = {g: idx for idx, g in enumerate(self.graphemes)}
+        self.idx2g = {idx: g for idx, g in enumerate(self.graphemes)}
+        self.p2idx = {p: idx for idx, p in enumerate(self.phonemes)}
+        self.idx2p = {idx: p for idx, p in enumerate(self.phonemes)}
+        self.load_variables()
+        self.homograph2features = construct_homograph_dictionary()
         # 分词初始化
         wordsegment.load()
 
@@ -257,6 +286,9 @@ class en_G2p(G2p):
         self.cmu = get_dict()
         self.namedict = get_namedict()
 
+        # 分词+神经网络预测较慢, 重复出现的未登录词直接复用结果
+        self.oov_cache = PronunciationCache(oov_cache_size, oov_cache_path)
+
         # 剔除读音错误的几个缩写
         for word in ["AE", "AI", "AR", "IOS", "HUD", "OS"]:
             del self.cmu[word.lower()]
@@ -346,20 +378,31 @@ class en_G2p(G2p):
                 phones.extend(['Z'])
             return phones
 
+        phones = self.oov_cache.get(word)
+        if phones is not None:
+            return phones
+
         # 尝试进行分词，应对复合词
         comps = wordsegment.segment(word.lower())
 
         # 无法分词的送回去预测
         if len(comps)==1:
-            return self.predict(word)
-
+            phones = self.predict(word)
         # 可以分词的递归处理
-        return [phone for comp in comps for phone in self.qryword(comp)]
+        else:
+            phones = [phone for comp in comps for phone in self.qryword(comp)]
+
+        self.oov_cache.put(word, phones)
+        return phones
 
 
 _g2p = en_G2p()
 
 
+def oov_cache_stats():
+    return _g2p.oov_cache.stats()
+
+
 def g2p(text):
     # g2p_en 整段推理，剔除不存在的arpa返回
     phone_list = _g2p(text)
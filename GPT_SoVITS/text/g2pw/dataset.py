@@ -44,17 +44,21 @@ def prepare_onnx_input(tokenizer,
     phoneme_masks = []
     char_ids = []
     position_ids = []
+    # 同一句中的多个多音字共享分词结果
+    tokenized = {}
 
     for idx in range(len(texts)):
         text = (truncated_texts if window_size else texts)[idx].lower()
         query_id = (truncated_query_ids if window_size else query_ids)[idx]
 
-        try:
-            tokens, text2token, token2text = tokenize_and_map(
-                tokenizer=tokenizer, text=text)
-        except Exception:
-            print(f'warning: text "{text}" is invalid')
-            return {}
+        if text not in tokenized:
+            try:
+                tokenized[text] = tokenize_and_map(
+                    tokenizer=tokenizer, text=text)
+            except Exception:
+                print(f'warning: text "{text}" is invalid')
+                return {}
+        tokens, text2token, token2text = tokenized[text]
 
         text, query_id, tokens, text2token, token2text = _truncate(
             max_len=max_len,
@@ -85,6 +89,14 @@ def prepare_onnx_input(tokenizer,
         char_ids.append(char_id)
         position_ids.append(position_id)
 
+    # 不同句子长度不同, 右侧补齐
+    max_length = max([len(input_id) for input_id in input_ids], default=0)
+    for i in range(len(input_ids)):
+        pad = max_length - len(input_ids[i])
+        input_ids[i] = input_ids[i] + [0] * pad
+        token_type_ids[i] = token_type_ids[i] + [0] * pad
+        attention_masks[i] = attention_masks[i] + [0] * pad
+
     outputs = {
         'input_ids': np.array(input_ids).astype(np.int64),
         'token_type_ids': np.array(token_type_ids).astype(np.int64),
@@ -2,6 +2,8 @@
 
 import pickle
 import os
+import threading
+from typing import List
 
 from pypinyin.constants import RE_HANS
 from pypinyin.core import Pinyin, Style
@@ -19,12 +21,13 @@ PP_FIX_DICT_PATH = os.path.join(current_file_path, "polyphonic-fix.rep")
 class G2PWPinyin(Pinyin):
     def __init__(self, model_dir='G2PWModel/', model_source=None,
                  enable_non_tradional_chinese=True,
-                 v_to_u=False, neutral_tone_with_five=False, tone_sandhi=False, **kwargs):
+                 v_to_u=False, neutral_tone_with_five=False, tone_sandhi=False, token_budget=8192, **kwargs):
         self._g2pw = G2PWOnnxConverter(
             model_dir=model_dir,
             style='pinyin',
             model_source=model_source,
             enable_non_tradional_chinese=enable_non_tradional_chinese,
+            token_budget=token_budget,
         )
         self._converter = Converter(
             self._g2pw, v_to_u=v_to_u,
@@ -35,6 +38,21 @@ class G2PWPinyin(Pinyin):
     def get_seg(self, **kwargs):
         return simple_seg
 
+    def lazy_pinyin_batch(self, sentences: List[str], **kwargs) -> List[List[str]]:
+        """
+        Same as calling lazy_pinyin on each sentence, 
+            but the polyphonic characters of all sentences are predicted in one batched g2pw run.
+        """
+        hans = []
+        for sentence in sentences:
+            hans.extend(words for words in self.seg(sentence) if RE_HANS.match(words))
+        hans = list(dict.fromkeys(hans))
+        self._converter.prefetched.data = dict(zip(hans, self._g2pw(hans))) if len(hans) > 0 else {}
+        try:
+            return [self.lazy_pinyin(sentence, **kwargs) for sentence in sentences]
+        finally:
+            self._converter.prefetched.data = None
+
 
 class Converter(UltimateConverter):
     def __init__(self, g2pw_instance, v_to_u=False,
@@ -46,6 +64,8 @@ class Converter(UltimateConverter):
             tone_sandhi=tone_sandhi, **kwargs)
 
         self._g2pw = g2pw_instance
+        # lazy_pinyin_batch 预先算好的 g2pw 结果, 按线程隔离
+        self.prefetched = threading.local()
 
     def convert(self, words, style, heteronym, errors, strict, **kwargs):
         pys = []
@@ -70,7 +90,11 @@ class Converter(UltimateConverter):
     def _to_pinyin(self, han, style, heteronym, errors, strict, **kwargs):
         pinyins = []
 
-        g2pw_pinyin = self._g2pw(han)
+        prefetched = getattr(self.prefetched, "data", None)
+        if prefetched is not None and han in prefetched:
+            g2pw_pinyin = [prefetched[han]]
+        else:
+            g2pw_pinyin = self._g2pw(han)
 
         if not g2pw_pinyin:  # g2pw 不支持的汉字改为使用 pypinyin 原有逻辑
             return super(Converter, self).convert(
@@ -79,8 +79,11 @@ class G2PWOnnxConverter:
                  model_dir: str='G2PWModel/',
                  style: str='bopomofo',
                  model_source: str=None,
-                 enable_non_tradional_chinese: bool=False):
+                 enable_non_tradional_chinese: bool=False,
+                 token_budget: int=8192):
         uncompress_path = download_and_decompress(model_dir)
+        # 单次ONNX推理的 batch大小 x 序列长度 上限
+        self.token_budget = token_budget
 
         sess_options = onnxruntime.SessionOptions()
         sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
@@ -190,20 +193,7 @@ class G2PWOnnxConverter:
             # sentences no polyphonic words
             return partial_results
 
-        onnx_input = prepare_onnx_input(
-            tokenizer=self.tokenizer,
-            labels=self.labels,
-            char2phonemes=self.char2phonemes,
-            chars=self.chars,
-            texts=texts,
-            query_ids=query_ids,
-            use_mask=self.config.use_mask,
-            window_size=None)
-
-        preds, confidences = predict(
-            session=self.session_g2pW,
-            onnx_input=onnx_input,
-            labels=self.labels)
+        preds = self._predict_batched(texts, query_ids)
         if self.config.use_char_phoneme:
             preds = [pred.split(' ')[1] for pred in preds]
 
@@ -213,6 +203,46 @@ class G2PWOnnxConverter:
 
         return results
 
+    def _predict_batched(self, texts: List[str], query_ids: List[int]) -> List[str]:
+        """
+        Predict all queries of all sentences together, 
+            queries are sorted by length and split into batches of at most token_budget padded tokens.
+        """
+        preds = [None] * len(texts)
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+
+        def run(batch: List[int]):
+            onnx_input = prepare_onnx_input(
+                tokenizer=self.tokenizer,
+                labels=self.labels,
+                char2phonemes=self.char2phonemes,
+                chars=self.chars,
+                texts=[texts[i] for i in batch],
+                query_ids=[query_ids[i] for i in batch],
+                use_mask=self.config.use_mask,
+                window_size=None)
+            batch_preds, _ = predict(
+                session=self.session_g2pW,
+                onnx_input=onnx_input,
+                labels=self.labels)
+            for i, pred in zip(batch, batch_preds):
+                preds[i] = pred
+
+        batch = []
+        max_length = 0
+        for i in order:
+            # 中文按字切分, 字数+[CLS][SEP]即为token数
+            length = min(len(texts[i]) + 2, 512)
+            if len(batch) > 0 and max(max_length, length) * (len(batch) + 1) > self.token_budget:
+                run(batch)
+                batch = []
+                max_length = 0
+            batch.append(i)
+            max_length = max(max_length, length)
+        if len(batch) > 0:
+            run(batch)
+        return preds
+
     def _prepare_data(
             self, sentences: List[str]
     ) -> Tuple[List[str], List[int], List[int], List[List[str]]]:
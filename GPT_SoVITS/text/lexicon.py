@@ -0,0 +1,246 @@
+import atexit
+import mmap
+import os
+import struct
+import sys
+import threading
+import traceback
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+# 文件格式(本机字节序):
+#   magic(8s) | 词条数 n(I) | 补齐到4字节
+#   key_offsets: (n+1) x uint32 | value_offsets: (n+1) x uint32
+#   keys: 按utf-8字节序排序的单词 | values: 以空格分隔的音素
+MAGIC = b"GSVLEX1" + (b"L" if sys.byteorder == "little" else b"B")
+HEADER = struct.Struct("=8sI4x")
+
+
+def build_lexicon(g2p_dict:Dict[str, List[List[str]]], path:str)->str:
+    '''
+    Write {word: [phones, ...]} to `path` as a sorted, memory-mappable lexicon.
+    Only the first pronunciation of each word is kept, which is the one en_G2p uses.
+    '''
+    items = sorted((word.encode("utf-8"), " ".join(prons[0]).encode("utf-8"))
+                   for word, prons in g2p_dict.items() if len(prons) > 0)
+    key_offsets, value_offsets = array("I", [0]), array("I", [0])
+    for key, value in items:
+        key_offsets.append(key_offsets[-1] + len(key))
+        value_offsets.append(value_offsets[-1] + len(value))
+    assert key_offsets.itemsize == 4
+
+    # 先写临时文件再替换, 多个进程同时构建时不会读到写了一半的文件
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(items)))
+        key_offsets.tofile(f)
+        value_offsets.tofile(f)
+        f.write(b"".join(key for key, _ in items))
+        f.write(b"".join(value for _, value in items))
+    os.replace(tmp_path, path)
+    return path
+
+
+class MmapLexicon:
+    '''
+    Read-only pronunciation dictionary backed by a memory-mapped file written by `build_lexicon`.
+
+    Lookups binary search the sorted keys in place, nothing is unpickled, so loading takes milliseconds
+    and processes mapping the same file share its pages.
+    Supports the subset of the dict interface used by en_G2p: `in`, `[word]` -> [phones], get, and
+    `[word] = ...` / `del` which only change an in-memory overlay.
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size = HEADER.unpack_from(self.mm, 0)
+        assert magic == MAGIC, f"invalid lexicon file: {path}"
+        offset = HEADER.size
+        view = memoryview(self.mm)
+        self.key_offsets = view[offset:offset + (self.size + 1) * 4].cast("I")
+        offset += (self.size + 1) * 4
+        self.value_offsets = view[offset:offset + (self.size + 1) * 4].cast("I")
+        offset += (self.size + 1) * 4
+        self.keys_start = offset
+        self.values_start = offset + self.key_offsets[self.size]
+        # 覆盖项(热词等), None 表示已删除
+        self.overlay:Dict[str, List[List[str]]] = {}
+
+    def _key(self, index:int)->bytes:
+        return self.mm[self.keys_start + self.key_offsets[index]:self.keys_start + self.key_offsets[index + 1]]
+
+    def _find(self, word:str)->int:
+        key = word.encode("utf-8")
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.size and self._key(lo) == key:
+            return lo
+        return -1
+
+    def _lookup(self, word:str):
+        if word in self.overlay:
+            return self.overlay[word]
+        index = self._find(word)
+        if index < 0:
+            return None
+        value = self.mm[self.values_start + self.value_offsets[index]:self.values_start + self.value_offsets[index + 1]]
+        return [value.decode("utf-8").split(" ")]
+
+    def __contains__(self, word:str)->bool:
+        return self._lookup(word) is not None
+
+    def __getitem__(self, word:str)->List[List[str]]:
+        prons = self._lookup(word)
+        if prons is None:
+            raise KeyError(word)
+        return prons
+
+    def get(self, word:str, default=None):
+        prons = self._lookup(word)
+        return default if prons is None else prons
+
+    def __setitem__(self, word:str, prons:List[List[str]]):
+        self.overlay[word] = prons
+
+    def __delitem__(self, word:str):
+        if word not in self:
+            raise KeyError(word)
+        self.overlay[word] = None
+
+    def __len__(self)->int:
+        return self.size + sum(1 if prons is not None else -1 for word, prons in self.overlay.items()
+                               if (self._find(word) >= 0) != (prons is not None))
+
+
+def load_lexicon(path:str, sources:List[str], build_dict)->MmapLexicon:
+    '''
+    Map the lexicon at `path`, (re)building it with `build_dict()` when it is missing or older than `sources`.
+    '''
+    source_mtime = max([os.path.getmtime(source) for source in sources if os.path.exists(source)], default=0)
+    if not os.path.exists(path) or os.path.getmtime(path) < source_mtime:
+        build_lexicon(build_dict(), path)
+    try:
+        return MmapLexicon(path)
+    except AssertionError:
+        # 其他字节序的机器上生成的文件
+        build_lexicon(build_dict(), path)
+        return MmapLexicon(path)
+
+
+class PronunciationCache:
+    '''
+    Thread-safe LRU cache of predicted pronunciations {word: [phones]}, with hit/miss stats.
+
+    If `path` is set, the cache is warm-started from it and new entries are appended to it
+        in the same "word PH PH ..." format as engdict-hot.rep, so predictions survive restarts.
+    Entries are written in batches of `flush_every` outside the cache lock, the rest at exit (or by `flush()`).
+    The file is compacted to the in-memory entries once it holds more than twice `max_items` lines.
+    '''
+    def __init__(self, max_items:int=10000, path:str=None, flush_every:int=64):
+        self.max_items = max_items
+        self.path = path
+        self.flush_every = max(1, flush_every)
+        self.lock = threading.Lock()
+        # 写文件时持有, 不阻塞查询
+        self.file_lock = threading.Lock()
+        self.data:OrderedDict = OrderedDict()
+        self.pending:List[str] = []
+        self.hits:int = 0
+        self.misses:int = 0
+        self.file_lines:int = 0
+        if self.path not in [None, ""]:
+            if os.path.exists(self.path):
+                self.load()
+            atexit.register(self.flush)
+
+    def load(self):
+        with self.lock:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    word_split = line.strip().split(" ")
+                    if len(word_split) < 2:
+                        continue
+                    self._put(word_split[0], word_split[1:])
+                    self.file_lines += 1
+            entries = list(self.data.items())
+        if self.file_lines > 2 * self.max_items:
+            with self.file_lock:
+                self._compact(entries)
+
+    def get(self, word:str)->Optional[List[str]]:
+        with self.lock:
+            if word in self.data:
+                self.data.move_to_end(word)
+                self.hits += 1
+                return list(self.data[word])
+            self.misses += 1
+            return None
+
+    def put(self, word:str, phones:List[str]):
+        with self.lock:
+            self._put(word, list(phones))
+            if self.path in [None, ""] or " " in word or len(phones) == 0:
+                return
+            self.pending.append(word + " " + " ".join(phones) + "\n")
+            if len(self.pending) < self.flush_every:
+                return
+        self.flush()
+
+    def flush(self):
+        '''
+        Append the pending entries to the file, or rewrite it when it has grown past twice `max_items` lines.
+        '''
+        if self.path in [None, ""]:
+            return
+        with self.file_lock:
+            with self.lock:
+                lines, self.pending = self.pending, []
+                compact = self.file_lines + len(lines) > 2 * self.max_items
+                entries = list(self.data.items()) if compact else None
+            if len(lines) == 0:
+                return
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                if compact:
+                    self._compact(entries)
+                else:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.writelines(lines)
+                    self.file_lines += len(lines)
+            except:
+                traceback.print_exc()
+
+    def _put(self, word:str, phones:List[str]):
+        self.data[word] = phones
+        self.data.move_to_end(word)
+        while len(self.data) > self.max_items:
+            self.data.popitem(last=False)
+
+    def _compact(self, entries:List[tuple]):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for word, phones in entries:
+                f.write(word + " " + " ".join(phones) + "\n")
+        os.replace(tmp_path, self.path)
+        self.file_lines = len(entries)
+
+    def stats(self)->Dict[str, Any]:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.data),
+                "max_items": self.max_items,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total > 0 else 0.0,
+            }
+
+    def __len__(self):
+        return len(self.data)
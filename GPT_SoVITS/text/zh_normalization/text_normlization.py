@@ -55,6 +55,56 @@ from .quantifier import RE_TEMPERATURE
 from .quantifier import replace_measure
 from .quantifier import replace_temperature
 
+# 数字相关规则的前提: 句子中含有数字(与正则中的 \d 一致, 包含所有Unicode数字)
+RE_ANY_DIGIT = re.compile(r'\d')
+# (需要数字, 必需字符, 正则, 替换函数), 顺序即优先级, 与逐条执行的原实现一致(见 zh_normalization_benchmark.py)
+# 必需字符: 规则命中时句子中至少含有其中一个字符, None 表示不限制
+# 正则为 None 时替换函数直接处理整句
+NORMALIZE_RULES = [
+    # number related NSW verbalization
+    (True, frozenset('年'), RE_DATE, replace_date),
+    (True, frozenset('- /.'), RE_DATE2, replace_date2),
+    # range first
+    (True, frozenset(':'), RE_TIME_RANGE, replace_time),
+    (True, frozenset(':'), RE_TIME, replace_time),
+    # 处理~波浪号作为至的替换
+    (True, frozenset('~'), RE_TO_RANGE, replace_to_range),
+    (True, frozenset('°℃度'), RE_TEMPERATURE, replace_temperature),
+    # 单位替换不依赖数字
+    (False, None, None, replace_measure),
+    # 处理数学运算, 字母之间的运算也会替换
+    (False, frozenset('+-×÷='), RE_ASMD, replace_asmd),
+    (False, frozenset('⁰¹²³⁴⁵⁶⁷⁸⁹ˣʸⁿ'), RE_POWER, replace_power),
+    (True, frozenset('/'), RE_FRAC, replace_frac),
+    (True, frozenset('%'), RE_PERCENTAGE, replace_percentage),
+    (True, None, RE_MOBILE_PHONE, replace_mobile),
+    (True, None, RE_TELEPHONE, replace_phone),
+    (True, None, RE_NATIONAL_UNIFORM_NUMBER, replace_phone),
+    (True, frozenset('-~'), RE_RANGE, replace_range),
+    (True, frozenset('-'), RE_INTEGER, replace_negative_num),
+    (True, frozenset('.'), RE_DECIMAL_NUM, replace_number),
+    (True, None, RE_POSITIVE_QUANTIFIERS, replace_positive_quantifier),
+    (True, None, RE_DEFAULT_NUM, replace_default_num),
+    (True, None, RE_NUMBER, replace_number),
+]
+
+POST_REPLACE_TABLE = str.maketrans({
+    '/': '每',
+    '①': '一', '②': '二', '③': '三', '④': '四', '⑤': '五',
+    '⑥': '六', '⑦': '七', '⑧': '八', '⑨': '九', '⑩': '十',
+    'α': '阿尔法', 'β': '贝塔', 'γ': '伽玛', 'Γ': '伽玛',
+    'δ': '德尔塔', 'Δ': '德尔塔', 'ε': '艾普西龙', 'ζ': '捷塔',
+    'η': '依塔', 'θ': '西塔', 'Θ': '西塔', 'ι': '艾欧塔',
+    'κ': '喀帕', 'λ': '拉姆达', 'Λ': '拉姆达', 'μ': '缪',
+    'ν': '拗', 'ξ': '克西', 'Ξ': '克西', 'ο': '欧米克伦',
+    'π': '派', 'Π': '派', 'ρ': '肉', 'ς': '西格玛', 'Σ': '西格玛',
+    'σ': '西格玛', 'τ': '套', 'υ': '宇普西龙', 'φ': '服艾', 'Φ': '服艾',
+    'χ': '器', 'ψ': '普赛', 'Ψ': '普赛', 'ω': '欧米伽', 'Ω': '欧米伽',
+    # 兜底数学运算，顺便兼容懒人用语
+    '+': '加', '-': '减', '×': '乘', '÷': '除', '=': '等',
+})
+RE_POST_FILTER = re.compile(r'[-——《》【】<=>{}()（）#&@“”^_|\\]')
+
 
 class TextNormalizer():
     def __init__(self):
@@ -78,52 +128,10 @@ class TextNormalizer():
         return sentences
 
     def _post_replace(self, sentence: str) -> str:
-        sentence = sentence.replace('/', '每')
-        # sentence = sentence.replace('~', '至')
-        # sentence = sentence.replace('～', '至')
-        sentence = sentence.replace('①', '一')
-        sentence = sentence.replace('②', '二')
-        sentence = sentence.replace('③', '三')
-        sentence = sentence.replace('④', '四')
-        sentence = sentence.replace('⑤', '五')
-        sentence = sentence.replace('⑥', '六')
-        sentence = sentence.replace('⑦', '七')
-        sentence = sentence.replace('⑧', '八')
-        sentence = sentence.replace('⑨', '九')
-        sentence = sentence.replace('⑩', '十')
-        sentence = sentence.replace('α', '阿尔法')
-        sentence = sentence.replace('β', '贝塔')
-        sentence = sentence.replace('γ', '伽玛').replace('Γ', '伽玛')
-        sentence = sentence.replace('δ', '德尔塔').replace('Δ', '德尔塔')
-        sentence = sentence.replace('ε', '艾普西龙')
-        sentence = sentence.replace('ζ', '捷塔')
-        sentence = sentence.replace('η', '依塔')
-        sentence = sentence.replace('θ', '西塔').replace('Θ', '西塔')
-        sentence = sentence.replace('ι', '艾欧塔')
-        sentence = sentence.replace('κ', '喀帕')
-        sentence = sentence.replace('λ', '拉姆达').replace('Λ', '拉姆达')
-        sentence = sentence.replace('μ', '缪')
-        sentence = sentence.replace('ν', '拗')
-        sentence = sentence.replace('ξ', '克西').replace('Ξ', '克西')
-        sentence = sentence.replace('ο', '欧米克伦')
-        sentence = sentence.replace('π', '派').replace('Π', '派')
-        sentence = sentence.replace('ρ', '肉')
-        sentence = sentence.replace('ς', '西格玛').replace('Σ', '西格玛').replace(
-            'σ', '西格玛')
-        sentence = sentence.replace('τ', '套')
-        sentence = sentence.replace('υ', '宇普西龙')
-        sentence = sentence.replace('φ', '服艾').replace('Φ', '服艾')
-        sentence = sentence.replace('χ', '器')
-        sentence = sentence.replace('ψ', '普赛').replace('Ψ', '普赛')
-        sentence = sentence.replace('ω', '欧米伽').replace('Ω', '欧米伽')
-        # 兜底数学运算，顺便兼容懒人用语
-        sentence = sentence.replace('+', '加')
-        sentence = sentence.replace('-', '减')
-        sentence = sentence.replace('×', '乘')
-        sentence = sentence.replace('÷', '除')
-        sentence = sentence.replace('=', '等')
+        # 单字符替换合并为一次 translate, 与逐个 replace 等价(替换结果中不含被替换的字符)
+        sentence = sentence.translate(POST_REPLACE_TABLE)
         # re filter special characters, have one more character "-" than line 68
-        sentence = re.sub(r'[-——《》【】<=>{}()（）#&@“”^_|\\]', '', sentence)
+        sentence = RE_POST_FILTER.sub('', sentence)
         return sentence
 
     def normalize_sentence(self, sentence: str) -> str:
@@ -132,39 +140,30 @@ class TextNormalizer():
         sentence = sentence.translate(F2H_ASCII_LETTERS).translate(
             F2H_DIGITS).translate(F2H_SPACE)
 
-        # number related NSW verbalization
-        sentence = RE_DATE.sub(replace_date, sentence)
-        sentence = RE_DATE2.sub(replace_date2, sentence)
-
-        # range first
-        sentence = RE_TIME_RANGE.sub(replace_time, sentence)
-        sentence = RE_TIME.sub(replace_time, sentence)
-
-        # 处理~波浪号作为至的替换
-        sentence = RE_TO_RANGE.sub(replace_to_range, sentence)
-        sentence = RE_TEMPERATURE.sub(replace_temperature, sentence)
-        sentence = replace_measure(sentence)
-
-        # 处理数学运算
-        while RE_ASMD.search(sentence):
-            sentence = RE_ASMD.sub(replace_asmd, sentence)
-        sentence = RE_POWER.sub(replace_power, sentence)
-
-        sentence = RE_FRAC.sub(replace_frac, sentence)
-        sentence = RE_PERCENTAGE.sub(replace_percentage, sentence)
-        sentence = RE_MOBILE_PHONE.sub(replace_mobile, sentence)
-
-        sentence = RE_TELEPHONE.sub(replace_phone, sentence)
-        sentence = RE_NATIONAL_UNIFORM_NUMBER.sub(replace_phone, sentence)
-
-        sentence = RE_RANGE.sub(replace_range, sentence)
+        # 按原顺序执行各替换规则, 但跳过当前句子中不可能命中的规则:
+        # 句子的字符集合只在被改写后重新计算, 缺少数字或必需字符的规则不再扫描整句
+        has_digit = RE_ANY_DIGIT.search(sentence) is not None
+        chars = set(sentence)
+        for need_digit, need_chars, pattern, repl in NORMALIZE_RULES:
+            if need_digit and not has_digit:
+                continue
+            if need_chars is not None and need_chars.isdisjoint(chars):
+                continue
+
+            if pattern is None:
+                new_sentence = repl(sentence)
+            elif pattern is RE_ASMD:
+                new_sentence = sentence
+                while RE_ASMD.search(new_sentence):
+                    new_sentence = RE_ASMD.sub(replace_asmd, new_sentence)
+            else:
+                new_sentence = pattern.sub(repl, sentence)
+
+            if new_sentence is not sentence:
+                sentence = new_sentence
+                has_digit = RE_ANY_DIGIT.search(sentence) is not None
+                chars = set(sentence)
 
-        sentence = RE_INTEGER.sub(replace_negative_num, sentence)
-        sentence = RE_DECIMAL_NUM.sub(replace_number, sentence)
-        sentence = RE_POSITIVE_QUANTIFIERS.sub(replace_positive_quantifier,
-                                               sentence)
-        sentence = RE_DEFAULT_NUM.sub(replace_default_num, sentence)
-        sentence = RE_NUMBER.sub(replace_number, sentence)
         sentence = self._post_replace(sentence)
 
         return sentence
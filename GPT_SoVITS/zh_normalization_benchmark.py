@@ -0,0 +1,194 @@
+"""
+中文文本归一化(zh_normalization.TextNormalizer)的正确性检查与性能测试
+
+` python GPT_SoVITS/zh_normalization_benchmark.py --sentences 2000 `
+
+random: 随机拼接的数字密集文本, normalize_sentence 的输出必须与逐条规则执行的原实现 normalize_sentence_sequential 一致
+bench: 数字密集文本与纯中文文本上两种实现的耗时
+固定样例的输出检查见 tests/test_zh_normalization.py
+"""
+import os
+import re
+import sys
+import random
+import argparse
+from time import perf_counter as ttime
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+sys.path.append("%s/GPT_SoVITS" % (now_dir))
+
+from text.zh_normalization.text_normlization import TextNormalizer
+from text.zh_normalization.char_convert import tranditional_to_simplified
+from text.zh_normalization.chronology import RE_DATE, RE_DATE2, RE_TIME, RE_TIME_RANGE
+from text.zh_normalization.chronology import replace_date, replace_date2, replace_time
+from text.zh_normalization.constants import F2H_ASCII_LETTERS, F2H_DIGITS, F2H_SPACE
+from text.zh_normalization.num import RE_DECIMAL_NUM, RE_DEFAULT_NUM, RE_FRAC, RE_INTEGER, RE_NUMBER, RE_PERCENTAGE
+from text.zh_normalization.num import RE_POSITIVE_QUANTIFIERS, RE_RANGE, RE_TO_RANGE, RE_ASMD, RE_POWER
+from text.zh_normalization.num import replace_default_num, replace_frac, replace_negative_num, replace_number
+from text.zh_normalization.num import replace_percentage, replace_positive_quantifier, replace_range
+from text.zh_normalization.num import replace_to_range, replace_asmd, replace_power
+from text.zh_normalization.phonecode import RE_MOBILE_PHONE, RE_NATIONAL_UNIFORM_NUMBER, RE_TELEPHONE
+from text.zh_normalization.phonecode import replace_mobile, replace_phone
+from text.zh_normalization.quantifier import RE_TEMPERATURE, replace_measure, replace_temperature
+
+
+def normalize_sentence_sequential(sentence: str) -> str:
+    """The original rule-by-rule implementation of TextNormalizer.normalize_sentence, the reference for the rule skipping."""
+    # basic character conversions
+    sentence = tranditional_to_simplified(sentence)
+    sentence = sentence.translate(F2H_ASCII_LETTERS).translate(
+        F2H_DIGITS).translate(F2H_SPACE)
+
+    # number related NSW verbalization
+    sentence = RE_DATE.sub(replace_date, sentence)
+    sentence = RE_DATE2.sub(replace_date2, sentence)
+
+    # range first
+    sentence = RE_TIME_RANGE.sub(replace_time, sentence)
+    sentence = RE_TIME.sub(replace_time, sentence)
+
+    # 处理~波浪号作为至的替换
+    sentence = RE_TO_RANGE.sub(replace_to_range, sentence)
+    sentence = RE_TEMPERATURE.sub(replace_temperature, sentence)
+    sentence = replace_measure(sentence)
+
+    # 处理数学运算
+    while RE_ASMD.search(sentence):
+        sentence = RE_ASMD.sub(replace_asmd, sentence)
+    sentence = RE_POWER.sub(replace_power, sentence)
+
+    sentence = RE_FRAC.sub(replace_frac, sentence)
+    sentence = RE_PERCENTAGE.sub(replace_percentage, sentence)
+    sentence = RE_MOBILE_PHONE.sub(replace_mobile, sentence)
+
+    sentence = RE_TELEPHONE.sub(replace_phone, sentence)
+    sentence = RE_NATIONAL_UNIFORM_NUMBER.sub(replace_phone, sentence)
+
+    sentence = RE_RANGE.sub(replace_range, sentence)
+
+    sentence = RE_INTEGER.sub(replace_negative_num, sentence)
+    sentence = RE_DECIMAL_NUM.sub(replace_number, sentence)
+    sentence = RE_POSITIVE_QUANTIFIERS.sub(replace_positive_quantifier,
+                                           sentence)
+    sentence = RE_DEFAULT_NUM.sub(replace_default_num, sentence)
+    sentence = RE_NUMBER.sub(replace_number, sentence)
+    sentence = _post_replace_sequential(sentence)
+
+    return sentence
+
+def _post_replace_sequential(sentence: str) -> str:
+    sentence = sentence.replace('/', '每')
+    # sentence = sentence.replace('~', '至')
+    # sentence = sentence.replace('～', '至')
+    sentence = sentence.replace('①', '一')
+    sentence = sentence.replace('②', '二')
+    sentence = sentence.replace('③', '三')
+    sentence = sentence.replace('④', '四')
+    sentence = sentence.replace('⑤', '五')
+    sentence = sentence.replace('⑥', '六')
+    sentence = sentence.replace('⑦', '七')
+    sentence = sentence.replace('⑧', '八')
+    sentence = sentence.replace('⑨', '九')
+    sentence = sentence.replace('⑩', '十')
+    sentence = sentence.replace('α', '阿尔法')
+    sentence = sentence.replace('β', '贝塔')
+    sentence = sentence.replace('γ', '伽玛').replace('Γ', '伽玛')
+    sentence = sentence.replace('δ', '德尔塔').replace('Δ', '德尔塔')
+    sentence = sentence.replace('ε', '艾普西龙')
+    sentence = sentence.replace('ζ', '捷塔')
+    sentence = sentence.replace('η', '依塔')
+    sentence = sentence.replace('θ', '西塔').replace('Θ', '西塔')
+    sentence = sentence.replace('ι', '艾欧塔')
+    sentence = sentence.replace('κ', '喀帕')
+    sentence = sentence.replace('λ', '拉姆达').replace('Λ', '拉姆达')
+    sentence = sentence.replace('μ', '缪')
+    sentence = sentence.replace('ν', '拗')
+    sentence = sentence.replace('ξ', '克西').replace('Ξ', '克西')
+    sentence = sentence.replace('ο', '欧米克伦')
+    sentence = sentence.replace('π', '派').replace('Π', '派')
+    sentence = sentence.replace('ρ', '肉')
+    sentence = sentence.replace('ς', '西格玛').replace('Σ', '西格玛').replace(
+        'σ', '西格玛')
+    sentence = sentence.replace('τ', '套')
+    sentence = sentence.replace('υ', '宇普西龙')
+    sentence = sentence.replace('φ', '服艾').replace('Φ', '服艾')
+    sentence = sentence.replace('χ', '器')
+    sentence = sentence.replace('ψ', '普赛').replace('Ψ', '普赛')
+    sentence = sentence.replace('ω', '欧米伽').replace('Ω', '欧米伽')
+    # 兜底数学运算，顺便兼容懒人用语
+    sentence = sentence.replace('+', '加')
+    sentence = sentence.replace('-', '减')
+    sentence = sentence.replace('×', '乘')
+    sentence = sentence.replace('÷', '除')
+    sentence = sentence.replace('=', '等')
+    # re filter special characters, have one more character "-" than line 68
+    sentence = re.sub(r'[-——《》【】<=>{}()（）#&@“”^_|\\]', '', sentence)
+    return sentence
+
+
+pieces = [
+    "2024年", "3月", "12日", "8:30", "~", "5%", "1/2", "-3", "3.14", "kg", "cm", "个", "人", "的",
+    "你好", "，", "。", "+", "=", "x", "²", "ⁿ", "13912345678", "010-12345678", "400-800-1234",
+    "℃", "度", "a", "m", " ", "-", "12", "345", "6789", ".5", "÷", "×", "②", "π", "/",
+]
+
+
+def random_text(rnd:random.Random, num_pieces:int)->str:
+    return "".join(rnd.choice(pieces) for _ in range(num_pieces))
+
+
+def normalize(normalizer:TextNormalizer, fn, text:str):
+    # 部分随机文本会让原实现抛出异常, 两种实现抛出相同的异常也视为一致
+    try:
+        return [fn(sentence) for sentence in normalizer._split(text)]
+    except Exception as e:
+        return type(e).__name__
+
+
+def check_random(normalizer:TextNormalizer, num_texts:int, seed:int)->int:
+    rnd = random.Random(seed)
+    failed = 0
+    for _ in range(num_texts):
+        text = random_text(rnd, rnd.randint(1, 12))
+        expected = normalize(normalizer, normalize_sentence_sequential, text)
+        result = normalize(normalizer, normalizer.normalize_sentence, text)
+        if result != expected:
+            failed += 1
+            if failed <= 10:
+                print("random mismatch: %r\n  expected: %r\n  got:      %r" % (text, expected, result))
+    print("random: %d/%d passed" % (num_texts - failed, num_texts))
+    return failed
+
+
+def bench(normalizer:TextNormalizer, args):
+    rnd = random.Random(args.seed)
+    texts = {
+        "number-heavy": "，".join(random_text(rnd, 10) for _ in range(args.sentences)),
+        "plain": "今天天气很好，我们一起去公园散步吧。" * (args.sentences // 2),
+    }
+    for name, text in texts.items():
+        sentences = normalizer._split(text)
+        for fn in [normalize_sentence_sequential, normalizer.normalize_sentence]:
+            t = ttime()
+            for _ in range(args.runs):
+                for sentence in sentences:
+                    try:
+                        fn(sentence)
+                    except Exception:
+                        pass
+            print("%-14s %-32s %8.2f ms" % (name, fn.__name__, (ttime() - t) / args.runs * 1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="zh_normalization check and benchmark")
+    parser.add_argument("--random_texts", type=int, default=20000)
+    parser.add_argument("--sentences", type=int, default=2000)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    normalizer = TextNormalizer()
+    failed = check_random(normalizer, args.random_texts, args.seed)
+    bench(normalizer, args)
+    sys.exit(1 if failed > 0 else 0)
@@ -7,6 +7,11 @@
     `-a` - `绑定地址, 默认"127.0.0.1"`
     `-p` - `绑定端口, 默认9880`
     `-c` - `TTS配置文件路径, 默认"GPT_SoVITS/configs/tts_infer.yaml"`
+    `-cb` - `开启连续批处理, 并发请求的句子合并到同一个T2S解码batch中`
+    `-mbs` - `连续批处理的最大batch大小, 默认20`
+    `-tw` - `推理工作线程数, 默认1(开启连续批处理时默认与最大batch大小相同)`
+    `-mqs` - `推理排队的最大请求数, 超出时返回503, 默认64`
+    `-sk` - `/srt 接口在"音频输出"目录下保留的音频及字幕文件数, 默认100`
 
 ## 调用:
 
@@ -36,11 +41,15 @@ POST:
     "split_bucket: True,          # bool. whether to split the batch into multiple buckets.
     "speed_factor":1.0,           # float. control the speed of the synthesized audio.
     "streaming_mode": False,      # bool. whether to return a streaming response.
+    "stream_chunk_size": 0,       # int. in streaming mode, vocode every n semantic tokens (25 per second) instead of every sentence, 0 to disable.
     "seed": -1,                   # int. random seed for reproducibility.
     "parallel_infer": True,       # bool. whether to use parallel inference.
-    "repetition_penalty": 1.35    # float. repetition penalty for T2S model.
+    "repetition_penalty": 1.35,   # float. repetition penalty for T2S model.
+    "gpt_weights_path": None,     # str.(optional) GPT weights to use for this request.
+    "sovits_weights_path": None   # str.(optional) SoVITS weights to use for this request.
 }
 ```
+指定的模型常驻于模型池中(LRU淘汰, 见配置文件 model_pool_size / model_pool_cpu_size / model_pool_memory_budget), 切换时无需重新加载
 
 RESP:
 成功: 直接返回 wav 音频流， http code 200
@@ -93,12 +102,29 @@ http://127.0.0.1:9880/set_sovits_weights?weights_path=GPT_SoVITS/pretrained_mode
 RESP: 
 成功: 返回"success", http code 200
 失败: 返回包含错误信息的 json, http code 400
+
+### 模型池状态
+
+endpoint: `/model_pool_status`
+
+RESP: 返回常驻显存及CPU中的模型列表与显存占用, http code 200
+
+### 推理队列状态
+
+endpoint: `/queue_status`
+
+RESP: 返回正在推理及排队中的请求数, http code 200
     
 """
 import os
 import sys
+import queue
+import asyncio
+import threading
 import traceback
-from typing import Generator, Optional
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncGenerator, Optional
 
 now_dir = os.getcwd()
 sys.path.append(now_dir)
@@ -112,7 +138,6 @@ origins = ["*"]  #"*"，即为所有。
 import config as global_config
 
 import argparse
-import subprocess
 import wave
 import signal
 import numpy as np
@@ -121,10 +146,13 @@ from fastapi import FastAPI, Request, HTTPException, Response
 from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi import FastAPI, UploadFile, File
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 import uvicorn
 from io import BytesIO
 from tools.i18n.i18n import I18nAuto
 from GPT_SoVITS.TTS_infer_pack.TTS import TTS, TTS_Config
+from GPT_SoVITS.TTS_infer_pack.audio_export import AudioExporter
+from GPT_SoVITS.TTS_infer_pack.audio_encoder import FFmpegEncoderPool
 from GPT_SoVITS.TTS_infer_pack.text_segmentation_method import get_method_names as get_cut_method_names
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
@@ -136,6 +164,11 @@ parser = argparse.ArgumentParser(description="GPT-SoVITS api")
 parser.add_argument("-c", "--tts_config", type=str, default="GPT_SoVITS/configs/tts_infer.yaml", help="tts_infer路径")
 parser.add_argument("-a", "--bind_addr", type=str, default="127.0.0.1", help="default: 127.0.0.1")
 parser.add_argument("-p", "--port", type=int, default=9880, help="default: 9880")
+parser.add_argument("-cb", "--continuous_batching", action="store_true", default=False, help="合并并发请求的T2S解码")
+parser.add_argument("-mbs", "--max_batch_size", type=int, default=20, help="连续批处理的最大batch大小, default: 20")
+parser.add_argument("-tw", "--tts_workers", type=int, default=None, help="推理工作线程数")
+parser.add_argument("-mqs", "--max_queue_size", type=int, default=64, help="推理排队的最大请求数, default: 64")
+parser.add_argument("-sk", "--srt_keep", type=int, default=100, help="/srt 接口保留的音频及字幕文件数, default: 100")
 args = parser.parse_args()
 config_path = args.tts_config
 # device = args.device
@@ -149,10 +182,14 @@ if config_path in [None, ""]:
 tts_config = TTS_Config(config_path)
 print(tts_config)
 tts_pipeline = TTS(tts_config)
+if args.continuous_batching:
+    tts_pipeline.enable_continuous_batching(True, args.max_batch_size)
 
 APP = FastAPI()
 
 
+# /srt 接口的音频及字幕文件由后台线程写入, 每个请求使用独立的文件名
+audio_exporter = AudioExporter("音频输出", keep_last=args.srt_keep)
 APP.mount("/srt", StaticFiles(directory="音频输出"), name="音频输出")
 
 APP.add_middleware(
@@ -184,6 +221,9 @@ class TTS_Request(BaseModel):
     streaming_mode:bool = False
     parallel_infer:bool = True
     repetition_penalty:float = 1.35
+    gpt_weights_path:str = None
+    sovits_weights_path:str = None
+    stream_chunk_size:int = 0
 
 ### modify from https://github.com/RVC-Boss/GPT-SoVITS/pull/894/files
 def pack_ogg(io_buffer:BytesIO, data:np.ndarray, rate:int):
@@ -206,21 +246,16 @@ def pack_wav(io_buffer:BytesIO, data:np.ndarray, rate:int):
     sf.write(io_buffer, data, rate, format='wav')
     return io_buffer
 
+# 预先启动的ffmpeg AAC编码进程, 请求无需等待ffmpeg启动
+aac_encoder_pool = FFmpegEncoderPool(size=2)
+
 def pack_aac(io_buffer:BytesIO, data:np.ndarray, rate:int):
-    process = subprocess.Popen([
-        'ffmpeg',
-        '-f', 's16le',  # 输入16位有符号小端整数PCM
-        '-ar', str(rate),  # 设置采样率
-        '-ac', '1',  # 单声道
-        '-i', 'pipe:0',  # 从管道读取输入
-        '-c:a', 'aac',  # 音频编码器为AAC
-        '-b:a', '192k',  # 比特率
-        '-vn',  # 不包含视频
-        '-f', 'adts',  # 输出AAC数据流格式
-        'pipe:1'  # 将输出写入管道
-    ], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, _ = process.communicate(input=data.tobytes())
-    io_buffer.write(out)
+    encoder = aac_encoder_pool.acquire(rate)
+    try:
+        encoder.write(data)
+        io_buffer.write(encoder.close())
+    finally:
+        encoder.kill()
     return io_buffer
 
 def pack_audio(io_buffer:BytesIO, data:np.ndarray, rate:int, media_type:str):
@@ -237,6 +272,88 @@ def pack_audio(io_buffer:BytesIO, data:np.ndarray, rate:int, media_type:str):
 
 
 
+class TTSWorkerPool:
+    '''
+    Run the synchronous tts pipeline on dedicated worker threads, so that the event loop stays responsive.
+
+    At most `max_queue_size` requests wait for a free worker, further requests are rejected with queue.Full.
+    Audio chunks are bridged back to the event loop through an async generator,
+        the worker pauses when `max_chunks` chunks are waiting to be consumed.
+    '''
+    def __init__(self, num_workers:int=1, max_queue_size:int=64, max_chunks:int=8):
+        self.num_workers = num_workers
+        self.max_queue_size = max_queue_size
+        self.max_chunks = max_chunks
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="tts_worker")
+        self.lock = threading.Lock()
+        self.num_running:int = 0
+        self.num_waiting:int = 0
+
+    def status(self)->dict:
+        with self.lock:
+            return {
+                "workers": self.num_workers,
+                "running": self.num_running,
+                "waiting": self.num_waiting,
+                "max_queue_size": self.max_queue_size,
+            }
+
+    def submit(self, req:dict)->AsyncGenerator:
+        with self.lock:
+            if self.num_waiting >= self.max_queue_size:
+                raise queue.Full(f"too many pending requests: {self.num_waiting}")
+            self.num_waiting += 1
+
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        cancel = threading.Event()
+        # 队列中每个未被取走的音频块占用一个名额
+        slots = threading.Semaphore(self.max_chunks)
+        self.executor.submit(self._run, req, loop, chunks, slots, cancel)
+        return self._iterate(chunks, slots, cancel)
+
+    def _run(self, req:dict, loop:asyncio.AbstractEventLoop, chunks:asyncio.Queue, slots:threading.Semaphore, cancel:threading.Event):
+        with self.lock:
+            self.num_waiting -= 1
+            self.num_running += 1
+        try:
+            if cancel.is_set():
+                return
+            # 客户端断开后 cancel 被设置, 推理在下一段结束时停止
+            for item in tts_pipeline.run(dict(req, stop_event=cancel)):
+                slots.acquire()
+                if cancel.is_set():
+                    break
+                loop.call_soon_threadsafe(chunks.put_nowait, item)
+        except Exception as e:
+            loop.call_soon_threadsafe(chunks.put_nowait, e)
+        finally:
+            with self.lock:
+                self.num_running -= 1
+            loop.call_soon_threadsafe(chunks.put_nowait, None)
+
+    async def _iterate(self, chunks:asyncio.Queue, slots:threading.Semaphore, cancel:threading.Event):
+        try:
+            while True:
+                item = await chunks.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                slots.release()
+                yield item
+        finally:
+            cancel.set()
+            # 唤醒可能正在等待名额的工作线程
+            slots.release()
+
+
+tts_worker_pool = TTSWorkerPool(
+    num_workers=args.tts_workers if args.tts_workers is not None else (args.max_batch_size if args.continuous_batching else 1),
+    max_queue_size=args.max_queue_size,
+)
+
+
 # from https://huggingface.co/spaces/coqui/voice-chat-with-mistral/blob/main/app.py
 def wave_header_chunk(frame_input=b"", channels=1, sample_width=2, sample_rate=32000):
     # This will create a wave header then append the frame input
@@ -372,6 +489,10 @@ def check_params(req:dict):
     
     if text_split_method not in cut_method_names:
         return JSONResponse(status_code=400, content={"message": f"text_split_method:{text_split_method} is not supported"})
+    for key in ["gpt_weights_path", "sovits_weights_path"]:
+        weights_path = req.get(key, None)
+        if weights_path not in [None, ""] and not os.path.exists(weights_path):
+            return JSONResponse(status_code=400, content={"message": f"{key}: {weights_path} not exists"})
 
     return None
 
@@ -400,8 +521,11 @@ async def tts_handle(req:dict):
                 "seed": -1,                   # int. random seed for reproducibility.
                 "media_type": "wav",          # str. media type of the output audio, support "wav", "raw", "ogg", "aac".
                 "streaming_mode": False,      # bool. whether to return a streaming response.
+                "stream_chunk_size": 0,       # int.(optional) in streaming mode, vocode every n semantic tokens instead of every sentence.
                 "parallel_infer": True,       # bool.(optional) whether to use parallel inference.
-                "repetition_penalty": 1.35    # float.(optional) repetition penalty for T2S model.          
+                "repetition_penalty": 1.35,   # float.(optional) repetition penalty for T2S model.
+                "gpt_weights_path": None,     # str.(optional) GPT weights to use for this request.
+                "sovits_weights_path": None   # str.(optional) SoVITS weights to use for this request.
             }
     returns:
         StreamingResponse: audio stream response.
@@ -419,25 +543,68 @@ async def tts_handle(req:dict):
             req["return_fragment"] = True
         
         
-        tts_generator = tts_pipeline.run(req)
+        tts_generator = tts_worker_pool.submit(req)
 
         if streaming_mode:
-            def streaming_generator(tts_generator: Generator, media_type: str):
+            async def streaming_generator(tts_generator: AsyncGenerator, media_type: str):
                 if media_type == "wav":
                     yield wave_header_chunk()
                     media_type = "raw"
-                for sr, chunk in tts_generator:
-                    yield pack_audio(BytesIO(), chunk, sr, media_type).getvalue()
+                if media_type == "aac":
+                    # 整个流共用一个ffmpeg编码进程, 输出一条连续的ADTS流;
+                    # 编码器的读取线程直接把编码包送入 packets, 与后续片段的合成并行发送
+                    loop = asyncio.get_running_loop()
+                    packets = asyncio.Queue()
+                    encoders = []
+
+                    async def encode():
+                        try:
+                            async for sr, chunk in tts_generator:
+                                if len(encoders) == 0:
+                                    encoder = await run_in_threadpool(aac_encoder_pool.acquire, sr)
+                                    encoders.append(encoder)
+                                    encoder.forward(lambda data: loop.call_soon_threadsafe(packets.put_nowait, data))
+                                await run_in_threadpool(encoders[0].write, chunk)
+                            if len(encoders) == 0:
+                                packets.put_nowait(None)
+                            else:
+                                await run_in_threadpool(encoders[0].finish)
+                        except Exception as e:
+                            packets.put_nowait(e)
+
+                    encode_task = asyncio.ensure_future(encode())
+                    try:
+                        while True:
+                            data = await packets.get()
+                            if data is None:
+                                break
+                            if isinstance(data, Exception):
+                                raise data
+                            yield data
+                    finally:
+                        encode_task.cancel()
+                        await asyncio.gather(encode_task, return_exceptions=True)
+                        await tts_generator.aclose()
+                        for encoder in encoders:
+                            encoder.kill()
+                    return
+                async for sr, chunk in tts_generator:
+                    yield (await run_in_threadpool(pack_audio, BytesIO(), chunk, sr, media_type)).getvalue()
             
             return StreamingResponse(
                 streaming_generator(tts_generator, media_type), 
                 media_type=f"audio/{media_type}"
             )
         else:
-            sr, audio_data = next(tts_generator)
-            audio_data = pack_audio(BytesIO(), audio_data, sr, media_type).getvalue()
+            try:
+                sr, audio_data = await tts_generator.__anext__()
+            finally:
+                await tts_generator.aclose()
+            audio_data = (await run_in_threadpool(pack_audio, BytesIO(), audio_data, sr, media_type)).getvalue()
             return Response(audio_data, media_type=f"audio/{media_type}")
 
+    except queue.Full as e:
+        return JSONResponse(status_code=503, content={"message": "tts queue is full", "Exception": str(e)})
     except Exception as e:
         import traceback
         
@@ -478,8 +645,11 @@ async def tts_handle_srt(req:dict,request):
                 "seed": -1,                   # int. random seed for reproducibility.
                 "media_type": "wav",          # str. media type of the output audio, support "wav", "raw", "ogg", "aac".
                 "streaming_mode": False,      # bool. whether to return a streaming response.
+                "stream_chunk_size": 0,       # int.(optional) in streaming mode, vocode every n semantic tokens instead of every sentence.
                 "parallel_infer": True,       # bool.(optional) whether to use parallel inference.
-                "repetition_penalty": 1.35    # float.(optional) repetition penalty for T2S model.          
+                "repetition_penalty": 1.35,   # float.(optional) repetition penalty for T2S model.
+                "gpt_weights_path": None,     # str.(optional) GPT weights to use for this request.
+                "sovits_weights_path": None   # str.(optional) SoVITS weights to use for this request.
             }
     returns:
         StreamingResponse: audio stream response.
@@ -492,15 +662,20 @@ async def tts_handle_srt(req:dict,request):
         if check_res is not None:
             return check_res
 
-    
-    
-        tts_generator=tts_pipeline.run(req)
-        
-        sr, audio_data = next(tts_generator)
-        print(audio_data)
+        req["return_segments"] = True
+        tts_generator = tts_worker_pool.submit(req)
+        try:
+            sr, audio_data, segments = await tts_generator.__anext__()
+        finally:
+            await tts_generator.aclose()
         #audio_data = pack_audio(BytesIO(), audio_data, sr, media_type).getvalue()
         #return Response(audio_data, media_type=f"audio/{media_type}")
-        return JSONResponse({"code":"200", "srt":f"http://{request.url.hostname}:{request.url.port}/srt/tts-out.srt","audio":f"http://{request.url.hostname}:{request.url.port}/srt/audio.wav"})
+        name = uuid.uuid4().hex
+        await asyncio.wrap_future(audio_exporter.export(name, sr, audio_data, segments))
+        base_url = f"http://{request.url.hostname}:{request.url.port}/srt"
+        return JSONResponse({"code":"200", "srt":f"{base_url}/{name}.srt", "audio":f"{base_url}/{name}.wav", "segments":segments})
+    except queue.Full as e:
+        return JSONResponse(status_code=503, content={"message": "tts queue is full", "Exception": str(e)})
     except Exception as e:
         return JSONResponse(status_code=400, content={"message": f"tts failed", "Exception": str(e)})
 
@@ -531,7 +706,9 @@ async def tts_get_endpoint_srt(request: Request,
                         media_type:str = "wav",
                         streaming_mode:bool = False,
                         parallel_infer:bool = True,
-                        repetition_penalty:float = 1.35
+                        repetition_penalty:float = 1.35,
+                        gpt_weights_path:str = None,
+                        sovits_weights_path:str = None
                         ):
     req = {
         "text": text,
@@ -552,7 +729,9 @@ async def tts_get_endpoint_srt(request: Request,
         "media_type":media_type,
         "streaming_mode":streaming_mode,
         "parallel_infer":parallel_infer,
-        "repetition_penalty":float(repetition_penalty)
+        "repetition_penalty":float(repetition_penalty),
+        "gpt_weights_path":gpt_weights_path,
+        "sovits_weights_path":sovits_weights_path
     }
     return await tts_handle_srt(req,request)
 
@@ -584,7 +763,10 @@ async def tts_get_endpoint(
     media_type:str = "wav",
     streaming_mode:bool = False,
     parallel_infer:bool = True,
-    repetition_penalty:float = 1.35
+    repetition_penalty:float = 1.35,
+    gpt_weights_path:str = None,
+    sovits_weights_path:str = None,
+    stream_chunk_size:int = 0
 ):
     req = {
         "text": text,
@@ -606,7 +788,10 @@ async def tts_get_endpoint(
         "media_type":media_type,
         "streaming_mode":streaming_mode,
         "parallel_infer":parallel_infer,
-        "repetition_penalty":float(repetition_penalty)
+        "repetition_penalty":float(repetition_penalty),
+        "gpt_weights_path":gpt_weights_path,
+        "sovits_weights_path":sovits_weights_path,
+        "stream_chunk_size":int(stream_chunk_size)
     }
     return await tts_handle(req)
                 
@@ -637,7 +822,10 @@ async def tts_get_endpoint(
     media_type:str = "wav",
     streaming_mode:bool = False,
     parallel_infer:bool = True,
-    repetition_penalty:float = 1.35
+    repetition_penalty:float = 1.35,
+    gpt_weights_path:str = None,
+    sovits_weights_path:str = None,
+    stream_chunk_size:int = 0
 ):
     req = {
         "text": text,
@@ -659,7 +847,10 @@ async def tts_get_endpoint(
         "media_type":media_type,
         "streaming_mode":streaming_mode,
         "parallel_infer":parallel_infer,
-        "repetition_penalty":float(repetition_penalty)
+        "repetition_penalty":float(repetition_penalty),
+        "gpt_weights_path":gpt_weights_path,
+        "sovits_weights_path":sovits_weights_path,
+        "stream_chunk_size":int(stream_chunk_size)
     }
     return await tts_handle(req)
                 
@@ -701,7 +892,7 @@ async def set_gpt_weights(weights_path: str = None):
     try:
         if weights_path in ["", None]:
             return JSONResponse(status_code=400, content={"message": "gpt weight path is required"})
-        tts_pipeline.init_t2s_weights(weights_path)
+        await run_in_threadpool(tts_pipeline.set_models, weights_path, None)
     except Exception as e:
         return JSONResponse(status_code=400, content={"message": f"change gpt weight failed", "Exception": str(e)})
 
@@ -713,7 +904,7 @@ async def set_sovits_weights(weights_path: str = None):
     try:
         if weights_path in ["", None]:
             return JSONResponse(status_code=400, content={"message": "sovits weight path is required"})
-        tts_pipeline.init_vits_weights(weights_path)
+        await run_in_threadpool(tts_pipeline.set_models, None, weights_path)
     except Exception as e:
         return JSONResponse(status_code=400, content={"message": f"change sovits weight failed", "Exception": str(e)})
     return JSONResponse(status_code=200, content={"message": "success"})
@@ -736,7 +927,7 @@ async def set_model(request: Request):
 
         # 加载 GPT 模型
         try:
-            tts_pipeline.init_t2s_weights(gpt_path)
+            await run_in_threadpool(tts_pipeline.set_models, gpt_path, None)
         except Exception as e:
             return JSONResponse(
                 status_code=400,
@@ -748,7 +939,7 @@ async def set_model(request: Request):
 
         # 加载 SoVITS 模型
         try:
-            tts_pipeline.init_vits_weights(sovits_path)
+            await run_in_threadpool(tts_pipeline.set_models, None, sovits_path)
         except Exception as e:
             return JSONResponse(
                 status_code=400,
@@ -789,6 +980,30 @@ def speakers_endpoint():
     return JSONResponse(voices, status_code=200)
 
 
+@APP.get("/queue_status")
+async def queue_status_endpoint():
+    return JSONResponse(tts_worker_pool.status(), status_code=200)
+
+
+@APP.get("/model_pool_status")
+async def model_pool_status_endpoint():
+    return JSONResponse(tts_pipeline.model_pool_status(), status_code=200)
+
+
+@APP.get("/cache_stats")
+async def cache_stats_endpoint():
+    english = sys.modules.get("text.english")
+    return JSONResponse(
+        status_code=200,
+        content={
+            "text": tts_pipeline.text_preprocessor.cache_stats(),
+            "ref_audio": tts_pipeline.ref_audio_cache.stats(),
+            # 英文未登录词发音缓存, 英文前端尚未加载时为空
+            "english_oov": english.oov_cache_stats() if english is not None else {},
+        }
+    )
+
+
 @APP.get("/speakers_list")
 def speakerlist_endpoint():
     return JSONResponse(["female_calm","female","male"], status_code=200)
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# 与仓库中的脚本相同, 从仓库根目录与 GPT_SoVITS 目录导入
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+sys.path.append(os.path.join(root_dir, "GPT_SoVITS"))
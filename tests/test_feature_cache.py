@@ -0,0 +1,54 @@
+"""
+TTS_infer_pack.feature_cache.FeatureCache 的磁盘层: 后台写入, 按mtime的LRU淘汰
+"""
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+# TTS_infer_pack 包会导入整个推理管线
+FeatureCache = pytest.importorskip("TTS_infer_pack.feature_cache").FeatureCache
+
+
+def disk_keys(cache_dir):
+    return sorted(name[:-len(".pth")] for name in os.listdir(cache_dir) if name.endswith(".pth"))
+
+
+def test_disk_roundtrip(tmp_path):
+    cache = FeatureCache(max_items=1, cache_dir=str(tmp_path))
+    cache.put("a", torch.arange(4))
+    cache.put("b", torch.arange(8))
+    cache.flush()
+    assert disk_keys(tmp_path) == ["a", "b"]
+
+    # "a" 已被挤出内存, 从磁盘读回
+    assert torch.equal(cache.get("a"), torch.arange(4))
+    assert cache.stats()["disk_hits"] == 1
+
+    # 重启后从磁盘读回
+    restarted = FeatureCache(max_items=1, cache_dir=str(tmp_path))
+    assert torch.equal(restarted.get("b"), torch.arange(8))
+
+
+def test_disk_budget_evicts_least_recently_used(tmp_path):
+    value = torch.zeros(1024)
+    probe = FeatureCache(max_items=1, cache_dir=str(tmp_path / "probe"))
+    probe.put("p", value)
+    probe.flush()
+    file_size = probe.stats()["disk_bytes"]
+
+    cache = FeatureCache(max_items=1, cache_dir=str(tmp_path / "cache"), max_disk_bytes=3 * file_size)
+    for key in ["a", "b", "c"]:
+        cache.put(key, value)
+    cache.flush()
+    # 读取 "a" 使其成为最近使用的文件
+    assert cache.get("a") is not None
+    cache.put("d", value)
+    cache.flush()
+    assert disk_keys(tmp_path / "cache") == ["a", "c", "d"]
+    assert cache.stats()["disk_bytes"] == 3 * file_size
+
+    # 重启时按mtime恢复顺序并立即应用上限
+    restarted = FeatureCache(max_items=1, cache_dir=str(tmp_path / "cache"), max_disk_bytes=2 * file_size)
+    restarted.flush()
+    assert len(disk_keys(tmp_path / "cache")) == 2
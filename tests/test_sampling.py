@@ -0,0 +1,76 @@
+"""
+AR.models.utils 中向量化采样(logits_to_probs_batched / Sampler)与 logits_to_probs 的一致性检查
+"""
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from AR.models.utils import Sampler, logits_to_probs, logits_to_probs_batched
+
+vocab_size = 64
+tolerance = dict(atol=1e-6, rtol=1e-5)
+
+# (top_k, top_p, temperature, repetition_penalty), top_k <= 0 表示不做top-k
+params_list = [
+    (15, 1.0, 1.0, 1.35),
+    (5, 0.8, 0.7, 1.0),
+    (-100, 0.9, 1.2, 1.35),
+    (-100, 1.0, 1.0, 1.0),
+    (vocab_size + 10, 0.5, 1.0, 1.1),
+]
+
+
+def reference_probs(logits, history, top_k, top_p, temperature, repetition_penalty):
+    return logits_to_probs(logits.clone(), history, temperature=temperature, top_k=top_k if top_k > 0 else None,
+                           top_p=top_p, repetition_penalty=repetition_penalty)
+
+
+def as_column(value, dtype):
+    return torch.tensor([[value]], dtype=dtype)
+
+
+@pytest.mark.parametrize("params", params_list)
+def test_batched_matches_logits_to_probs(params):
+    torch.manual_seed(0)
+    top_k, top_p, temperature, repetition_penalty = params
+    logits = torch.randn(1, vocab_size) * 3
+    history = torch.randint(0, vocab_size, (1, 40))
+    token_counts = torch.zeros(1, vocab_size, dtype=torch.int32).scatter_add_(1, history, torch.ones_like(history, dtype=torch.int32))
+
+    probs = logits_to_probs_batched(logits.clone(), token_counts, as_column(temperature, torch.float), as_column(top_k, torch.long),
+                                    as_column(top_p, torch.float), as_column(repetition_penalty, torch.float))
+    torch.testing.assert_close(probs, reference_probs(logits, history, *params), **tolerance)
+
+
+def test_sampler_per_sequence_params():
+    torch.manual_seed(1)
+    bsz = len(params_list)
+    prompts = torch.randint(0, vocab_size, (bsz, 20))
+    sampler = Sampler(vocab_size, "cpu")
+    for i, params in enumerate(params_list):
+        top_k, top_p, temperature, repetition_penalty = params
+        sampler.add(prompts[i:i + 1], top_k, top_p, temperature, repetition_penalty)
+    histories = [prompts[i:i + 1] for i in range(bsz)]
+    rows = list(range(bsz))
+
+    for step in range(30):
+        logits = torch.randn(len(rows), vocab_size) * 3
+        samples, probs = sampler.sample(logits.clone())
+        for j, i in enumerate(rows):
+            torch.testing.assert_close(probs[j:j + 1], reference_probs(logits[j:j + 1], histories[i], *params_list[i]), **tolerance)
+            histories[i] = torch.concat([histories[i], samples[j:j + 1].long()], dim=1)
+        if step == 10:
+            # 与batch推理中移除已结束的序列相同
+            keep = [0, 2, 4]
+            sampler.index_select(torch.LongTensor(keep))
+            rows = [rows[j] for j in keep]
+        if step == 20:
+            # 与T2SScheduler合并新请求相同: 单独prefill的序列并入正在运行的batch
+            other = Sampler(vocab_size, "cpu").add(histories[1], *params_list[1])
+            sampler.extend(other)
+            rows.append(1)
+
+    # token计数直方图与完整历史一致
+    for j, i in enumerate(rows):
+        counts = torch.bincount(histories[i].view(-1), minlength=vocab_size)
+        assert torch.equal(sampler.token_counts[j].long(), counts)
@@ -0,0 +1,168 @@
+"""
+T2S推理代码(T2SBlock / T2STransformer)的数值检查, 使用随机初始化的小模型, 不需要下载预训练模型
+参考实现与 t2s_benchmark.py 共用
+"""
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchmetrics")
+
+from t2s_benchmark import build_model, make_prompt_batch, process_prompt_loop
+
+tolerance = dict(atol=1e-5, rtol=1e-4)
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    return build_model("cpu", n_layer=2)
+
+
+@pytest.mark.parametrize("bsz", [1, 3, 6])
+@torch.no_grad()
+def test_process_prompt_matches_loop(model, bsz):
+    torch.manual_seed(bsz)
+    xy_pos, attn_mask, _, padding_mask = make_prompt_batch(model, bsz, 24, 16, torch.float32, "cpu")
+    x_ref, x = xy_pos, xy_pos
+    for block in model.t2s_transformer.blocks:
+        x_ref, k_ref, v_ref = process_prompt_loop(block, x_ref, attn_mask, padding_mask)
+        x, k, v = block.process_prompt(x, attn_mask, padding_mask)
+        torch.testing.assert_close(x, x_ref, **tolerance)
+        torch.testing.assert_close(k, k_ref, **tolerance)
+        torch.testing.assert_close(v, v_ref, **tolerance)
+
+
+@pytest.mark.parametrize("masked", [False, True])
+@torch.no_grad()
+def test_sdpa_matches_jit(model, masked):
+    torch.manual_seed(1)
+    transformer = model.t2s_transformer
+    bsz, src_len, steps = 3, 32, 4
+    xy_pos = torch.randn(bsz, src_len, model.model_dim)
+    xs = torch.randn(steps, bsz, 1, model.model_dim)
+    max_kv_len = model.get_kv_cache_len(src_len, steps)
+    # 有mask时每条序列前面有不同长度的padding, 与T2SScheduler合并请求时的mask相同
+    starts = torch.tensor([0, 5, 11]) if masked else torch.zeros(bsz, dtype=torch.long)
+
+    outputs = {}
+    try:
+        for backend in ["jit", "sdpa"]:
+            model.set_attention_backend(backend)
+            prompt_mask = torch.arange(src_len).unsqueeze(0) < starts.unsqueeze(1)
+            y, k_cache, v_cache = transformer.process_prompt(xy_pos, prompt_mask.view(bsz, 1, 1, src_len), None, max_kv_len)
+            outputs[backend] = [y]
+            kv_len = src_len
+            for step in range(steps):
+                attn_mask = torch.arange(kv_len + 1).unsqueeze(0) < starts.unsqueeze(1)
+                y, k_cache, v_cache = transformer.decode_next_token(xs[step], k_cache, v_cache, kv_len, attn_mask.view(bsz, 1, 1, kv_len + 1))
+                outputs[backend].append(y)
+                kv_len += 1
+    finally:
+        model.set_attention_backend("jit")
+
+    for y_sdpa, y_jit in zip(outputs["sdpa"], outputs["jit"]):
+        torch.testing.assert_close(y_sdpa, y_jit, **tolerance)
+
+
+@torch.no_grad()
+def test_sdpa_fully_masked_rows(model):
+    # batch推理中padding的query整行被mask, sdpa不应产生NaN(这些位置随后被padding_mask置零)
+    torch.manual_seed(2)
+    xy_pos, attn_mask, _, padding_mask = make_prompt_batch(model, 4, 24, 16, torch.float32, "cpu")
+    try:
+        model.set_attention_backend("sdpa")
+        x_sdpa, _, _ = model.t2s_transformer.process_prompt(xy_pos, attn_mask, padding_mask)
+    finally:
+        model.set_attention_backend("jit")
+    x_jit, _, _ = model.t2s_transformer.process_prompt(xy_pos, attn_mask, padding_mask)
+    assert not torch.isnan(x_sdpa).any()
+    torch.testing.assert_close(x_sdpa, x_jit, **tolerance)
+
+
+@pytest.mark.parametrize("bsz", [1, 4])
+@torch.no_grad()
+def test_compact_prompt_mask_matches_dense(model, bsz):
+    torch.manual_seed(3)
+    xy_pos, attn_mask, compact_attn_mask, padding_mask = make_prompt_batch(model, bsz, 24, 16, torch.float32, "cpu")
+    # padding的query行在稠密mask中整行被mask, 紧凑mask不mask它们(输出会被置零), 只比较有效行
+    valid_rows = padding_mask[:, :, 0].logical_not()
+    assert torch.equal(compact_attn_mask.expand_as(attn_mask).transpose(1, 2)[valid_rows], attn_mask.transpose(1, 2)[valid_rows])
+
+    x_dense, k_dense, v_dense = model.t2s_transformer.process_prompt(xy_pos, attn_mask, padding_mask)
+    x, k, v = model.t2s_transformer.process_prompt(xy_pos, compact_attn_mask, padding_mask)
+    torch.testing.assert_close(x, x_dense, **tolerance)
+    for a, b in zip(k + v, k_dense + v_dense):
+        torch.testing.assert_close(a, b, **tolerance)
+
+
+@torch.no_grad()
+def test_padding_bitmap_decode_matches_dense(model):
+    torch.manual_seed(4)
+    transformer = model.t2s_transformer
+    bsz, x_len, y_len, steps = 3, 20, 12, 6
+    src_len = x_len + y_len
+    x_lens = torch.LongTensor([20, 13, 7])
+    y_lens = torch.LongTensor([y_len] * bsz)
+    # 预分配的长度比解码步数少, 覆盖位图扩容的情况
+    max_kv_len = src_len + steps // 2
+    xy_padding_mask, kv_padding_mask = model.make_batch_padding_mask(x_lens, x_len, y_lens, y_len, max_kv_len)
+    assert kv_padding_mask.shape == (bsz, max_kv_len)
+    assert torch.equal(kv_padding_mask[:, :src_len], xy_padding_mask)
+    assert not kv_padding_mask[:, src_len:].any()
+
+    xy_pos = torch.randn(bsz, src_len, model.model_dim)
+    xs = torch.randn(steps, bsz, 1, model.model_dim)
+    prompt_mask = model.make_batch_prompt_attn_mask(x_len, y_len, kv_padding_mask)
+    padding_mask = xy_padding_mask.view(bsz, src_len, 1).expand(-1, -1, model.model_dim)
+    _, k_ref, v_ref = transformer.process_prompt(xy_pos, prompt_mask, padding_mask, max_kv_len)
+    _, k_cache, v_cache = transformer.process_prompt(xy_pos, prompt_mask, padding_mask, max_kv_len)
+
+    # 参考: 每步拼接出完整的逐head稠密mask
+    dense_mask = xy_padding_mask.view(bsz, 1, 1, src_len).expand(-1, model.num_head, -1, -1)
+    kv_len = src_len
+    for step in range(steps):
+        dense_mask = torch.concat([dense_mask, torch.zeros(bsz, model.num_head, 1, 1, dtype=torch.bool)], dim=-1)
+        y_ref, k_ref, v_ref = transformer.decode_next_token(xs[step], k_ref, v_ref, kv_len, dense_mask)
+
+        if kv_len + 1 > kv_padding_mask.shape[1]:
+            kv_padding_mask = torch.nn.functional.pad(kv_padding_mask, (0, kv_padding_mask.shape[1]), value=False)
+        step_mask = kv_padding_mask[:, None, None, :kv_len + 1]
+        y, k_cache, v_cache = transformer.decode_next_token(xs[step], k_cache, v_cache, kv_len, step_mask)
+        kv_len += 1
+        torch.testing.assert_close(y, y_ref, **tolerance)
+
+
+@torch.no_grad()
+def test_static_decode_step_matches_eager(model):
+    torch.manual_seed(5)
+    transformer = model.t2s_transformer
+    src_len, steps, capacity = 16, 10, 22
+    xy_pos = torch.randn(1, src_len, model.model_dim)
+    xs = torch.randn(steps, 1, 1, model.model_dim)
+    attn_mask = torch.zeros(1, 1, src_len, src_len, dtype=torch.bool)
+    max_kv_len = model.get_kv_cache_len(src_len, steps)
+
+    _, k_ref, v_ref = transformer.process_prompt(xy_pos, attn_mask, None, max_kv_len)
+    kv_len = src_len
+    y_ref = []
+    for step in range(steps):
+        y, k_ref, v_ref = transformer.decode_next_token(xs[step], k_ref, v_ref, kv_len)
+        y_ref.append(y)
+        kv_len += 1
+
+    # "eager": 不经过torch.compile的静态形状解码步; capacity小于总长度, 覆盖中途拷回eager解码的情况
+    compiled = model.enable_compiled_decode("eager", capacity)
+    try:
+        _, k_cache, v_cache = transformer.process_prompt(xy_pos, attn_mask, None, max_kv_len)
+        assert compiled.acquire(xy_pos, src_len)
+        compiled.load_prompt(k_cache, v_cache, src_len)
+        kv_len = src_len
+        for step in range(steps):
+            y, k_cache, v_cache, compiled = model.decode_next_token_single(xs[step], k_cache, v_cache, kv_len, max_kv_len, compiled)
+            kv_len += 1
+            torch.testing.assert_close(y, y_ref[step], **tolerance)
+        assert compiled is None
+    finally:
+        if compiled is not None:
+            compiled.release()
+        model.enable_compiled_decode(None)
@@ -0,0 +1,52 @@
+"""
+zh_normalization.TextNormalizer 的输出检查
+
+golden: 固定样例的输出必须与记录的结果一致
+random: 跳过不可能命中的规则后, 输出必须与逐条规则执行的原实现一致
+"""
+import random
+
+import pytest
+
+pytest.importorskip("pypinyin")
+
+from text.zh_normalization.text_normlization import TextNormalizer
+from zh_normalization_benchmark import normalize, normalize_sentence_sequential, random_text
+
+golden_cases = [
+    ('今天是2024年10月18日，气温-3~5℃。', ['今天是二零二四年十月十八日，', '气温负三~五度。']),
+    ('买了3.5kg苹果，花了50%的钱。', ['买了三点五千克苹果，', '花了百分之五十的钱。']),
+    ('电话13812345678，座机010-12345678，客服400-123-4567。', ['电话幺三八幺二三四五六七八，', '座机零幺零减幺二三四五六七八，', '客服四零零减幺二三减四五六七。']),
+    ('没有数字的句子，只是普通的中文文本。', ['没有数字的句子，', '只是普通的中文文本。']),
+    ('a+b=c，x²+y²=z²。', ['a加b等于c，', 'x的二次方加y的二次方等于z的二次方。']),
+    ('会议时间8:30-10:00，地点3楼。', ['会议时间八点半至十点，', '地点三楼。']),
+    ('比分是3:2。', ['比分是三:二。']),
+    ('日期2024-01-05。', ['日期二零二四年一月五日。']),
+    ('20cm~30cm。', ['二十厘米至三十厘米。']),
+    ('α和β，①②③。', ['阿尔法和贝塔，', '一二三。']),
+    ('共有12345人，约1000多个。', ['共有一万二千三百四十五人，', '约一千多个。']),
+    ('-5度，5-10个。', ['零下五度，', '五减十个。']),
+    ('23:59:59', ['二十三点五十九分五十九秒']),
+    ('1+2=3', ['一加二等于三']),
+    ('三分之一写作1/3。', ['三分之一写作三分之一。']),
+    ('ＡＢＣ１２３。', ['ABC幺二三。']),
+    ('速度是120km/h。', ['速度是一百二十千米每h。']),
+]
+
+
+@pytest.fixture(scope="module")
+def normalizer():
+    return TextNormalizer()
+
+
+@pytest.mark.parametrize("text, expected", golden_cases)
+def test_golden(normalizer, text, expected):
+    assert normalizer.normalize(text) == expected
+
+
+def test_matches_sequential_rules(normalizer):
+    rnd = random.Random(0)
+    for _ in range(2000):
+        text = random_text(rnd, rnd.randint(1, 12))
+        expected = normalize(normalizer, normalize_sentence_sequential, text)
+        assert normalize(normalizer, normalizer.normalize_sentence, text) == expected, text
@@ -0,0 +1,54 @@
+"""
+load_audio 解码速度测试: 进程内解码(soundfile + resample_poly) 与 ffmpeg 子进程的对比
+
+` python tools/load_audio_benchmark.py --dir 参考音频目录 --sr 32000 `
+
+输出两种方式每秒加载的文件数, 以及两者结果的最大误差
+"""
+import os
+import sys
+import argparse
+from time import perf_counter as ttime
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import numpy as np
+
+from tools.my_utils import SOUNDFILE_EXTS, load_audio_ffmpeg, load_audio_soundfile
+
+
+def bench(fn, files, sr):
+    results = []
+    t = ttime()
+    for file in files:
+        results.append(fn(file, sr))
+    cost = ttime() - t
+    return results, len(files) / cost
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="load_audio benchmark")
+    parser.add_argument("--dir", type=str, required=True, help="directory of short audio clips")
+    parser.add_argument("--sr", type=int, default=32000)
+    parser.add_argument("--limit", type=int, default=200)
+    args = parser.parse_args()
+
+    files = sorted(os.path.join(args.dir, name) for name in os.listdir(args.dir)
+                   if os.path.splitext(name)[1].lower() in SOUNDFILE_EXTS)[:args.limit]
+    if len(files) == 0:
+        print("no wav/flac/ogg files in %s" % args.dir)
+        sys.exit(1)
+
+    sf_results, sf_speed = bench(load_audio_soundfile, files, args.sr)
+    ff_results, ff_speed = bench(load_audio_ffmpeg, files, args.sr)
+
+    max_diff = 0.0
+    for a, b in zip(sf_results, ff_results):
+        length = min(len(a), len(b))
+        if length > 0:
+            max_diff = max(max_diff, float(np.abs(a[:length] - b[:length]).max()))
+    print("files: %d, sr: %d" % (len(files), args.sr))
+    print("soundfile: %8.1f files/s" % sf_speed)
+    print("ffmpeg:    %8.1f files/s" % ff_speed)
+    print("max abs diff: %.5f" % max_diff)
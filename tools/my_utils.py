@@ -1,32 +1,63 @@
 import platform,os,traceback
+import math
 import ffmpeg
 import numpy as np
+import soundfile as sf
+from scipy.signal import resample_poly
 import gradio as gr
 from tools.i18n.i18n import I18nAuto
 import pandas as pd
 i18n = I18nAuto(language=os.environ.get('language','Auto'))
 
+# soundfile(libsndfile)可直接解码的格式, 在进程内解码; 其余格式交给ffmpeg
+SOUNDFILE_EXTS = {".wav", ".flac", ".ogg", ".oga", ".aif", ".aiff"}
+
+
+def resample_audio(audio:np.ndarray, orig_sr:int, sr:int)->np.ndarray:
+    if orig_sr == sr:
+        return audio
+    # 多相滤波重采样, 整段向量化计算
+    gcd = math.gcd(int(orig_sr), int(sr))
+    return resample_poly(audio, int(sr) // gcd, int(orig_sr) // gcd).astype(np.float32)
+
+
+def load_audio_soundfile(file, sr):
+    audio, orig_sr = sf.read(file, dtype="float32", always_2d=True)
+    # 多声道取平均混为单声道
+    audio = audio.mean(axis=1) if audio.shape[1] > 1 else audio[:, 0]
+    return resample_audio(audio, orig_sr, sr)
+
+
+def load_audio_ffmpeg(file, sr):
+    # https://github.com/openai/whisper/blob/main/whisper/audio.py#L26
+    # This launches a subprocess to decode audio while down-mixing and resampling as necessary.
+    # Requires the ffmpeg CLI and `ffmpeg-python` package to be installed.
+    out, _ = (
+        ffmpeg.input(file, threads=0)
+        .output("-", format="f32le", acodec="pcm_f32le", ac=1, ar=sr)
+        .run(cmd=["ffmpeg", "-nostdin"], capture_stdout=True, capture_stderr=True)
+    )
+    return np.frombuffer(out, np.float32).flatten()
+
+
 def load_audio(file, sr):
     try:
-        # https://github.com/openai/whisper/blob/main/whisper/audio.py#L26
-        # This launches a subprocess to decode audio while down-mixing and resampling as necessary.
-        # Requires the ffmpeg CLI and `ffmpeg-python` package to be installed.
         file = clean_path(file)  # 防止小白拷路径头尾带了空格和"和回车
         if os.path.exists(file) == False:
             raise RuntimeError(
                 "You input a wrong audio path that does not exists, please fix it!"
             )
-        out, _ = (
-            ffmpeg.input(file, threads=0)
-            .output("-", format="f32le", acodec="pcm_f32le", ac=1, ar=sr)
-            .run(cmd=["ffmpeg", "-nostdin"], capture_stdout=True, capture_stderr=True)
-        )
+        if os.path.splitext(file)[1].lower() in SOUNDFILE_EXTS:
+            try:
+                return load_audio_soundfile(file, sr)
+            except Exception:
+                # 编码不受 libsndfile 支持(如部分wav压缩格式)时回退到ffmpeg
+                pass
+        return load_audio_ffmpeg(file, sr)
     except Exception as e:
         traceback.print_exc()
         raise RuntimeError(i18n("音频加载失败"))
 
-    return np.frombuffer(out, np.float32).flatten()
-
 
 def clean_path(path_str:str):
     if path_str.endswith(('\\','/')):